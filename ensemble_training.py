@@ -4,13 +4,19 @@ import torch
 import tqdm
 import time
 import os
+import itertools
 
 from src.multicls_trainer import PromptBoostingTrainer
+from src.multi_run import MultiRunBooster, load_template_preds, boost_runs, evaluate_runs
+from src.checkpoint import save_checkpoint, load_checkpoint, save_ensemble, load_ensemble, get_base_ids
 from src.ptuning import BaseModel, RoBERTaVTuningClassification, OPTVTuningClassification
-from src.saver import PredictionSaver, TestPredictionSaver
+from src.saver import PredictionSaver, TestPredictionSaver, VerbalizerMemo
 from src.template import SentenceTemplate, TemplateManager
 from src.utils import ROOT_DIR, BATCH_SIZE, create_logger, MODEL_CACHE_DIR
 from src.data_util import get_class_num, get_template_list_with_filter, load_dataset, get_task_type, get_template_list
+from src.planner import plan_storage, GB
+from src.prob_store import DEFAULT_TOPK
+from src.cache_backend import get_cache_backend
 
 import wandb
 import argparse
@@ -45,8 +51,173 @@ parser.add_argument("--fewshot_seed", type = int, default = 100, choices = [100,
 
 parser.add_argument("--filter_templates", action = 'store_true')
 
+parser.add_argument("--storage_mode", type = str, default = 'auto', choices = ['auto', 'dense', 'half', 'topk', 'mmap'])
+parser.add_argument("--store_topk", type = int, default = DEFAULT_TOPK)
+parser.add_argument("--store_layout", type = str, default = 'example', choices = ['example', 'token'])
+parser.add_argument("--search_mode", type = str, default = 'batched', choices = ['loop', 'batched', 'exact', 'race'], help = "verbalizer candidate search")
+parser.add_argument("--race_delta", type = float, default = 0.05, help = "race search mode: the largest probability to drop the best candidate")
+parser.add_argument("--candidate_cache", type = float, default = None,
+                    help = "GB of device memory for the cached wrong flags of the evaluated candidates (1 by default), 0 to disable")
+parser.add_argument("--cache_backend", type = str, default = '', help = "shared prediction cache: http://host:port of scripts/cache_server.py, or a shared directory")
+parser.add_argument("--memory_budget", type = float, default = 0, help = "GB, 0 for detecting from the device")
+parser.add_argument("--disk_budget", type = float, default = 0, help = "GB, 0 for detecting from the cache directory")
+parser.add_argument("--stream_test", action = 'store_true', help = "evaluate the test set chunk by chunk without caching its full distribution")
+parser.add_argument("--prefix_curve", action = 'store_true', help = "report the accuracy of every ensemble size on train/valid/test")
+parser.add_argument("--grid_adaboost_lrs", type = float, nargs = '+', default = None, help = "grid mode: train one ensemble per (label set size, adaboost lr)")
+parser.add_argument("--grid_label_set_sizes", type = int, nargs = '+', default = None, help = "grid mode: train one ensemble per (label set size, adaboost lr)")
+parser.add_argument("--checkpoint_dir", type = str, default = 'checkpoints/')
+parser.add_argument("--checkpoint_interval", type = int, default = 0, help = "save the boosting state every n rounds (0: no checkpoints)")
+parser.add_argument("--resume", action = 'store_true', help = "continue from the checkpoint of the same run if there is one")
+parser.add_argument("--save_ensemble", type = str, default = '', help = "save the weak learners to this file at the end of training")
+parser.add_argument("--warm_start", type = str, default = '', help = "continue boosting from an ensemble saved with --save_ensemble")
+parser.add_argument("--template_schedule", type = str, default = 'rotate', choices = ['rotate', 'threshold'],
+                    help = "threshold: with --change_template, keep fitting weak learners on the current template while their error is below --stay_error")
+parser.add_argument("--stay_error", type = float, default = 0.3)
+parser.add_argument("--max_stay_rounds", type = int, default = 10, help = "the largest number of consecutive weak learners on a template")
+parser.add_argument("--verbalizer_memo", action = 'store_true', help = "reuse (and record) the weak learners fitted on the templates with uniform weights")
+parser.add_argument("--template_selection", type = str, default = 'sequential', choices = ['sequential', 'joint'],
+                    help = "joint: every round, pick the (template, verbalizer) pair with the lowest error among all the templates")
+
 args = parser.parse_args()
 
+## the settings that change the weak learners of a run: a checkpoint is only resumed with the same ones
+CHECKPOINT_SETTINGS = ['dataset', 'model', 'adaboost_lr', 'label_set_size', 'max_template_num', 'use_logits', 'change_template',
+                       'use_part_templates', 'start_idx', 'end_idx', 'sort_dataset', 'fewshot', 'low', 'fewshot_k', 'fewshot_seed',
+                       'filter_templates', 'store_layout', 'search_mode', 'race_delta', 'template_schedule', 'stay_error',
+                       'max_stay_rounds', 'verbalizer_memo', 'template_selection', 'warm_start']
+
+def memo_search(memo, memo_entries, trainer, template, vtuning_model, train_probs, train_labels, weight_tensor, label_set_size):
+    '''
+    consult the VerbalizerMemo for the weak learner of the template. The memoized label set scores (computed with uniform
+    weights) start the incremental label set scores of the template on its first visit. While the weights are still uniform
+    (no weak learner yet), the memoized verbalizer replaces the search.
+    return: the search result to pass to boost_round (None to search), and whether the entry of the template is missing
+    '''
+    template_name = template.template_name
+    if template_name not in memo_entries:
+        memo_entries[template_name] = memo.load(template, label_set_size)
+    entry = memo_entries[template_name]
+    uniform_weights = torch.ones_like(weight_tensor) / weight_tensor.size(0)
+    if entry is not None and entry['scores'] is not None and trainer.label_set_scores.get_saved_scores(template_name) is None:
+        trainer.label_set_scores.seed(template_name, entry['scores'].to(vtuning_model.device), uniform_weights.to(vtuning_model.device))
+    if len(trainer.model_weight_tensor) > 0:
+        return None, False
+    if entry is None:
+        return None, True
+    trainer.replay_search_rng(label_set_size)
+    selected = torch.LongTensor(entry['verbalizer']).to(weight_tensor.device)
+    return trainer.search_result_from_verbalizer(selected, train_probs, train_labels, weight_tensor), False
+
+def warm_start_from(ensemble, trainer, template_manager, prediction_saver, vtuning_model, train_dataset, valid_dataset,
+                    train_labels, valid_labels, weight_tensor):
+    '''
+    continue boosting from a saved ensemble (see save_ensemble): its weak learners are replayed with their alphas on the current,
+    e.g. enlarged, training set to recompute the dataset weights. The predictions of a template come from the cache of the current
+    datasets, or are extended from the cache of the datasets the ensemble was fitted on, so only the new examples need forward passes.
+    return: the dataset weights to continue from
+    '''
+    base_saver = PredictionSaver(storage_mode = prediction_saver.storage_mode, device = prediction_saver.device,
+                                 store_topk = prediction_saver.store_topk, store_layout = prediction_saver.store_layout, **ensemble['cache'])
+    templates = {template.template_name: template for template in template_manager.get_all_template()}
+    num_models = len(ensemble['alphas'])
+    train_preds, valid_preds = [None] * num_models, [None] * num_models
+    for template_name in dict.fromkeys(ensemble['template_name_list']):
+        assert template_name in templates, f"template {template_name} of the saved ensemble is not loaded"
+        template = templates[template_name]
+        cached_preds, flag = prediction_saver.load_preds(template)
+        if flag and len(cached_preds[0]) == len(train_dataset[0]) and len(cached_preds[1]) == len(valid_dataset[0]):
+            train_probs, valid_probs = cached_preds
+        else:
+            ## the cache of the current datasets is replaced when the training set grew since it was written
+            grown = flag and len(train_dataset[0]) > len(cached_preds[0])
+            del cached_preds
+            base_preds, base_flag = base_saver.load_preds(template)
+            probs = []
+            for split, eval_dataset, base_examples in [('train', train_dataset, ensemble['train_examples']),
+                                                       ('valid', valid_dataset, ensemble['valid_examples'])]:
+                store_path = prediction_saver.get_store_prefix(template, split)
+                if store_path == base_saver.get_store_prefix(template, split):
+                    store_path = None    ## the base store is read while the extended one is written: save_preds writes it
+                base_probs = base_preds[0 if split == 'train' else 1] if base_flag else []
+                if len(base_probs) > 0:
+                    probs.append(trainer.extend_logits(vtuning_model, template, eval_dataset, base_probs, get_base_ids(eval_dataset, base_examples),
+                                                       store_path = store_path))
+                else:
+                    probs.append(trainer.pre_compute_logits(vtuning_model, template, eval_dataset, store_path = store_path))
+            train_probs, valid_probs = probs
+            del base_preds
+            del base_probs
+            prediction_saver.save_preds(template, train_probs, valid_probs, overwrite = grown)
+        for model_id in range(num_models):
+            if ensemble['template_name_list'][model_id] != template_name:
+                continue
+            verbalizer = [vtuning_model.word2idx[ensemble['verbalizer_list'][model_id][i]] for i in range(trainer.num_classes)]
+            _, train_preds[model_id], _ = trainer.compute_acc(train_probs, verbalizer, train_labels, sync = False)
+            _, valid_preds[model_id], _ = trainer.compute_acc(valid_probs, verbalizer, valid_labels, sync = False)
+        del train_probs
+        del valid_probs
+
+    for model_id in range(num_models):
+        weight_tensor = trainer.replay_weak_learner(ensemble['verbalizer_list'][model_id], ensemble['template_name_list'][model_id],
+                                                    ensemble['alphas'][model_id], train_preds[model_id], valid_preds[model_id],
+                                                    train_labels, weight_tensor)
+    if num_models > 0:
+        trainer.best_epoch = trainer.get_best_epoch(valid_labels, split = 'valid')
+        trainer.best_ensemble_valid = trainer.ensemble_result(valid_labels, split = 'valid', ensemble_num = trainer.best_epoch, verbose = False).item()
+    print(f"warm start from {num_models} weak classifiers, best ensemble classfier: 0 - {trainer.best_epoch}, valid acc {trainer.best_ensemble_valid}")
+    return weight_tensor
+
+def check_grid_args(args):
+    '''
+    grid mode advances the runs with the batched search of MultiRunBooster on the rotating template sequence, without
+    candidate caches, checkpoints, warm start or memo: the options of the single-run loop it cannot honour are refused
+    '''
+    unsupported = []
+    if args.search_mode != 'batched':
+        unsupported.append(f"--search_mode {args.search_mode}")
+    if args.candidate_cache is not None:
+        unsupported.append("--candidate_cache")
+    if args.template_schedule != 'rotate':
+        unsupported.append(f"--template_schedule {args.template_schedule}")
+    if args.template_selection != 'sequential':
+        unsupported.append(f"--template_selection {args.template_selection}")
+    if args.checkpoint_interval > 0 or args.resume:
+        unsupported.append("--checkpoint_interval/--resume")
+    if args.warm_start != '':
+        unsupported.append("--warm_start")
+    if args.save_ensemble != '':
+        unsupported.append("--save_ensemble")
+    if args.verbalizer_memo:
+        unsupported.append("--verbalizer_memo")
+    if args.prefix_curve:
+        unsupported.append("--prefix_curve")
+    if len(unsupported) > 0:
+        parser.error(f"grid mode (--grid_adaboost_lrs/--grid_label_set_sizes) does not support {', '.join(unsupported)}")
+
+def train_grid(grid, trainers, template_manager, prediction_saver, test_pred_saver, vtuning_model, train_dataset, valid_dataset, test_dataset,
+               train_labels, valid_labels, adaboost_weak_cls, use_wandb = False, streaming = False):
+    '''
+    grid mode: the ensembles of all the (label set size, adaboost lr) configurations are advanced together round by round
+    against the same template stores (see MultiRunBooster), then the validation curves of the whole grid are reported.
+    '''
+    run_names = [f"label_set{label_set_size}-lr{adaboost_lr}" for label_set_size, adaboost_lr in grid]
+    booster = MultiRunBooster(run_names, trainers, [label_set_size for label_set_size, _ in grid], len(train_dataset[0]),
+                              device = train_labels.device)
+    log_fn = (lambda run_name, tolog: wandb.log({f"{run_name}/{key}": value for key, value in tolog.items()})) if use_wandb else None
+    boost_runs(booster, template_manager, prediction_saver, vtuning_model, train_dataset, valid_dataset, train_labels, valid_labels,
+               adaboost_weak_cls, log_fn = log_fn)
+
+    curves = booster.validation_curves(valid_labels)
+    for run_name in run_names:
+        print(f"[{run_name}] valid accuracy by ensemble size: " + ", ".join([f"{i + 1}: {acc:.4f}" for i, acc in enumerate(curves[run_name])]))
+    results = evaluate_runs(booster, template_manager, vtuning_model, valid_labels, test_dataset, test_pred_saver, streaming = streaming)
+    if use_wandb:
+        for run_name, _, valid_ensemble_acc, test_ensemble_acc in results:
+            wandb.log({f"{run_name}/best_valid": valid_ensemble_acc, f"{run_name}/best_test": test_ensemble_acc})
+    print("run\tbest epoch\tbest valid acc\tbest test acc")
+    for run_name, best_epoch, valid_ensemble_acc, test_ensemble_acc in results:
+        print(f"{run_name}\t{best_epoch}\t{valid_ensemble_acc}\t{test_ensemble_acc}")
+
 if __name__ == '__main__':
     device = torch.device('cuda')
     adaboost_lr = args.adaboost_lr
@@ -123,74 +294,135 @@ if __name__ == '__main__':
     dir_list = "\n\t".join(template_manager.template_dir_list)
     print(f"using templates from: {dir_list}",)
 
-    trainer = PromptBoostingTrainer(adaboost_lr = adaboost_lr, num_classes = num_classes, adaboost_maximum_epoch = adaboost_maximum_epoch)
+    if args.template_selection == 'joint' and args.verbalizer_memo:
+        ## the memo holds one weak learner per template, while joint selection searches all the templates every round
+        parser.error("--template_selection joint does not support --verbalizer_memo")
+
+    grid = None
+    if args.grid_adaboost_lrs is not None or args.grid_label_set_sizes is not None:
+        check_grid_args(args)
+        grid = list(itertools.product(args.grid_label_set_sizes or [label_set_size], args.grid_adaboost_lrs or [adaboost_lr]))
+
+    storage_plan = plan_storage(num_training, num_valid, num_test, vtuning_model.lm_model.config.vocab_size,
+                                num_templates = len(template_manager.get_all_template()),
+                                num_weak_cls = adaboost_weak_cls * (len(grid) if grid is not None else 1),
+                                storage_mode = args.storage_mode, topk = args.store_topk, device = device,
+                                cache_dir = os.path.join(ROOT_DIR, pred_cache_dir if pred_cache_dir != '' else 'cached_preds/'),
+                                memory_budget = int(args.memory_budget * GB), disk_budget = int(args.disk_budget * GB),
+                                stream_test = args.stream_test,
+                                num_resident_templates = len(template_manager.get_all_template()) if args.template_selection == 'joint' else 1)
+
+    cache_backend = get_cache_backend(args.cache_backend)
+    trainer = PromptBoostingTrainer(adaboost_lr = adaboost_lr, num_classes = num_classes, adaboost_maximum_epoch = adaboost_maximum_epoch,
+                                    storage_mode = storage_plan.mode, store_topk = storage_plan.topk,
+                                    store_layout = args.store_layout, search_mode = args.search_mode,
+                                    flag_cache_bytes = int((args.candidate_cache if args.candidate_cache is not None else 1.0) * GB), race_delta = args.race_delta)
 
     if pred_cache_dir != '':
         prediction_saver = PredictionSaver(save_dir = os.path.join(ROOT_DIR, pred_cache_dir), model_name = model,
                                             fewshot = fewshot, fewshot_k = fewshot_k, fewshot_seed = fewshot_seed,
-                                            low = low,
+                                            low = low, storage_mode = storage_plan.mode, device = device, backend = cache_backend,
+                                            store_topk = storage_plan.topk, store_layout = args.store_layout,
                                             )
     else:
         prediction_saver = PredictionSaver(model_name = model,
                                             fewshot = fewshot, fewshot_k = fewshot_k, fewshot_seed = fewshot_seed,        
+                                            storage_mode = storage_plan.mode, device = device, backend = cache_backend,
+                                            store_topk = storage_plan.topk, store_layout = args.store_layout,
                                             )
-    test_pred_saver = TestPredictionSaver(save_dir = os.path.join(ROOT_DIR, f'cached_test_preds/{dataset}/'), model_name = model)
+    test_pred_saver = TestPredictionSaver(save_dir = os.path.join(ROOT_DIR, f'cached_test_preds/{dataset}/'), model_name = model,
+                                          storage_mode = storage_plan.mode, device = device, backend = cache_backend,
+                                          store_topk = storage_plan.topk, store_layout = args.store_layout)
+    if grid is not None:
+        trainers = [PromptBoostingTrainer(adaboost_lr = grid_lr, num_classes = num_classes, adaboost_maximum_epoch = adaboost_maximum_epoch,
+                                          storage_mode = storage_plan.mode, store_topk = storage_plan.topk, store_layout = args.store_layout)
+                    for _, grid_lr in grid]
+        train_grid(grid, trainers, template_manager, prediction_saver, test_pred_saver, vtuning_model, train_dataset, valid_dataset, test_dataset,
+                   train_labels, valid_labels, adaboost_weak_cls, use_wandb = use_wandb, streaming = args.stream_test)
+        exit()
+
     train_probs, valid_probs = [],[]
 
-    word2idx = vtuning_model.tokenizer.get_vocab()
-    for model_id in tqdm.tqdm(range(adaboost_weak_cls)):
-        if args.change_template:
-            del train_probs
-            del valid_probs
-            template = template_manager.change_template()
+    resident_templates = {}
+    if args.template_selection == 'joint':
+        for template in template_manager.get_all_template():
             template.visualize()
-            cached_preds, flag = prediction_saver.load_preds(template)
-            if not flag:
-                train_probs = trainer.pre_compute_logits(vtuning_model, template, train_dataset,)
-                valid_probs = trainer.pre_compute_logits(vtuning_model, template, valid_dataset,)
-                prediction_saver.save_preds(template, train_probs, valid_probs)
-            else:
-                train_probs, valid_probs = cached_preds
-
-        trainer.record_dataset_weights(weight_tensor)
-
-        verbalizer, train_error,train_acc, wrong_flags,train_preds= trainer.train(train_dataset, vtuning_model, train_probs, train_labels,
-                                                                                weight_tensor = weight_tensor,label_set_size = label_set_size,
-                                                                                )
-        print(verbalizer)
-        if train_error < 1 - (1 / (num_classes)):
-            print(f"\tmodel {model_id + 1} finished")
-            print(f"\ttrain error {train_error}, train_acc {train_acc}")
-            succ_flag = True
-        else:
-            print(f"error {train_error}; train_acc {train_acc}\n Ensemble is worse than random, ensemble can not be fit.")
+            resident_templates[template.template_name] = (template,) + load_template_preds(trainer, prediction_saver, vtuning_model, template,
+                                                                                           train_dataset, valid_dataset)
+
+    run_name = f"{model}-{dataset}-{suffix}-label_set{label_set_size}-lr{adaboost_lr}-{args.template_selection}-{args.template_schedule}" \
+               f"-{args.search_mode}-{storage_plan.mode}-{args.store_layout}"
+    if fewshot:
+        run_name += f"-{fewshot_k}shot-seed{fewshot_seed}"
+    elif low:
+        run_name += f"-low{fewshot_k}-seed{fewshot_seed}"
+    checkpoint_path = os.path.join(ROOT_DIR, args.checkpoint_dir, f"{run_name}.pt")
+    run_config = {key: getattr(args, key) for key in CHECKPOINT_SETTINGS}
+    run_config.update({'storage_mode': storage_plan.mode, 'store_topk': storage_plan.topk})
+    start_round = 0
+    loop_state = {'stay_on_template': False, 'rounds_on_template': 0}
+    if args.resume:
+        start_round, saved_weight_tensor, saved_loop_state = load_checkpoint(checkpoint_path, trainer, template_manager, device = device,
+                                                                            config = run_config)
+        if saved_weight_tensor is not None:
+            weight_tensor = saved_weight_tensor
+            loop_state.update(saved_loop_state)
+    if args.warm_start != '' and len(trainer.model_weight_tensor) == 0:
+        weight_tensor = warm_start_from(load_ensemble(args.warm_start), trainer, template_manager, prediction_saver, vtuning_model,
+                                        train_dataset, valid_dataset, train_labels, valid_labels, weight_tensor)
+
+    loaded_template_name = None
+    memo, memo_entries = None, {}
+    if args.verbalizer_memo:
+        memo = VerbalizerMemo(train_dataset, valid_dataset, model_name = model, search_config = trainer.memo_config(), backend = cache_backend)
+    if loop_state['stay_on_template']:
+        template = template_manager.get_current_template()
+
+    for model_id in tqdm.tqdm(range(start_round, adaboost_weak_cls)):
+        search_result = None
+        if args.template_selection == 'joint':
+            template_probs = {name: train_probs for name, (_, train_probs, _) in resident_templates.items()}
+            best_name, search_result = trainer.select_template(train_dataset, vtuning_model, template_probs, train_labels,
+                                                               weight_tensor, label_set_size)
+            if best_name is None:
+                print(f"\tround {model_id + 1} skipped: no template gives a weak learner better than the error of 1")
+                continue
+            template, train_probs, valid_probs = resident_templates[best_name]
+            template.visualize()
+        elif args.change_template:
+            if not loop_state['stay_on_template']:
+                template = template_manager.change_template()
+                template.visualize()
+                loop_state['rounds_on_template'] = 0
+            if template.template_name != loaded_template_name:
+                del train_probs
+                del valid_probs
+                train_probs, valid_probs = load_template_preds(trainer, prediction_saver, vtuning_model, template, train_dataset, valid_dataset)
+                loaded_template_name = template.template_name
+
+        record_memo = False
+        if memo is not None:
+            search_result, record_memo = memo_search(memo, memo_entries, trainer, template, vtuning_model, train_probs, train_labels,
+                                                     weight_tensor, label_set_size)
+
+        tolog, weight_tensor = trainer.boost_round(train_dataset, vtuning_model, train_probs, train_labels, valid_probs, valid_labels,
+                                                   weight_tensor, label_set_size, template.template_name,
+                                                   score_key = template.template_name, search_result = search_result)
+        ## threshold schedule: fit the next weak learner on the same template (its cached predictions and label set scores
+        ## are already resident) while the last one was good enough
+        loop_state['rounds_on_template'] += 1
+        loop_state['stay_on_template'] = args.template_schedule == 'threshold' and tolog is not None \
+            and tolog['train_error'] < args.stay_error and loop_state['rounds_on_template'] < args.max_stay_rounds
+        if record_memo and tolog is not None:
+            memo.save(template, label_set_size, trainer.label_set_scores.get_saved_scores(template.template_name),
+                      vtuning_model.tokenizer.convert_tokens_to_ids([trainer.verbalizer_list[-1][i] for i in range(num_classes)]),
+                      tolog['train_error'], tolog['train_acc'], tolog['valid_acc'])
+        if args.checkpoint_interval > 0 and (model_id + 1) % args.checkpoint_interval == 0:
+            save_checkpoint(checkpoint_path, model_id + 1, trainer, template_manager, weight_tensor, loop_state = loop_state,
+                            config = run_config)
+        if tolog is None:
             continue
-
-        alpha, weight_tensor = trainer.adaboost_step(train_error, wrong_flags, weight_tensor)
-        print(f"\talpha {alpha}")
-                
-        valid_acc, valid_preds, valid_logits = trainer.evaluate(word2idx, valid_probs, verbalizer, valid_labels)
-
-        trainer.save_prediction(train_preds, split = 'train')
-        trainer.save_prediction(valid_preds, split = 'valid')
-
-        train_ensemble_acc = trainer.ensemble_result(train_labels, split = 'train')
-        valid_ensemble_acc = trainer.ensemble_result(valid_labels, split = 'valid')
-
-        if valid_ensemble_acc >= trainer.best_ensemble_valid:
-            trainer.best_ensemble_valid = valid_ensemble_acc
-            trainer.best_epoch = len(trainer.model_weight_tensor)
-
-        trainer.save_weak_learner(verbalizer, template.template_name)
-
-        tolog = {
-            'train_error': train_error,
-            'alpha': alpha,
-            'train_acc': train_acc,
-            'valid_acc': valid_acc,
-            'ensemble_train_acc': train_ensemble_acc,
-            'ensemble_valid_acc': valid_ensemble_acc,
-        }
+        print(f"\tmodel {model_id + 1} finished")
         if use_wandb:
             wandb.log(tolog)
 
@@ -200,11 +432,19 @@ if __name__ == '__main__':
     valid_ensemble_acc = trainer.ensemble_result(valid_labels, split = 'valid', ensemble_num = trainer.best_epoch)
     
     all_template_used = template_manager.get_all_template()
-    test_ensemble_acc = trainer.final_eval(test_dataset, vtuning_model, all_template_used, test_pred_saver)
+    test_ensemble_acc = trainer.final_eval(test_dataset, vtuning_model, all_template_used, test_pred_saver, streaming = args.stream_test)
 
     print(f"best valid acc {valid_ensemble_acc}")
     print(f"best test acc {test_ensemble_acc}")
 
+    if args.save_ensemble != '':
+        save_ensemble(args.save_ensemble, trainer, train_dataset, valid_dataset, prediction_saver)
+
+    if args.prefix_curve:
+        for split, labels in [('train', train_labels), ('valid', valid_labels), ('test', test_labels)]:
+            curve = trainer.ensemble_curve(labels, split = split).tolist()
+            print(f"{split} accuracy by ensemble size: " + ", ".join([f"{i + 1}: {acc:.4f}" for i, acc in enumerate(curve)]))
+
     if use_wandb:
         to_log = {"best_valid": valid_ensemble_acc, "best_test":test_ensemble_acc}
         wandb.log(to_log)
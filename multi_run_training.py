@@ -0,0 +1,136 @@
+import numpy as np
+import torch
+
+import os
+import itertools
+
+from src.multicls_trainer import PromptBoostingTrainer
+from src.multi_run import MultiRunBooster, boost_runs, evaluate_runs
+from src.ptuning import RoBERTaVTuningClassification, OPTVTuningClassification
+from src.saver import PredictionSaver, TestPredictionSaver
+from src.template import TemplateManager
+from src.utils import ROOT_DIR, MODEL_CACHE_DIR
+from src.data_util import get_class_num, get_template_list_with_filter, load_dataset, get_task_type, get_template_list
+from src.planner import plan_storage, GB
+from src.prob_store import DEFAULT_TOPK
+from src.cache_backend import get_cache_backend
+
+import argparse
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--adaboost_lrs", type = float, nargs = '+', default = [1.0])
+parser.add_argument("--adaboost_weak_cls", type = int, default = 200)
+parser.add_argument("--dataset", type = str, default = 'sst')
+parser.add_argument("--model", type = str, default = 'roberta')
+parser.add_argument("--label_set_sizes", type = int, nargs = '+', default = [5])
+parser.add_argument("--max_template_num", type = int, default = 0)
+
+parser.add_argument("--pred_cache_dir", type = str, default = '')
+parser.add_argument("--use_logits", action = 'store_true')
+
+parser.add_argument("--use_part_templates", action = 'store_true')
+parser.add_argument("--start_idx", type = int, default = 0)
+parser.add_argument("--end_idx", type = int, default = 10)
+
+parser.add_argument("--sort_dataset", action = 'store_true')
+
+parser.add_argument("--fewshot", action = 'store_true')
+parser.add_argument("--low", action = 'store_true')
+parser.add_argument("--fewshot_k", type = int, default = 0)
+parser.add_argument("--fewshot_seeds", type = int, nargs = '+', default = [13, 21, 42, 87, 100])
+
+parser.add_argument("--filter_templates", action = 'store_true')
+
+parser.add_argument("--storage_mode", type = str, default = 'auto', choices = ['auto', 'dense', 'half', 'topk', 'mmap'])
+parser.add_argument("--store_topk", type = int, default = DEFAULT_TOPK)
+parser.add_argument("--store_layout", type = str, default = 'example', choices = ['example', 'token'])
+parser.add_argument("--cache_backend", type = str, default = '', help = "shared prediction cache: http://host:port of scripts/cache_server.py, or a shared directory")
+parser.add_argument("--memory_budget", type = float, default = 0, help = "GB, 0 for detecting from the device")
+parser.add_argument("--disk_budget", type = float, default = 0, help = "GB, 0 for detecting from the cache directory")
+parser.add_argument("--stream_test", action = 'store_true', help = "evaluate the test set chunk by chunk without caching its full distribution")
+
+args = parser.parse_args()
+
+## Train the ensembles of every (fewshot seed, label set size, adaboost lr) configuration in one process: the LM is loaded once,
+## and the runs of a seed share its training set, its template sequence and the cached predictions, and are boosted together
+## (see MultiRunBooster). The results of every run are reported as in ensemble_training.py.
+if __name__ == '__main__':
+    device = torch.device('cuda')
+    dataset = args.dataset
+    sentence_pair = get_task_type(dataset)
+    num_classes = get_class_num(dataset)
+    model = args.model
+    pred_cache_dir = args.pred_cache_dir
+    adaboost_weak_cls = args.adaboost_weak_cls
+    adaboost_maximum_epoch = 20000
+    fewshot = args.fewshot
+    low = args.low
+    fewshot_k = args.fewshot_k
+
+    assert not (fewshot and low), "fewshot and low resource can not be true!"
+
+    if model == 'roberta':
+        vtuning_model = RoBERTaVTuningClassification(model_type = 'roberta-large', cache_dir = os.path.join(MODEL_CACHE_DIR, 'roberta_model/roberta-large/'),
+                                                device = device, verbalizer_dict = None, sentence_pair = sentence_pair)
+    elif model == 'opt-6.7b':
+        vtuning_model = OPTVTuningClassification(model_type = 'facebook/opt-6.7b', cache_dir = os.path.join(MODEL_CACHE_DIR, 'opt_model/opt-6.7b/'),
+                                                device = device, verbalizer_dict = None, sentence_pair = sentence_pair)
+    else:
+        raise NotImplementedError
+
+    cache_backend = get_cache_backend(args.cache_backend)
+    configs = list(itertools.product(args.label_set_sizes, args.adaboost_lrs))
+    results = []
+    for fewshot_seed in args.fewshot_seeds:
+        train_dataset, valid_dataset, test_dataset = load_dataset(dataset_name = dataset, sort_dataset = args.sort_dataset, fewshot = fewshot, k = fewshot_k,
+                                                                  rand_seed = fewshot_seed, low_resource = low)
+        num_training = len(train_dataset[0])
+        train_labels = torch.LongTensor(train_dataset[1]).to(device)
+        valid_labels = torch.LongTensor(valid_dataset[1]).to(device)
+        test_labels = torch.LongTensor(test_dataset[1]).to(device)
+
+        if args.filter_templates:
+            template_dir_list = get_template_list_with_filter(dataset, fewshot = fewshot, low = low,  fewshot_seed = fewshot_seed,
+                                                              fewshot_k = fewshot_k,  topk = 10, return_source_dir = False)
+        else:
+            template_dir_list = get_template_list(dataset, model = args.model)
+        template_manager = TemplateManager(template_dir_list = template_dir_list, output_token = vtuning_model.tokenizer.mask_token, max_template_num = args.max_template_num,
+                                            use_part_templates = args.use_part_templates, start_idx = args.start_idx, end_idx = args.end_idx)
+
+        storage_plan = plan_storage(num_training, len(valid_dataset[0]), len(test_dataset[0]), vtuning_model.lm_model.config.vocab_size,
+                                    num_templates = len(template_manager.get_all_template()), num_weak_cls = adaboost_weak_cls * len(configs),
+                                    storage_mode = args.storage_mode, topk = args.store_topk, device = device,
+                                    cache_dir = os.path.join(ROOT_DIR, pred_cache_dir if pred_cache_dir != '' else 'cached_preds/'),
+                                    memory_budget = int(args.memory_budget * GB), disk_budget = int(args.disk_budget * GB),
+                                    stream_test = args.stream_test)
+
+        if pred_cache_dir != '':
+            prediction_saver = PredictionSaver(save_dir = os.path.join(ROOT_DIR, pred_cache_dir), model_name = model,
+                                                fewshot = fewshot, fewshot_k = fewshot_k, fewshot_seed = fewshot_seed,
+                                                low = low, storage_mode = storage_plan.mode, device = device, backend = cache_backend,
+                                                store_topk = storage_plan.topk, store_layout = args.store_layout,
+                                                )
+        else:
+            prediction_saver = PredictionSaver(model_name = model,
+                                                fewshot = fewshot, fewshot_k = fewshot_k, fewshot_seed = fewshot_seed,
+                                                storage_mode = storage_plan.mode, device = device, backend = cache_backend,
+                                                store_topk = storage_plan.topk, store_layout = args.store_layout,
+                                                )
+        test_pred_saver = TestPredictionSaver(save_dir = os.path.join(ROOT_DIR, f'cached_test_preds/{dataset}/'), model_name = model,
+                                              storage_mode = storage_plan.mode, device = device, backend = cache_backend,
+                                              store_topk = storage_plan.topk, store_layout = args.store_layout)
+
+        run_names = [f"seed{fewshot_seed}-label_set{label_set_size}-lr{adaboost_lr}" for label_set_size, adaboost_lr in configs]
+        trainers = [PromptBoostingTrainer(adaboost_lr = adaboost_lr, num_classes = num_classes, adaboost_maximum_epoch = adaboost_maximum_epoch,
+                                          use_logits = args.use_logits, storage_mode = storage_plan.mode, store_topk = storage_plan.topk,
+                                          store_layout = args.store_layout)
+                    for _, adaboost_lr in configs]
+        booster = MultiRunBooster(run_names, trainers, [label_set_size for label_set_size, _ in configs], num_training, device = device)
+
+        boost_runs(booster, template_manager, prediction_saver, vtuning_model, train_dataset, valid_dataset, train_labels, valid_labels,
+                   adaboost_weak_cls)
+        results += evaluate_runs(booster, template_manager, vtuning_model, valid_labels, test_dataset, test_pred_saver, streaming = args.stream_test)
+
+    print("run\tbest epoch\tbest valid acc\tbest test acc")
+    for run_name, best_epoch, valid_ensemble_acc, test_ensemble_acc in results:
+        print(f"{run_name}\t{best_epoch}\t{valid_ensemble_acc}\t{test_ensemble_acc}")
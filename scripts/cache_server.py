@@ -0,0 +1,119 @@
+import os, sys, inspect
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0, parentdir)
+
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import unquote
+import hmac
+import shutil
+
+from src.cache_backend import LocalCacheBackend, READ_BLOCK_SIZE, TOKEN_ENV, TOKEN_HEADER
+from src.utils import ROOT_DIR
+
+import argparse
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--host", type = str, default = '127.0.0.1', help = "0.0.0.0 to serve the other nodes (on a trusted network only)")
+parser.add_argument("--port", type = int, default = 8765)
+parser.add_argument("--root_dir", type = str, default = os.path.join(ROOT_DIR, 'shared_cache/'))
+parser.add_argument("--read_only", action = 'store_true', help = "serve the blobs under root_dir without accepting uploads")
+
+args = parser.parse_args()
+
+'''
+Shared blob store for the cached LM predictions. Run it on one machine:
+    PROMPTBOOSTING_CACHE_TOKEN=<secret> python scripts/cache_server.py --host 0.0.0.0 --port 8765
+and point the training scripts of every node to it with --cache_backend http://<host>:8765 and the same
+PROMPTBOOSTING_CACHE_TOKEN. The clients unpickle what they fetch, so whoever can upload a blob can run code on every
+node: every request must carry the token, and uploads are refused without one (--read_only serves the blobs only).
+'''
+
+class BlobHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    store = None
+    token = ''
+    read_only = False
+
+    def authorized(self):
+        if self.token == '':
+            return True
+        return hmac.compare_digest(self.headers.get(TOKEN_HEADER, ''), self.token)
+
+    def get_key(self):
+        if not self.path.startswith('/blob/'):
+            return None
+        key = unquote(self.path[len('/blob/'):])
+        if key == '' or '..' in key.split('/'):
+            return None
+        return key
+
+    def send_empty(self, status):
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_HEAD(self):
+        if not self.authorized():
+            self.send_empty(403)
+            return
+        key = self.get_key()
+        if key is None or not self.store.exists(key):
+            self.send_empty(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', str(os.path.getsize(self.store.get_path(key))))
+        self.end_headers()
+
+    def do_GET(self):
+        if not self.authorized():
+            self.send_empty(403)
+            return
+        key = self.get_key()
+        if key is None or not self.store.exists(key):
+            self.send_empty(404)
+            return
+        blob_path = self.store.get_path(key)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(os.path.getsize(blob_path)))
+        self.end_headers()
+        with open(blob_path, 'rb') as f:
+            shutil.copyfileobj(f, self.wfile, READ_BLOCK_SIZE)
+
+    def do_PUT(self):
+        if self.read_only or self.token == '' or not self.authorized():
+            self.close_connection = True    ## the body is not read
+            self.send_empty(403)
+            return
+        key = self.get_key()
+        if key is None:
+            self.send_empty(400)
+            return
+        remaining = int(self.headers['Content-Length'])
+        blob_path = self.store.get_path(key)
+        os.makedirs(os.path.dirname(blob_path), exist_ok = True)
+        tmp_path = blob_path + f".tmp{os.getpid()}_{self.client_address[1]}"
+        with open(tmp_path, 'wb') as f:
+            while remaining > 0:
+                block = self.rfile.read(min(READ_BLOCK_SIZE, remaining))
+                if not block:
+                    break
+                f.write(block)
+                remaining -= len(block)
+        if remaining > 0:
+            os.remove(tmp_path)
+            self.send_empty(400)
+            return
+        os.replace(tmp_path, blob_path)
+        self.send_empty(201)
+
+if __name__ == '__main__':
+    BlobHandler.store = LocalCacheBackend(args.root_dir)
+    BlobHandler.token = os.environ.get(TOKEN_ENV, '')
+    BlobHandler.read_only = args.read_only
+    if BlobHandler.token == '' and not args.read_only:
+        parser.error(f"set the shared token in the {TOKEN_ENV} environment variable (or use --read_only)")
+    server = ThreadingHTTPServer((args.host, args.port), BlobHandler)
+    print(f"serving cached predictions from {args.root_dir} on {args.host}:{args.port}")
+    server.serve_forever()
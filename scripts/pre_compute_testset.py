@@ -15,6 +15,9 @@ from src.saver import TestPredictionSaver
 from src.template import TemplateManager
 from src.utils import ROOT_DIR, MODEL_CACHE_DIR, BATCH_SIZE, create_logger
 from src.data_util import get_class_num, load_dataset, get_task_type, get_template_list
+from src.planner import plan_storage, GB
+from src.prob_store import DEFAULT_TOPK
+from src.cache_backend import get_cache_backend
 
 import argparse
 
@@ -33,6 +36,13 @@ parser.add_argument("--fewshot_k", type = int, default = 0)
 parser.add_argument("--fewshot_seed", type = int, default = 100, choices = [100, 13, 21, 42, 87])
 parser.add_argument("--filter_templates", action = 'store_true')
 
+parser.add_argument("--storage_mode", type = str, default = 'auto', choices = ['auto', 'dense', 'half', 'topk', 'mmap'])
+parser.add_argument("--store_topk", type = int, default = DEFAULT_TOPK)
+parser.add_argument("--store_layout", type = str, default = 'example', choices = ['example', 'token'])
+parser.add_argument("--cache_backend", type = str, default = '', help = "shared prediction cache: http://host:port of scripts/cache_server.py, or a shared directory")
+parser.add_argument("--memory_budget", type = float, default = 0, help = "GB, 0 for detecting from the device")
+parser.add_argument("--disk_budget", type = float, default = 0, help = "GB, 0 for detecting from the cache directory")
+
 args = parser.parse_args()
 
 
@@ -69,16 +79,25 @@ if __name__ == '__main__':
     dir_list = "\n\t".join(template_manager.template_dir_list)
     print(f"using templates from: {dir_list}",)
 
-    trainer = PromptBoostingTrainer(adaboost_lr = 1.0, num_classes = num_classes, adaboost_maximum_epoch = 100)
-
     save_dir = os.path.join(ROOT_DIR, f'cached_test_preds/{dataset}/')
-    prediction_saver = TestPredictionSaver(save_dir = os.path.join(ROOT_DIR, f'cached_test_preds/{dataset}/'), model_name = model)
+    all_templates = template_manager.get_all_template()
+    storage_plan = plan_storage(0, 0, num_test, vtuning_model.lm_model.config.vocab_size, num_templates = len(all_templates), num_weak_cls = 0,
+                                storage_mode = args.storage_mode, topk = args.store_topk, device = device, cache_dir = save_dir,
+                                memory_budget = int(args.memory_budget * GB), disk_budget = int(args.disk_budget * GB))
+
+    trainer = PromptBoostingTrainer(adaboost_lr = 1.0, num_classes = num_classes, adaboost_maximum_epoch = 100,
+                                    storage_mode = storage_plan.mode, store_topk = storage_plan.topk,
+                                    store_layout = args.store_layout)
+
+    cache_backend = get_cache_backend(args.cache_backend)
+    prediction_saver = TestPredictionSaver(save_dir = os.path.join(ROOT_DIR, f'cached_test_preds/{dataset}/'), model_name = model,
+                                           storage_mode = storage_plan.mode, device = device, backend = cache_backend,
+                                           store_topk = storage_plan.topk, store_layout = args.store_layout)
     
     word2idx = vtuning_model.tokenizer.get_vocab()
-    all_templates = template_manager.get_all_template()
     for template in all_templates:
         template.visualize()
-        test_probs = trainer.pre_compute_logits(vtuning_model, template, test_dataset)
+        test_probs = trainer.pre_compute_logits(vtuning_model, template, test_dataset, store_path = prediction_saver.get_store_prefix(template))
         prediction_saver.save_preds(template, test_probs)
 
     end_time = time.time()
@@ -12,7 +12,7 @@ import csv
 
 from src.multicls_trainer import PromptBoostingTrainer
 from src.ptuning import RoBERTaVTuningClassification
-from src.saver import PredictionSaver
+from src.saver import PredictionSaver, VerbalizerMemo
 from src.template import SentenceTemplate, TemplateManager
 from src.utils import ROOT_DIR, BATCH_SIZE, create_logger, MODEL_CACHE_DIR
 from src.data_util import get_class_num, load_dataset, get_task_type, get_full_template_list
@@ -33,6 +33,7 @@ parser.add_argument("--fewshot_k", type = int, default = 0)
 parser.add_argument("--low", action = 'store_true')
 parser.add_argument("--low_mode", type = str, choices = ['low-resource-16valid'])
 parser.add_argument("--fewshot_seed", type = int, default = 100, choices = [100, 13, 21, 42, 87])
+parser.add_argument("--verbalizer_memo", action = 'store_true', help = "reuse (and record) the weak learners fitted on the templates with uniform weights")
 
 args = parser.parse_args()
 
@@ -96,18 +97,33 @@ if __name__ == '__main__':
     trainer = PromptBoostingTrainer(adaboost_lr = 1.0, num_classes = num_classes, adaboost_maximum_epoch = adaboost_maximum_epoch)
     
     word2idx = vtuning_model.tokenizer.get_vocab()
+    memo = None
+    if args.verbalizer_memo:
+        memo = VerbalizerMemo(train_dataset, valid_dataset, model_name = model, search_config = trainer.memo_config())
     for template_id in tqdm.tqdm(range(eval_num)):
         template = template_manager.change_template()
         str_template = template.visualize()
         template_path = template.template_path
 
+        memo_entry = memo.load(template, label_set_size) if memo is not None else None
+        if memo_entry is not None:
+            trainer.replay_search_rng(label_set_size)
+            best_tokens = vtuning_model.tokenizer.convert_ids_to_tokens(memo_entry['verbalizer'])
+            verbalizer = {i:best_tokens[i] for i in range(num_classes)}
+            csv_writer.writerow([template_path, str_template, f"{verbalizer}", f"{memo_entry['train_acc']}", f"{memo_entry['valid_acc']}"])
+            continue
+
         train_probs = trainer.pre_compute_logits(vtuning_model, template, train_dataset,)
         valid_probs = trainer.pre_compute_logits(vtuning_model, template, valid_dataset,)
 
+        _, scores = trainer.get_label_set_scores(train_dataset, vtuning_model, train_probs, weight_tensor)
         verbalizer, train_error,train_acc, wrong_flags,train_preds = trainer.train(train_dataset, vtuning_model, train_probs, train_labels,
                                                                                 weight_tensor = weight_tensor,label_set_size = label_set_size,
-                                                                                )                
+                                                                                scores = scores)
         valid_acc, valid_preds, valid_logits = trainer.evaluate(word2idx, valid_probs, verbalizer, valid_labels)
+        if memo is not None:
+            memo.save(template, label_set_size, scores, [word2idx[verbalizer[i]] for i in range(num_classes)],
+                      train_error, train_acc, valid_acc)
 
         verbalizer = f"{verbalizer}"
         csv_writer.writerow([template_path, str_template, verbalizer, f"{train_acc}", f"{valid_acc}"])
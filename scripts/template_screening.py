@@ -0,0 +1,211 @@
+import os, sys, inspect
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0, parentdir)
+
+import numpy as np
+import pandas as pd
+import torch
+
+import tqdm
+import csv
+
+from src.multicls_trainer import PromptBoostingTrainer
+from src.ptuning import RoBERTaVTuningClassification
+from src.template import TemplateManager
+from src.utils import MODEL_CACHE_DIR
+from src.data_util import get_class_num, load_dataset, get_task_type, get_full_template_list
+
+
+import argparse
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--dataset", type = str, default = 'sst')
+parser.add_argument("--model", type = str, default = 'roberta')
+parser.add_argument("--label_set_size", type = int, default = 5)
+parser.add_argument("--eval_num", type = int, default = 100)
+parser.add_argument("--sort_dataset", action = 'store_true')
+
+parser.add_argument("--fewshot", action = 'store_true')
+parser.add_argument("--fewshot_k", type = int, default = 0)
+parser.add_argument("--low", action = 'store_true')
+parser.add_argument("--fewshot_seed", type = int, default = 100, choices = [100, 13, 21, 42, 87])
+
+parser.add_argument("--initial_size", type = int, default = 32, help = "number of train (and valid) examples of the first round")
+parser.add_argument("--num_finalists", type = int, default = 10, help = "number of templates evaluated on the full train/valid sets")
+parser.add_argument("--proxy_model", type = str, default = '', help = "a small masked LM (e.g. distilroberta-base) to pre-screen the templates")
+parser.add_argument("--proxy_keep", type = int, default = 30, help = "number of templates passed from the proxy model to the large model")
+parser.add_argument("--proxy_correlation", action = 'store_true',
+                    help = "evaluate every template with the large model on the full train/valid sets to report the rank correlation of the two models")
+
+args = parser.parse_args()
+
+def subset(dataset, example_ids):
+    sentence_list, label_list = dataset
+    return [sentence_list[x] for x in example_ids], [label_list[x] for x in example_ids]
+
+def extend_probs(trainer, vtuning_model, template, dataset, example_ids, prev_probs):
+    '''
+    the predictions of the examples example_ids, of which the first len(prev_probs) are already computed
+    '''
+    num_prev = 0 if prev_probs is None else prev_probs.size(0)
+    curr_dataset = subset(dataset, example_ids)
+    if num_prev == 0:
+        return trainer.pre_compute_logits(vtuning_model, template, curr_dataset).cpu()
+    if num_prev == len(example_ids):
+        return prev_probs
+    base_ids = list(range(num_prev)) + [-1] * (len(example_ids) - num_prev)
+    return trainer.extend_logits(vtuning_model, template, curr_dataset, prev_probs, base_ids).cpu()
+
+def rank_correlation(x, y):
+    '''
+    Spearman rank correlation (ties get their average rank)
+    '''
+    x_ranks = pd.Series(x).rank().to_numpy()
+    y_ranks = pd.Series(y).rank().to_numpy()
+    if np.std(x_ranks) == 0 or np.std(y_ranks) == 0:
+        return 0.0
+    return float(np.corrcoef(x_ranks, y_ranks)[0, 1])
+
+def evaluate_template(trainer, vtuning_model, word2idx, train_probs, valid_probs, train_dataset, valid_dataset):
+    '''
+    accuracy of the best weak learner of the template (uniform dataset weights) on the given train/valid subsets
+    '''
+    device = vtuning_model.device
+    train_labels = torch.LongTensor(train_dataset[1]).to(device)
+    valid_labels = torch.LongTensor(valid_dataset[1]).to(device)
+    weight_tensor = torch.ones(len(train_labels), dtype = torch.float32).to(device) / len(train_labels)
+    verbalizer, train_error, train_acc, wrong_flags, train_preds = trainer.train(train_dataset, vtuning_model, train_probs.to(device), train_labels,
+                                                                                weight_tensor = weight_tensor, label_set_size = args.label_set_size)
+    if verbalizer is None:
+        return None, 0, 0
+    valid_acc, valid_preds, valid_logits = trainer.evaluate(word2idx, valid_probs.to(device), verbalizer, valid_labels, visualize = False)
+    return verbalizer, train_acc, valid_acc
+
+## Successive halving: every template is evaluated on small train/valid subsets, the better half (by the valid accuracy of its
+## best weak learner, as in get_template_list_with_filter) is kept, the subsets are doubled, and so on until num_finalists
+## templates remain. The subsets are growing prefixes of a fixed random order, so the predictions of a template are extended
+## with the new examples only, and the full train/valid passes are only made for the finalists. The finalists are written to
+## the csv file read by get_template_list_with_filter (same format as scripts/template_refinement.py).
+## With --proxy_model, the templates are first ranked by a small masked LM on the full sets and only the best proxy_keep are
+## screened with the large model. The rank correlation of the valid accuracies of the two models on the full sets is reported
+## for the finalists, or for every template with --proxy_correlation (which costs a full evaluation of every template).
+if __name__ == '__main__':
+    device = torch.device('cuda')
+    dataset = args.dataset
+    sentence_pair = get_task_type(dataset)
+    num_classes = get_class_num(dataset)
+    model = args.model
+    sort_dataset = args.sort_dataset
+    eval_num = args.eval_num
+
+    adaboost_maximum_epoch = 20000
+
+    fewshot = args.fewshot
+    low = args.low
+    fewshot_k = args.fewshot_k
+    fewshot_seed = args.fewshot_seed
+    assert sort_dataset
+
+    wandb_name = f"{model}-{dataset}"
+    if fewshot:
+        wandb_name += f"-{fewshot_k}shot-seed{fewshot_seed}"
+    elif low:
+        wandb_name += f"-low{fewshot_k}-seed{fewshot_seed}"
+    else:
+        raise NotImplementedError
+
+    train_dataset, valid_dataset, test_dataset = load_dataset(dataset_name = dataset, sort_dataset = sort_dataset, fewshot = fewshot, k = fewshot_k, rand_seed = fewshot_seed,
+                                                            low_resource = low)
+    num_training = len(train_dataset[0])
+    num_valid = len(valid_dataset[0])
+    rng = np.random.RandomState(fewshot_seed)
+    train_order = rng.permutation(num_training).tolist()
+    valid_order = rng.permutation(num_valid).tolist()
+
+    vtuning_model = RoBERTaVTuningClassification(model_type = 'roberta-large', cache_dir = MODEL_CACHE_DIR + 'roberta_model/roberta-large/',
+                                            device = device, verbalizer_dict = None, sentence_pair = sentence_pair)
+    template_dir_list = get_full_template_list(dataset)
+    template_manager = TemplateManager(template_dir_list = template_dir_list, output_token = vtuning_model.tokenizer.mask_token, max_template_num = eval_num,
+                                        rand_order = False)
+    templates = template_manager.get_all_template()
+
+    trainer = PromptBoostingTrainer(adaboost_lr = 1.0, num_classes = num_classes, adaboost_maximum_epoch = adaboost_maximum_epoch)
+    word2idx = vtuning_model.tokenizer.get_vocab()
+
+    survivors = list(range(len(templates)))
+    proxy_results = None
+    if args.proxy_model != '':
+        ## pre-screening with the proxy model on the full train/valid sets: only the best proxy_keep templates go to the large model
+        proxy_model = RoBERTaVTuningClassification(model_type = args.proxy_model, cache_dir = MODEL_CACHE_DIR + f'roberta_model/{args.proxy_model}/',
+                                                   device = device, verbalizer_dict = None, sentence_pair = sentence_pair)
+        proxy_word2idx = proxy_model.tokenizer.get_vocab()
+        proxy_results = {}
+        for template_id in tqdm.tqdm(survivors):
+            proxy_train_probs = trainer.pre_compute_logits(proxy_model, templates[template_id], train_dataset)
+            proxy_valid_probs = trainer.pre_compute_logits(proxy_model, templates[template_id], valid_dataset)
+            proxy_results[template_id] = evaluate_template(trainer, proxy_model, proxy_word2idx, proxy_train_probs, proxy_valid_probs,
+                                                           train_dataset, valid_dataset)
+            del proxy_train_probs
+            del proxy_valid_probs
+        survivors = sorted(survivors, key = lambda x: (-proxy_results[x][2], -proxy_results[x][1]))[:args.proxy_keep]
+        print(f"{args.proxy_model} kept {len(survivors)} of {len(templates)} templates")
+        del proxy_model
+        torch.cuda.empty_cache()
+
+    train_probs = {x: None for x in survivors}
+    valid_probs = {x: None for x in survivors}
+    subset_size = args.initial_size
+    while True:
+        final = len(survivors) <= args.num_finalists or (subset_size >= num_training and subset_size >= num_valid)
+        train_ids = train_order if final else train_order[:subset_size]
+        valid_ids = valid_order if final else valid_order[:subset_size]
+        print(f"evaluating {len(survivors)} templates on {len(train_ids)} train / {len(valid_ids)} valid examples")
+        results = {}
+        for template_id in tqdm.tqdm(survivors):
+            template = templates[template_id]
+            train_probs[template_id] = extend_probs(trainer, vtuning_model, template, train_dataset, train_ids, train_probs[template_id])
+            valid_probs[template_id] = extend_probs(trainer, vtuning_model, template, valid_dataset, valid_ids, valid_probs[template_id])
+            results[template_id] = evaluate_template(trainer, vtuning_model, word2idx, train_probs[template_id], valid_probs[template_id],
+                                                     subset(train_dataset, train_ids), subset(valid_dataset, valid_ids))
+        if final:
+            break
+        ranked = sorted(survivors, key = lambda x: (-results[x][2], -results[x][1]))
+        survivors = ranked[:max(args.num_finalists, len(ranked) // 2)]
+        for template_id in ranked[len(survivors):]:
+            print(f"dropped {templates[template_id].template_path}: train acc {results[template_id][1]}, valid acc {results[template_id][2]}")
+            del train_probs[template_id]
+            del valid_probs[template_id]
+        subset_size *= 2
+
+    if proxy_results is not None:
+        ## the accuracies of both models on the full train/valid sets: of the finalists only, or of every template with
+        ## --proxy_correlation (the finalists are the best templates of both models, so their correlation is biased)
+        full_results = {x: results[x] for x in survivors}
+        if args.proxy_correlation:
+            for template_id in tqdm.tqdm(range(len(templates))):
+                if template_id in full_results:
+                    continue
+                full_train_probs = trainer.pre_compute_logits(vtuning_model, templates[template_id], train_dataset)
+                full_valid_probs = trainer.pre_compute_logits(vtuning_model, templates[template_id], valid_dataset)
+                full_results[template_id] = evaluate_template(trainer, vtuning_model, word2idx, full_train_probs, full_valid_probs,
+                                                              train_dataset, valid_dataset)
+                del full_train_probs
+                del full_valid_probs
+        template_ids = sorted(full_results.keys())
+        correlation = rank_correlation([proxy_results[x][2] for x in template_ids], [full_results[x][2] for x in template_ids])
+        print(f"rank correlation of the full valid accuracies of {args.proxy_model} and {model} "
+              f"({len(template_ids)} {'templates' if args.proxy_correlation else 'finalists'}): {correlation}")
+
+    save_dir = f"stat_data_file/{dataset}"
+    if not os.path.exists(save_dir):
+        os.makedirs(save_dir)
+    f = open(f"stat_data_file/{dataset}/{wandb_name}.csv", 'w', encoding = 'utf-8')
+    csv_writer = csv.writer(f)
+    csv_writer.writerow(['name', 'template', 'verbalizer', 'train_acc', 'valid_acc'])
+    for template_id in survivors:
+        template = templates[template_id]
+        verbalizer, train_acc, valid_acc = results[template_id]
+        csv_writer.writerow([template.template_path, template.visualize(), f"{verbalizer}", f"{train_acc}", f"{valid_acc}"])
+    f.close()
@@ -0,0 +1,155 @@
+import os
+import shutil
+import queue
+import http.client
+from urllib.parse import urlparse, quote
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+
+READ_BLOCK_SIZE = 1 << 20
+## the shared secret of the blob server: sent by the clients in TOKEN_HEADER, read from this environment variable
+TOKEN_ENV = 'PROMPTBOOSTING_CACHE_TOKEN'
+TOKEN_HEADER = 'X-Cache-Token'
+
+class CacheBackend():
+    '''
+    CacheBackend: a shared store of cached LM predictions addressed by cache key (e.g. "preds/cached_preds/<template>_fs_16shot_seed13.pkl").
+    PredictionSaver/TestPredictionSaver keep writing and reading the local files under their save_dir, and use the backend
+    to publish what they computed and to fetch what other nodes computed, so a template's forward passes are made once
+    for the whole cluster.
+    '''
+    def exists(self, key: str) -> bool:
+        raise NotImplementedError
+
+    def put_file(self, key: str, path: str):
+        raise NotImplementedError
+
+    def fetch_to_file(self, key: str, path: str) -> bool:
+        '''
+        download the blob of key to path. return False if the key is not in the store.
+        '''
+        raise NotImplementedError
+
+    def fetch_many(self, key_to_path: Dict[str, str]) -> List[str]:
+        '''
+        bulk fetch: download all the available keys. return the keys that were found.
+        '''
+        return [key for key, path in key_to_path.items() if self.fetch_to_file(key, path)]
+
+class LocalCacheBackend(CacheBackend):
+    '''
+    blobs are files under root_dir, e.g. a directory on a file system shared by the nodes
+    '''
+    def __init__(self, root_dir):
+        self.root_dir = root_dir
+        os.makedirs(self.root_dir, exist_ok = True)
+
+    def get_path(self, key):
+        return os.path.join(self.root_dir, *key.split('/'))
+
+    def exists(self, key):
+        return os.path.exists(self.get_path(key))
+
+    def put_file(self, key, path):
+        blob_path = self.get_path(key)
+        os.makedirs(os.path.dirname(blob_path), exist_ok = True)
+        tmp_path = blob_path + f".tmp{os.getpid()}"
+        shutil.copyfile(path, tmp_path)
+        os.replace(tmp_path, blob_path)
+
+    def fetch_to_file(self, key, path):
+        if not self.exists(key):
+            return False
+        tmp_path = path + f".tmp{os.getpid()}"
+        shutil.copyfile(self.get_path(key), tmp_path)
+        os.replace(tmp_path, path)
+        return True
+
+class HTTPCacheBackend(CacheBackend):
+    '''
+    client of the blob server in scripts/cache_server.py. Keep-alive connections are pooled (pool_size), and bulk fetches
+    download the keys concurrently over the pool. Every request carries the shared token of the server (token, by default
+    the TOKEN_ENV environment variable).
+    '''
+    def __init__(self, url, pool_size = 8, timeout = 600, token = None):
+        parsed = urlparse(url)
+        self.host = parsed.hostname
+        self.port = parsed.port or 80
+        self.base_path = parsed.path.rstrip('/')
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.token = token if token is not None else os.environ.get(TOKEN_ENV, '')
+        self.pool = queue.LifoQueue()
+        for _ in range(self.pool_size):
+            self.pool.put(None)
+
+    def get_url(self, key):
+        return f"{self.base_path}/blob/{quote(key)}"
+
+    def request(self, method, key, body = None, headers = {}, output_path = None):
+        '''
+        return (status, payload). The payload is streamed to output_path when given.
+        The pooled connection is re-created once if the server closed it or the request failed (e.g. timed out).
+        '''
+        headers = dict(headers)
+        if self.token != '':
+            headers[TOKEN_HEADER] = self.token
+        conn = self.pool.get()
+        try:
+            for attempt in range(2):
+                if conn is None:
+                    conn = http.client.HTTPConnection(self.host, self.port, timeout = self.timeout)
+                try:
+                    if hasattr(body, 'seek'):
+                        body.seek(0)
+                    conn.request(method, self.get_url(key), body = body, headers = headers)
+                    response = conn.getresponse()
+                    if output_path is not None and response.status == 200:
+                        tmp_path = output_path + f".tmp{os.getpid()}"
+                        with open(tmp_path, 'wb') as f:
+                            while True:
+                                block = response.read(READ_BLOCK_SIZE)
+                                if not block:
+                                    break
+                                f.write(block)
+                        os.replace(tmp_path, output_path)
+                        return response.status, None
+                    return response.status, response.read()
+                except (http.client.HTTPException, OSError):
+                    conn.close()
+                    conn = None
+                    if attempt == 1:
+                        raise
+        finally:
+            self.pool.put(conn)
+
+    def exists(self, key):
+        status, _ = self.request('HEAD', key)
+        return status == 200
+
+    def put_file(self, key, path):
+        with open(path, 'rb') as f:
+            status, payload = self.request('PUT', key, body = f, headers = {'Content-Length': str(os.path.getsize(path))})
+        assert status in [200, 201], f"failed to upload {key}: {status} {payload}"
+
+    def fetch_to_file(self, key, path):
+        status, _ = self.request('GET', key, output_path = path)
+        return status == 200
+
+    def fetch_many(self, key_to_path):
+        keys = list(key_to_path.keys())
+        with ThreadPoolExecutor(max_workers = self.pool_size) as executor:
+            found = list(executor.map(lambda key: self.fetch_to_file(key, key_to_path[key]), keys))
+        return [key for key, flag in zip(keys, found) if flag]
+
+def get_cache_backend(spec = '', pool_size = 8):
+    '''
+    spec: '' (no shared cache), the http url of a blob server (scripts/cache_server.py), or a directory
+    '''
+    if spec == '':
+        return None
+    if spec.startswith('http://'):
+        return HTTPCacheBackend(spec, pool_size = pool_size)
+    elif spec.startswith('https://'):
+        raise NotImplementedError("use the blob server behind a plain http endpoint")
+    return LocalCacheBackend(spec)
@@ -0,0 +1,105 @@
+import numpy as np
+import os
+import random
+import torch
+
+from src.template import TemplateManager
+
+
+def get_rng_state():
+    state = {'numpy': np.random.get_state(), 'random': random.getstate(), 'torch': torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+def set_rng_state(state):
+    np.random.set_state(state['numpy'])
+    random.setstate(state['random'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+def save_checkpoint(path, next_round, trainer, template_manager: TemplateManager, weight_tensor: torch.FloatTensor, loop_state = None,
+                    config = None):
+    '''
+    save the boosting state after a round: the trainer (see BaseMuticlsTrainer.state_dict), the position in the template
+    sequence, the dataset weights and the RNG states. The caches that are rebuilt on demand (e.g. the incremental label set
+    scores) are not saved; they are dropped from the trainer as well (reset_caches), so the run continues exactly as a run
+    resumed from this checkpoint would. The file is written next to the previous checkpoint and moved over it, so a job
+    preempted while saving keeps the previous one.
+    next_round: the index of the first round that is not done yet
+    loop_state: other variables of the training loop (a dict), returned by load_checkpoint
+    config:     the settings of the run (a dict), checked by load_checkpoint
+    '''
+    state = {
+        'next_round': next_round,
+        'trainer': trainer.state_dict(),
+        'template_manager': template_manager.state_dict(),
+        'weight_tensor': weight_tensor.cpu(),
+        'rng': get_rng_state(),
+        'loop_state': loop_state if loop_state is not None else {},
+        'config': config if config is not None else {},
+    }
+    trainer.reset_caches()
+    save_dir = os.path.dirname(path)
+    if save_dir != '' and not os.path.exists(save_dir):
+        os.makedirs(save_dir)
+    torch.save(state, path + '.tmp')
+    os.replace(path + '.tmp', path)
+
+def load_checkpoint(path, trainer, template_manager: TemplateManager, device = torch.device('cuda'), config = None):
+    '''
+    restore the state saved by save_checkpoint, after the trainer and the template manager are built as in the original run.
+    config: the settings of the current run, which must be the same as the ones of the checkpoint
+    return: the index of the next round, the dataset weights and the loop state, or (0, None, {}) if there is no checkpoint
+    '''
+    if not os.path.exists(path):
+        return 0, None, {}
+    state = torch.load(path, map_location = 'cpu')
+    if config is not None:
+        saved_config = state.get('config', {})
+        mismatch = [f"{key}: {saved_config.get(key)} (checkpoint) vs {config.get(key)}" for key in sorted(set(saved_config) | set(config))
+                    if saved_config.get(key) != config.get(key)]
+        if len(mismatch) > 0:
+            raise ValueError(f"the checkpoint {path} was saved with other settings:\n\t" + "\n\t".join(mismatch))
+    trainer.load_state_dict(state['trainer'], device)
+    template_manager.load_state_dict(state['template_manager'])
+    set_rng_state(state['rng'])
+    print(f"resuming from {path} at round {state['next_round']}")
+    return state['next_round'], state['weight_tensor'].to(device), state['loop_state']
+
+def example_key(example):
+    '''
+    a hashable key of an example of a dataset (a sentence, or a list of sentences for sentence pair tasks)
+    '''
+    return tuple(example) if isinstance(example, list) else example
+
+def get_base_ids(dataset, base_examples):
+    '''
+    the position of every example of the dataset in base_examples (a list of example keys), -1 for the new examples
+    '''
+    base_index = {key: i for i, key in enumerate(base_examples)}
+    return [base_index.get(example_key(example), -1) for example in dataset[0]]
+
+def save_ensemble(path, trainer, train_dataset, valid_dataset, prediction_saver):
+    '''
+    save the weak learners of the trainer (verbalizers, templates and alphas) to warm start another run from them, with
+    the examples they were fitted on and the location of the cached predictions of these examples
+    '''
+    state = {
+        'verbalizer_list': trainer.verbalizer_list,
+        'template_name_list': trainer.template_name_list,
+        'alphas': [float(alpha) for alpha in trainer.model_weight_tensor],
+        'train_examples': [example_key(example) for example in train_dataset[0]],
+        'valid_examples': [example_key(example) for example in valid_dataset[0]],
+        'cache': {'save_dir': prediction_saver.save_dir, 'model_name': prediction_saver.model_name, 'fewshot': prediction_saver.fewshot,
+                  'low': prediction_saver.low, 'fewshot_k': prediction_saver.fewshot_k, 'fewshot_seed': prediction_saver.fewshot_seed},
+    }
+    save_dir = os.path.dirname(path)
+    if save_dir != '' and not os.path.exists(save_dir):
+        os.makedirs(save_dir)
+    torch.save(state, path)
+
+def load_ensemble(path):
+    return torch.load(path, map_location = 'cpu')
+
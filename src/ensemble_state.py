@@ -0,0 +1,154 @@
+import torch
+
+INITIAL_CAPACITY = 64
+PREFIX_BLOCK_ELEMENTS = 1 << 26
+
+def one_hot_votes(pred_labels: torch.Tensor, alphas: torch.FloatTensor, num_classes: int):
+    '''
+    weighted vote of the weak learners: num_examples * num_classes, the sum of alpha * one_hot(prediction)
+    pred_labels: num_weak_learner * num_examples, negative predictions (no prediction) do not vote
+    '''
+    num_models, num_examples = pred_labels.size()
+    votes = torch.zeros([num_examples, num_classes], dtype = torch.float32, device = pred_labels.device)
+    if num_models == 0:
+        return votes
+    pred_labels = pred_labels.long().t()
+    weights = (alphas.float().view(1, -1) * (pred_labels >= 0).float())
+    votes.scatter_add_(1, pred_labels.clamp(min = 0), weights)
+    return votes
+
+def prefix_accuracies(pred_labels: torch.Tensor, alphas: torch.FloatTensor, labels: torch.LongTensor, num_classes: int,
+                      block_size = None):
+    '''
+    accuracy of every prefix of the ensemble (the first 1..num_weak_learner weak learners) in one pass: the one-hot votes are
+    accumulated over the weak learners with a cumulative sum, block of examples by block of examples.
+    pred_labels: num_weak_learner * num_examples
+    return: num_weak_learner float tensor
+    '''
+    num_models, num_examples = pred_labels.size()
+    device = pred_labels.device
+    correct = torch.zeros(num_models, dtype = torch.float32, device = device)
+    if num_models == 0 or num_examples == 0:
+        return correct
+    if block_size is None:
+        block_size = max(1, PREFIX_BLOCK_ELEMENTS // (num_models * num_classes))
+    labels = labels.to(device)
+    alphas = alphas.float().to(device).view(-1, 1, 1)
+    for start in range(0, num_examples, block_size):
+        block_preds = pred_labels[:, start: start + block_size].long()      ## num_weak_learner, block
+        weights = alphas * (block_preds >= 0).float().unsqueeze(-1)
+        votes = torch.zeros([num_models, block_preds.size(1), num_classes], dtype = torch.float32, device = device)
+        votes.scatter_(2, block_preds.clamp(min = 0).unsqueeze(-1), weights)
+        prefix_preds = torch.argmax(torch.cumsum(votes, dim = 0), dim = -1)
+        correct += torch.sum(prefix_preds == labels[start: start + block_size].view(1, -1), dim = 1).float()
+    return correct / num_examples
+
+class EnsembleState():
+    '''
+    The predictions of the weak learners on one split and the running weighted vote of the ensemble.
+    The predictions are kept in a preallocated int8 buffer (model capacity * num_examples, doubled when full) and the vote
+    (num_examples * num_classes) is updated in O(num_examples) per weak learner, so a run scales linearly with the number
+    of weak learners. The vote of a prefix of the ensemble (ensemble_num) is rebuilt from the stored predictions, from the
+    head or by removing the tail from the running vote, whichever is shorter.
+    '''
+    def __init__(self, num_classes):
+        self.num_classes = num_classes
+        self.num_models = 0
+        self.pred_labels = None
+        self.alphas = None
+        self.votes = None
+
+    def __len__(self):
+        return self.num_models
+
+    def reserve(self, num_models, num_examples, device):
+        if self.pred_labels is None:
+            capacity = max(INITIAL_CAPACITY, num_models)
+            self.pred_labels = torch.zeros([capacity, num_examples], dtype = torch.int8, device = device)
+            self.alphas = torch.zeros(capacity, dtype = torch.float32, device = device)
+            self.votes = torch.zeros([num_examples, self.num_classes], dtype = torch.float32, device = device)
+        elif num_models > self.pred_labels.size(0):
+            capacity = max(2 * self.pred_labels.size(0), num_models)
+            pred_labels = torch.zeros([capacity, num_examples], dtype = torch.int8, device = device)
+            pred_labels[:self.num_models] = self.pred_labels[:self.num_models]
+            alphas = torch.zeros(capacity, dtype = torch.float32, device = device)
+            alphas[:self.num_models] = self.alphas[:self.num_models]
+            self.pred_labels, self.alphas = pred_labels, alphas
+
+    def add(self, pred_labels: torch.Tensor, alpha):
+        '''
+        alpha: a python float or a tensor on the device
+        '''
+        self.reserve(self.num_models + 1, pred_labels.size(0), pred_labels.device)
+        self.pred_labels[self.num_models] = pred_labels.to(torch.int8)
+        self.alphas[self.num_models] = alpha
+        self.votes += one_hot_votes(self.pred_labels[self.num_models: self.num_models + 1], self.alphas[self.num_models: self.num_models + 1],
+                                    self.num_classes)
+        self.num_models += 1
+
+    def pop(self):
+        self.num_models -= 1
+        self.votes -= one_hot_votes(self.pred_labels[self.num_models: self.num_models + 1], self.alphas[self.num_models: self.num_models + 1],
+                                    self.num_classes)
+
+    def set_predictions(self, pred_labels_by_model: torch.Tensor, alphas: torch.FloatTensor):
+        '''
+        replace the weak learners, e.g. the predictions on the test set computed template by template
+        '''
+        self.num_models = 0
+        self.pred_labels = None
+        self.reserve(pred_labels_by_model.size(0), pred_labels_by_model.size(1), pred_labels_by_model.device)
+        self.num_models = pred_labels_by_model.size(0)
+        self.pred_labels[:self.num_models] = pred_labels_by_model.to(torch.int8)
+        self.alphas[:self.num_models] = alphas.to(self.alphas.device)
+        self.votes = one_hot_votes(self.pred_labels[:self.num_models], self.alphas[:self.num_models], self.num_classes)
+
+    def get_predictions(self, ensemble_num = 0):
+        '''
+        num_weak_learner * num_examples int8 predictions of the first ensemble_num weak learners (all if ensemble_num <= 0)
+        '''
+        if self.pred_labels is None:
+            return torch.zeros([0, 0], dtype = torch.int8)
+        if ensemble_num <= 0 or ensemble_num > self.num_models:
+            ensemble_num = self.num_models
+        return self.pred_labels[:ensemble_num]
+
+    def get_alphas(self, ensemble_num = 0):
+        if self.alphas is None:
+            return torch.zeros(0)
+        if ensemble_num <= 0 or ensemble_num > self.num_models:
+            ensemble_num = self.num_models
+        return self.alphas[:ensemble_num]
+
+    def get_votes(self, ensemble_num = 0):
+        if ensemble_num <= 0 or ensemble_num >= self.num_models:
+            return self.votes
+        if ensemble_num <= self.num_models - ensemble_num:
+            return one_hot_votes(self.pred_labels[:ensemble_num], self.alphas[:ensemble_num], self.num_classes)
+        return self.votes - one_hot_votes(self.pred_labels[ensemble_num: self.num_models], self.alphas[ensemble_num: self.num_models],
+                                          self.num_classes)
+
+    def predict(self, ensemble_num = 0):
+        return torch.argmax(self.get_votes(ensemble_num), dim = 1)
+
+    def prefix_accuracies(self, labels: torch.LongTensor):
+        return prefix_accuracies(self.get_predictions(), self.get_alphas(), labels, self.num_classes)
+
+    def state_dict(self):
+        if self.pred_labels is None:
+            return {'pred_labels': None}
+        return {'pred_labels': self.get_predictions().cpu(), 'alphas': self.get_alphas().cpu(), 'votes': self.votes.cpu()}
+
+    def load_state_dict(self, state, device):
+        '''
+        the running vote is restored as saved rather than rebuilt, so the predictions are the same bit for bit
+        '''
+        self.num_models = 0
+        self.pred_labels, self.alphas, self.votes = None, None, None
+        if state['pred_labels'] is None:
+            return
+        self.reserve(state['pred_labels'].size(0), state['pred_labels'].size(1), device)
+        self.num_models = state['pred_labels'].size(0)
+        self.pred_labels[:self.num_models] = state['pred_labels'].to(device)
+        self.alphas[:self.num_models] = state['alphas'].to(device)
+        self.votes = state['votes'].to(device)
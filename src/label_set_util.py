@@ -2,40 +2,157 @@ import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from collections import OrderedDict
 
 from src.ptuning import BaseModel, RoBERTaVTuningClassification
 from src.template import SentenceTemplate
+from src.prob_store import as_prob_store, CHUNK_SIZE
 
 
+CLASS_SIGN_CACHE_SIZE = 8
+_class_sign_cache = OrderedDict()
+
+def get_class_sign_matrix(label_list, num_classes, norm_class = False, device = torch.device('cuda')):
+    '''
+    num_classes * num_examples matrix: 1 for the examples of the class, -1 (or -1/(num_classes - 1) with norm_class) for the others.
+    It only depends on the labels, so it is cached across boosting rounds, keyed by the labels themselves. Only the
+    CLASS_SIGN_CACHE_SIZE most recently used matrices are kept (e.g. the subsets of scripts/template_screening.py).
+    '''
+    labels = tuple(label_list.tolist() if torch.is_tensor(label_list) else label_list)
+    key = (labels, num_classes, norm_class, str(device))
+    if key in _class_sign_cache:
+        _class_sign_cache.move_to_end(key)
+        return _class_sign_cache[key]
+    batch_labels = torch.LongTensor(labels).to(device)
+    class_mask = batch_labels.view(1, -1) == torch.arange(num_classes, device = device).view(-1, 1)
+    negative = -1/(num_classes - 1) if norm_class else -1.0
+    sign_matrix = torch.full(class_mask.size(), negative, device = device)
+    sign_matrix[class_mask] = 1.0
+    _class_sign_cache[key] = sign_matrix
+    while len(_class_sign_cache) > CLASS_SIGN_CACHE_SIZE:
+        _class_sign_cache.popitem(last = False)
+    return sign_matrix
+
 def generate_multicls_l1_label_set_with_cache(train_dataset, vtuning_model: RoBERTaVTuningClassification,
                                             weight_list = [], cache_probs = None, label_set_size = 0, num_classes = 3,
-                                            norm_class = False):
-
+                                            norm_class = False, weight_tensor = None):
+    '''
+    score of every token for every class: sum over the examples of weight * sign * prob, the sign being +1 for the examples of the
+    class and negative for the others. All the classes are scored at once as (num_classes * N) x (N * vocab_size) products over
+    the chunks of the cached probabilities, so the intermediate memory is num_classes * vocab_size.
+    weight_tensor: the dataset weights (N) on the device; weight_list is the same as a python list
+    '''
+    cache_probs = as_prob_store(cache_probs)
+    device = vtuning_model.device
     vocab_size = cache_probs.size(1)
-    label_indicator = torch.zeros(num_classes, vocab_size).float().to(vtuning_model.device)
     sentence_list, label_list = train_dataset
-    if weight_list == []:
-        weight_list = torch.ones(len(sentence_list)).float().to(vtuning_model.device)
+    if weight_tensor is None and len(weight_list) > 0:
+        weight_tensor = torch.FloatTensor(weight_list)
+    if weight_tensor is None:
+        batch_weights = torch.ones(len(sentence_list)).float().to(device)
     else:
-        weight_list = torch.FloatTensor(weight_list).to(vtuning_model.device) * len(sentence_list)
-        assert len(weight_list) == len(sentence_list)
-
-    batch_labels = torch.LongTensor(label_list).to(vtuning_model.device)
-    batch_weights = weight_list.view(-1, 1)
-
-    for i in range(num_classes):
-        label_mask = batch_labels == i
-        label_multiplier = torch.zeros_like(batch_labels).float()
-        if not norm_class:
-            label_multiplier.fill_(-1.0)
-        else:
-            label_multiplier.fill_(-1/(num_classes - 1))
-        label_multiplier[label_mask] = 1.0
-        label_multiplier = label_multiplier.view(-1,1)
-        balanced_score_tensor = cache_probs * label_multiplier
-        balanced_score_tensor = balanced_score_tensor * batch_weights
-        label_indicator[i,:] = torch.sum(balanced_score_tensor, dim = 0)          
+        assert len(weight_tensor) == len(sentence_list)
+        batch_weights = weight_tensor.float().to(device) * len(sentence_list)
+
+    weighted_signs = get_class_sign_matrix(label_list, num_classes, norm_class, device) * batch_weights.view(1, -1)
+    label_indicator = torch.zeros(num_classes, vocab_size).float().to(device)
+    for start, chunk_probs in cache_probs.iter_chunks():
+        end = start + chunk_probs.size(0)
+        label_indicator += torch.matmul(weighted_signs[:, start:end], chunk_probs.to(device))
 
     root = torch.argmax(label_indicator, dim = 0)
     return root, label_indicator
 
+def generate_multicls_l1_label_set_batched(train_dataset, vtuning_model: RoBERTaVTuningClassification, weight_tensors,
+                                           cache_probs = None, num_classes = 3, norm_class = False):
+    '''
+    label set scores of several weight vectors (e.g. independent boosting runs on the same training set) in one pass over the
+    cached probabilities: the weighted class signs of all the runs are stacked into one (num_runs * num_classes) * N matrix.
+    weight_tensors: num_runs * N
+    return: root (num_runs * vocab_size), label_indicator (num_runs * num_classes * vocab_size)
+    '''
+    cache_probs = as_prob_store(cache_probs)
+    device = vtuning_model.device
+    vocab_size = cache_probs.size(1)
+    _, label_list = train_dataset
+    num_runs, num_examples = weight_tensors.size()
+    sign_matrix = get_class_sign_matrix(label_list, num_classes, norm_class, device)
+    weighted_signs = sign_matrix.unsqueeze(0) * (weight_tensors.float().to(device) * num_examples).unsqueeze(1)
+    weighted_signs = weighted_signs.view(num_runs * num_classes, num_examples)
+    label_indicator = torch.zeros(num_runs * num_classes, vocab_size).float().to(device)
+    for start, chunk_probs in cache_probs.iter_chunks():
+        end = start + chunk_probs.size(0)
+        label_indicator += torch.matmul(weighted_signs[:, start:end], chunk_probs.to(device))
+    label_indicator = label_indicator.view(num_runs, num_classes, vocab_size)
+    root = torch.argmax(label_indicator, dim = 1)
+    return root, label_indicator
+
+class LabelSetScoreState():
+    '''
+    The label set scores of every template, kept across boosting rounds and updated from the weight changes.
+    The scores are linear in the dataset weights, and between two visits of a template adaboost_step only multiplies the
+    weights of the misclassified examples before renormalizing: the new weights are scale * the old ones (scale being the
+    product of the normalizations, i.e., the smallest ratio new/old) except on the examples misclassified in between.
+    A revisit then costs O(#changed examples * vocab_size) instead of a full rescan. A full rescan is made when more than
+    max_changed_ratio of the examples changed, every refresh_interval updates to bound the rounding drift, and always for
+    token-major mmap stores, whose example rows are not contiguous.
+    '''
+    def __init__(self, max_changed_ratio = 0.5, refresh_interval = 20, tolerance = 1e-5):
+        self.max_changed_ratio = max_changed_ratio
+        self.refresh_interval = refresh_interval
+        self.tolerance = tolerance
+        self.states = {}
+
+    def get_scores(self, key, train_dataset, vtuning_model: RoBERTaVTuningClassification, weight_tensor, cache_probs,
+                   num_classes = 3, norm_class = False):
+        '''
+        same outputs as generate_multicls_l1_label_set_with_cache; key identifies the cached probabilities (e.g. the template name)
+        '''
+        device = vtuning_model.device
+        weights = weight_tensor.float().to(device)
+        state = self.states.get(key)
+        if state is not None and state['norm_class'] == norm_class and state['weights'].size(0) == weights.size(0) \
+            and state['num_updates'] < self.refresh_interval:
+            ratio = weights / state['weights']
+            scale = ratio.min()
+            changed = torch.nonzero(ratio > scale * (1 + self.tolerance)).view(-1)
+            store = as_prob_store(cache_probs)
+            ## the rows of a token-major mmap store are scattered over the whole file, so reading a few of them costs as much
+            ## as a full (sequential) rescan
+            scattered = not store.is_resident() and store.layout == 'token'
+            if not scattered and changed.size(0) <= self.max_changed_ratio * weights.size(0):
+                label_indicator = state['scores'] * scale
+                if changed.size(0) > 0:
+                    _, label_list = train_dataset
+                    sign_matrix = get_class_sign_matrix(label_list, num_classes, norm_class, device)
+                    delta_weights = (weights[changed] - scale * state['weights'][changed]) * weights.size(0)
+                    ## out-of-core stores: the changed rows are read CHUNK_SIZE at a time
+                    chunk_size = changed.size(0) if store.is_resident() else CHUNK_SIZE
+                    for start in range(0, changed.size(0), chunk_size):
+                        chunk = changed[start: start + chunk_size]
+                        chunk_probs = store.select_rows(chunk).to(device)
+                        label_indicator = label_indicator + torch.matmul(sign_matrix[:, chunk] * delta_weights[start: start + chunk_size].view(1, -1),
+                                                                         chunk_probs)
+                self.states[key] = {'scores': label_indicator, 'weights': weights.clone(), 'norm_class': norm_class,
+                                    'num_updates': state['num_updates'] + 1}
+                return torch.argmax(label_indicator, dim = 0), label_indicator.clone()
+
+        root, label_indicator = generate_multicls_l1_label_set_with_cache(train_dataset, vtuning_model, cache_probs = cache_probs,
+                                                                         num_classes = num_classes, norm_class = norm_class,
+                                                                         weight_tensor = weights)
+        self.states[key] = {'scores': label_indicator.clone(), 'weights': weights.clone(), 'norm_class': norm_class, 'num_updates': 0}
+        return root, label_indicator
+
+    def seed(self, key, scores, weights, norm_class = False):
+        '''
+        start the state of a key from scores computed elsewhere (e.g. memoized), with the dataset weights they were computed with
+        '''
+        self.states[key] = {'scores': scores.float().clone(), 'weights': weights.float().clone(), 'norm_class': norm_class, 'num_updates': 0}
+
+    def get_saved_scores(self, key):
+        if key not in self.states:
+            return None
+        return self.states[key]['scores']
+
+    def clear(self):
+        self.states = {}
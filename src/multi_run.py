@@ -0,0 +1,192 @@
+import math
+import torch
+import tqdm
+from typing import List
+
+from src.multicls_trainer import PromptBoostingTrainer, clamp_weak_error, MIN_WEAK_ERROR
+from src.label_set_util import generate_multicls_l1_label_set_batched
+from src.verbalizer_search import search_best_verbalizers
+from src.prob_store import as_prob_store
+from src.template import SentenceTemplate
+
+
+class MultiRunBooster():
+    '''
+    Independent AdaBoost ensembles trained together on the same training set (e.g. one fewshot seed with several label set
+    sizes and learning rates). The runs visit the same templates, so every round the label set scores of all the runs are one
+    pass over the cached probabilities of the template, the candidate columns are gathered once, and the candidate errors,
+    the predictions of the weak learners and the weight updates are computed with the runs as an extra dimension.
+    Each run keeps its own PromptBoostingTrainer (ensemble, weak learners, best epoch) for reporting and final_eval.
+    '''
+    def __init__(self, run_names: List[str], trainers: List[PromptBoostingTrainer], label_set_sizes: List[int], num_training: int,
+                 device = torch.device('cuda')):
+        assert len(run_names) == len(trainers) == len(label_set_sizes)
+        self.run_names = run_names
+        self.trainers = trainers
+        self.label_set_sizes = label_set_sizes
+        self.num_classes = trainers[0].num_classes
+        self.device = device
+        self.adaboost_lrs = torch.FloatTensor([trainer.adaboost_lr for trainer in trainers]).to(device)
+        self.weight_tensors = torch.ones([len(trainers), num_training], dtype = torch.float32).to(device) / num_training
+
+    def sample_candidates(self, token_scores):
+        '''
+        the candidates of every run, sampled by its trainer from its own label sets, padded to the same number of candidates
+        by repeating the first one (which does not change the first minimal error)
+        return: num_runs * num_candidates * num_classes
+        '''
+        indices = torch.argsort(token_scores, dim = -1, descending = True)   ## num_runs, num_classes, vocab_size
+        candidates = [trainer.sample_candidates(indices[r, :, :self.label_set_sizes[r]]) for r, trainer in enumerate(self.trainers)]
+        num_candidates = max([curr_candidates.size(0) for curr_candidates in candidates])
+        padded = [torch.cat([curr_candidates, curr_candidates[:1].expand(num_candidates - curr_candidates.size(0), -1)])
+                  for curr_candidates in candidates]
+        return torch.stack(padded)
+
+    def predict(self, eval_probs, selected, eval_labels):
+        '''
+        predictions and wrong flags of the verbalizer of every run (selected: num_runs * num_classes): num_runs * num_examples
+        '''
+        num_runs = selected.size(0)
+        columns = as_prob_store(eval_probs).gather(selected.view(-1)).to(eval_labels.device)
+        pred_labels = torch.argmax(columns.view(-1, num_runs, self.num_classes), dim = -1).t().int()
+        wrong_flags = (pred_labels != eval_labels.view(1, -1)).float()
+        return pred_labels, wrong_flags
+
+    def boost_round(self, dataset: List, vtuning_model, template: SentenceTemplate, train_probs, train_labels: torch.LongTensor,
+                    valid_probs, valid_labels: torch.LongTensor, norm_class = False):
+        '''
+        one boosting round of every run on the template
+        return: the log of every run (None for the runs whose weak learner is rejected)
+        '''
+        for r, trainer in enumerate(self.trainers):
+            trainer.record_dataset_weights(self.weight_tensors[r])
+        label_map, token_scores = generate_multicls_l1_label_set_batched(dataset, vtuning_model, self.weight_tensors, train_probs,
+                                                                         num_classes = self.num_classes, norm_class = norm_class)
+        class_mask = label_map.unsqueeze(1) == torch.arange(self.num_classes, device = label_map.device).view(1, -1, 1)
+        token_scores[~class_mask] = -10000
+
+        candidate_ids = self.sample_candidates(token_scores)
+        selected, _, worst_errors = search_best_verbalizers(train_probs, candidate_ids, train_labels, self.weight_tensors)
+        train_preds, wrong_flags = self.predict(train_probs, selected, train_labels)
+        valid_preds, valid_wrong_flags = self.predict(valid_probs, selected, valid_labels)
+        train_errors = torch.sum(wrong_flags * self.weight_tensors, dim = 1)
+        train_accs = 1 - wrong_flags.mean(dim = 1)
+        valid_accs = 1 - valid_wrong_flags.mean(dim = 1)
+
+        accepted = train_errors < 1 - (1 / (self.num_classes))
+        clamped_errors = clamp_weak_error(train_errors, self.num_classes)
+        alphas = (torch.log((1 - clamped_errors)/clamped_errors) + math.log(self.num_classes - 1)) * self.adaboost_lrs
+        alphas = torch.where(accepted, alphas, torch.zeros_like(alphas))
+        weight_tensors = self.weight_tensors * torch.exp(alphas.view(-1, 1) * wrong_flags)
+        self.weight_tensors = weight_tensors / torch.sum(weight_tensors, dim = 1, keepdim = True)
+
+        stats = torch.stack([accepted.float(), train_errors, alphas, train_accs, valid_accs, worst_errors.float()], dim = 1)
+        stats = torch.cat([stats, selected.float().to(stats.device)], dim = 1).tolist()    ## one host sync for all the runs
+
+        ensemble_accs = []
+        for r, trainer in enumerate(self.trainers):
+            if not stats[r][0]:
+                continue
+            trainer.model_weight_tensor.append(alphas[r])
+            trainer.save_prediction(train_preds[r], split = 'train')
+            trainer.save_prediction(valid_preds[r], split = 'valid')
+            ensemble_accs.append(trainer.ensemble_result(train_labels, split = 'train', verbose = False))
+            ensemble_accs.append(trainer.ensemble_result(valid_labels, split = 'valid', verbose = False))
+        ensemble_accs = torch.stack(ensemble_accs).tolist() if len(ensemble_accs) > 0 else []
+
+        logs = []
+        for r, trainer in enumerate(self.trainers):
+            _, train_error, alpha, train_acc, valid_acc, worst_error = stats[r][:6]
+            best_tokens = vtuning_model.tokenizer.convert_ids_to_tokens([int(token_id) for token_id in stats[r][6:]])
+            verbalizer = {i:best_tokens[i] for i in range(self.num_classes)}
+            print(f"[{self.run_names[r]}] error range: {train_error}-{worst_error}")
+            print(f"[{self.run_names[r]}] {verbalizer}")
+            if train_error < MIN_WEAK_ERROR:
+                print(f"[{self.run_names[r]}] error {train_error} of a perfect weak learner clamped to {MIN_WEAK_ERROR}")
+            if not stats[r][0]:
+                print(f"[{self.run_names[r]}] error {train_error}; train_acc {train_acc}\n Ensemble is worse than random, ensemble can not be fit.")
+                logs.append(None)
+                continue
+            train_ensemble_acc, valid_ensemble_acc = ensemble_accs.pop(0), ensemble_accs.pop(0)
+            print(f"[{self.run_names[r]}]\ttrain error {train_error}, train_acc {train_acc}")
+            print(f"[{self.run_names[r]}]\talpha {alpha}")
+            print(f"[{self.run_names[r]}]\tvalid accuracy {valid_acc}")
+            print(f"[{self.run_names[r]}]\tensemble: train accuracy {train_ensemble_acc}, valid accuracy {valid_ensemble_acc}")
+            if valid_ensemble_acc >= trainer.best_ensemble_valid:
+                trainer.best_ensemble_valid = valid_ensemble_acc
+                trainer.best_epoch = len(trainer.model_weight_tensor)
+            trainer.save_weak_learner(verbalizer, template.template_name)
+            logs.append({
+                'train_error': train_error,
+                'alpha': alpha,
+                'train_acc': train_acc,
+                'valid_acc': valid_acc,
+                'ensemble_train_acc': train_ensemble_acc,
+                'ensemble_valid_acc': valid_ensemble_acc,
+            })
+        return logs
+
+    def validation_curves(self, valid_labels: torch.LongTensor):
+        '''
+        the accuracy of every ensemble prefix of every run on the validation set, copied to the host at once
+        return: {run name: list of accuracies}
+        '''
+        curves = [trainer.ensemble_curve(valid_labels, split = 'valid') for trainer in self.trainers]
+        lengths = [curve.size(0) for curve in curves]
+        max_length = max(lengths + [1])
+        padded = torch.stack([torch.cat([curve, curve.new_zeros(max_length - curve.size(0))]) for curve in curves]).tolist()
+        return {run_name: padded[r][:lengths[r]] for r, run_name in enumerate(self.run_names)}
+
+
+def load_template_preds(trainer: PromptBoostingTrainer, prediction_saver, vtuning_model, template: SentenceTemplate, train_dataset, valid_dataset):
+    '''
+    the cached probabilities of a template on the training and validation sets, computed with the LM and cached on a miss
+    '''
+    cached_preds, flag = prediction_saver.load_preds(template)
+    if not flag:
+        train_probs = trainer.pre_compute_logits(vtuning_model, template, train_dataset, store_path = prediction_saver.get_store_prefix(template, 'train'))
+        valid_probs = trainer.pre_compute_logits(vtuning_model, template, valid_dataset, store_path = prediction_saver.get_store_prefix(template, 'valid'))
+        prediction_saver.save_preds(template, train_probs, valid_probs)
+    else:
+        train_probs, valid_probs = cached_preds
+    return train_probs, valid_probs
+
+def boost_runs(booster: MultiRunBooster, template_manager, prediction_saver, vtuning_model, train_dataset, valid_dataset,
+               train_labels: torch.LongTensor, valid_labels: torch.LongTensor, num_rounds: int, log_fn = None):
+    '''
+    num_rounds boosting rounds of all the runs of the booster, one template of the template manager per round;
+    log_fn(run_name, tolog) is called with the logs of every run that added a weak learner
+    '''
+    train_probs, valid_probs = [], []
+    for model_id in tqdm.tqdm(range(num_rounds)):
+        del train_probs
+        del valid_probs
+        template = template_manager.change_template()
+        train_probs, valid_probs = load_template_preds(booster.trainers[0], prediction_saver, vtuning_model, template, train_dataset, valid_dataset)
+        logs = booster.boost_round(train_dataset, vtuning_model, template, train_probs, train_labels, valid_probs, valid_labels)
+        for run_name, tolog in zip(booster.run_names, logs):
+            if tolog is None:
+                continue
+            print(f"[{run_name}]\tmodel {model_id + 1} finished")
+            if log_fn is not None:
+                log_fn(run_name, tolog)
+    del train_probs
+    del valid_probs
+
+def evaluate_runs(booster: MultiRunBooster, template_manager, vtuning_model, valid_labels: torch.LongTensor, test_dataset, test_pred_saver,
+                  streaming = False):
+    '''
+    the best ensemble of every run on the validation and test sets
+    return: list of (run name, best epoch, best valid acc, best test acc)
+    '''
+    all_template_used = template_manager.get_all_template()
+    results = []
+    for run_name, trainer in zip(booster.run_names, booster.trainers):
+        print(f"[{run_name}] finish training with {len(trainer.model_weight_tensor)} weak classifier")
+        print(f"[{run_name}] best ensemble classfier: 0 - {trainer.best_epoch}")
+        valid_ensemble_acc = trainer.ensemble_result(valid_labels, split = 'valid', ensemble_num = trainer.best_epoch)
+        test_ensemble_acc = trainer.final_eval(test_dataset, vtuning_model, all_template_used, test_pred_saver, streaming = streaming)
+        print(f"[{run_name}] best valid acc {valid_ensemble_acc}")
+        print(f"[{run_name}] best test acc {test_ensemble_acc}")
+        results.append((run_name, trainer.best_epoch, float(valid_ensemble_acc), float(test_ensemble_acc)))
+    return results
@@ -16,15 +16,30 @@ from transformers import get_scheduler
 from src.ptuning import BaseModel, MLPClassificationHead, RoBERTaVTuningClassification
 from src.template import SentenceTemplate, TemplateManager, TemplateSaver
 from src.saver import PredictionSaver, TestPredictionSaver
-from src.label_set_util import generate_multicls_l1_label_set_with_cache
+from src.label_set_util import generate_multicls_l1_label_set_with_cache, LabelSetScoreState
+from src.prob_store import ProbStoreWriter, DEFAULT_TOPK, as_prob_store
+from src.ensemble_state import EnsembleState
+from src.verbalizer_search import SEARCH_MODES, count_candidates, sample_candidate_indices, decode_candidate_ids, \
+    search_best_verbalizer, exact_search_verbalizer, race_best_verbalizer, CandidateFlagStore
 from src.utils import ROOT_DIR, BATCH_SIZE
 
+MIN_WEAK_ERROR = 1e-10
+
+def clamp_weak_error(error, num_classes):
+    '''
+    clamp the weighted error of a weak learner to [MIN_WEAK_ERROR, 1 - 1/num_classes] before computing its alpha: a perfect
+    weak learner gets a large finite alpha instead of inf (and NaN weights), and a learner not better than random (rejected)
+    gets alpha 0 and leaves the weights unchanged
+    '''
+    if torch.is_tensor(error):
+        return error.clamp(min = MIN_WEAK_ERROR, max = 1 - 1 / num_classes)
+    return min(max(error, MIN_WEAK_ERROR), 1 - 1 / num_classes)
+
 
 class BaseMuticlsTrainer():
-    def __init__(self, adaboost_lr = 1.0, num_classes = 2, use_logits = False):
-        self.train_labels_by_model = []
-        self.valid_labels_by_model = []
-        self.test_labels_by_model = []
+    def __init__(self, adaboost_lr = 1.0, num_classes = 2, use_logits = False, storage_mode = 'dense', store_topk = DEFAULT_TOPK,
+                 store_layout = 'example'):
+        self.ensembles = {split: EnsembleState(num_classes) for split in ['train', 'valid', 'test']}
 
         self.dataset_weights = []
         self.model_weight_tensor = []
@@ -34,69 +49,79 @@ class BaseMuticlsTrainer():
         self.adaboost_lr = adaboost_lr
         self.num_classes = num_classes
         self.use_logits = use_logits
+        self.storage_mode = storage_mode
+        self.store_topk = store_topk
+        self.store_layout = store_layout
 
         self.verbalizer_list = []
         self.template_name_list = []
 
-    def save_prediction(self, pred_labels, split = 'train'):
-        if split == 'train':
-            if type(self.train_labels_by_model) == list:
-                self.train_labels_by_model = pred_labels.unsqueeze(0)
-            else:
-                self.train_labels_by_model = torch.cat([self.train_labels_by_model, pred_labels.unsqueeze(0)])
-        elif split == 'valid':
-            if type(self.valid_labels_by_model) == list:
-                self.valid_labels_by_model = pred_labels.unsqueeze(0)
-            else:
-                self.valid_labels_by_model = torch.cat([self.valid_labels_by_model, pred_labels.unsqueeze(0)])
-
-        elif split == 'test':
-            if type(self.test_labels_by_model) == list:
-                self.test_labels_by_model = pred_labels.unsqueeze(0)
-            else:
-                self.test_labels_by_model = torch.cat([self.test_labels_by_model, pred_labels.unsqueeze(0)])
-        
-        else:
-            raise NotImplementedError
+    @property
+    def train_labels_by_model(self):
+        return self.ensembles['train'].get_predictions()
 
-    def ensemble_result(self, labels: torch.LongTensor, split = 'train', ensemble_num = 0):
-        if ensemble_num <= 0:
-            if split == 'train':
-                labels_by_model = self.train_labels_by_model
-            elif split == 'valid':
-                labels_by_model = self.valid_labels_by_model
-            elif split == 'test':
-                labels_by_model = self.test_labels_by_model
-            else:
-                raise NotImplementedError
-            model_weight_tensor = torch.tensor(self.model_weight_tensor).to(labels.device)
+    @property
+    def valid_labels_by_model(self):
+        return self.ensembles['valid'].get_predictions()
 
-        else:
-            if split == 'train':
-                labels_by_model = self.train_labels_by_model[:ensemble_num]
-            elif split == 'valid':
-                labels_by_model = self.valid_labels_by_model[:ensemble_num]
-            elif split == 'test':
-                labels_by_model = self.test_labels_by_model[:ensemble_num]
-            else:
-                raise NotImplementedError
-            model_weight_tensor = torch.tensor(self.model_weight_tensor[:ensemble_num]).to(labels.device)
+    @property
+    def test_labels_by_model(self):
+        return self.ensembles['test'].get_predictions()
 
-        ## labels_by_model:  model_num * data_num
-        ensemble_score = torch.zeros([labels_by_model.size(1), self.num_classes]).float().to(labels_by_model.device)
-        model_weight_tensor = model_weight_tensor.view((-1,1))
-        for i in range(self.num_classes):
-            curr_class_score = torch.sum((labels_by_model == i).float() * model_weight_tensor, dim = 0)
-            ensemble_score[:,i] = curr_class_score
-        weighted_prediction = torch.argmax(ensemble_score, dim = 1)
+    def save_prediction(self, pred_labels, split = 'train', alpha = None):
+        '''
+        add the predictions of the next weak learner to the ensemble of the split.
+        alpha: the weight of the weak learner, by default the alpha recorded by adaboost_step for it
+        '''
+        if split not in self.ensembles:
+            raise NotImplementedError
+        ensemble = self.ensembles[split]
+        if alpha is None:
+            alpha = self.model_weight_tensor[len(ensemble)]
+        ensemble.add(pred_labels, alpha)
+
+    def get_model_weights(self, ensemble_num = 0, device = None):
+        '''
+        the alphas of the first ensemble_num weak learners (all if ensemble_num <= 0) as a tensor. The alphas are python floats,
+        or tensors kept on the device by boost_round.
+        '''
+        alphas = self.model_weight_tensor[:ensemble_num] if ensemble_num > 0 else self.model_weight_tensor
+        if len(alphas) > 0 and all(torch.is_tensor(alpha) for alpha in alphas):
+            return torch.stack([alpha.float().to(device) for alpha in alphas])
+        return torch.tensor([float(alpha) for alpha in alphas]).to(device)
+
+    def ensemble_result(self, labels: torch.LongTensor, split = 'train', ensemble_num = 0, verbose = True):
+        if split not in self.ensembles:
+            raise NotImplementedError
+        weighted_prediction = self.ensembles[split].predict(ensemble_num)
 
         n_correct = torch.sum(weighted_prediction == labels)
         total = len(labels)
         acc = n_correct / total
-        print(f"\tensemble: total {weighted_prediction.size(0)}, correct {n_correct}, accuracy {acc}")
+        if verbose:
+            print(f"\tensemble: total {weighted_prediction.size(0)}, correct {n_correct}, accuracy {acc}")
         return acc
 
-    def pre_compute_logits(self, vtuning_model, template, eval_dataset, batch_size = None):
+    def ensemble_curve(self, labels: torch.LongTensor, split = 'valid'):
+        '''
+        accuracy of every ensemble prefix 1..M on the split in one pass (M: the number of weak learners with predictions on it)
+        '''
+        if split not in self.ensembles:
+            raise NotImplementedError
+        return self.ensembles[split].prefix_accuracies(labels)
+
+    def get_best_epoch(self, labels: torch.LongTensor, split = 'valid'):
+        '''
+        the size of the best ensemble prefix on the split; the largest one among ties, as in the training loop
+        '''
+        curve = self.ensemble_curve(labels, split)
+        return curve.size(0) - torch.argmax(curve.flip(0)).item()
+
+    def pre_compute_logits(self, vtuning_model, template, eval_dataset, batch_size = None, store_path = None):
+        '''
+        In the dense storage mode with the example-major layout the full tensor is returned as before. Otherwise, each batch is
+        compressed into a ProbStore as soon as it is computed (store_path: where the memory-mapped file is written in the mmap mode).
+        '''
         sentence_list, label_list = eval_dataset
         if batch_size == None:
             print(f"using default batch size {BATCH_SIZE}")
@@ -104,7 +129,12 @@ class BaseMuticlsTrainer():
         use_verbalizer = False
         num_batches = len(sentence_list) // batch_size
 
-        all_probs = []
+        use_store = self.storage_mode != 'dense' or self.store_layout != 'example'
+        if use_store:
+            all_probs = ProbStoreWriter(len(sentence_list), mode = self.storage_mode, topk = self.store_topk,
+                                        path_prefix = store_path, device = vtuning_model.device, layout = self.store_layout)
+        else:
+            all_probs = []
 
         for i in tqdm.tqdm(range(num_batches)):
             batch_input = sentence_list[i * batch_size: (i+1) * batch_size]        
@@ -126,29 +156,128 @@ class BaseMuticlsTrainer():
             all_probs.append(pred_probs)
             del model_output
 
+        if use_store:
+            return all_probs.finish()
         all_probs = torch.cat(all_probs, dim = 0)
 
         return all_probs
 
+    def extend_logits(self, vtuning_model, template, eval_dataset, base_probs, base_ids, batch_size = None, store_path = None):
+        '''
+        pre_compute_logits for a dataset whose examples are partly in base_probs, the cached predictions of another dataset (e.g.
+        the training set before new labeled data arrived). base_ids[i] is the row of example i in base_probs, or -1: only these
+        examples go through the LM, and the result is in the order of eval_dataset.
+        '''
+        sentence_list, label_list = eval_dataset
+        if batch_size == None:
+            print(f"using default batch size {BATCH_SIZE}")
+            batch_size = BATCH_SIZE
+        device = vtuning_model.device
+        base_probs = as_prob_store(base_probs)
+        base_ids = torch.LongTensor(base_ids)
+        print(f"{torch.sum(base_ids < 0).item()} of {len(sentence_list)} examples are not cached")
+
+        use_store = self.storage_mode != 'dense' or self.store_layout != 'example'
+        if use_store:
+            all_probs = ProbStoreWriter(len(sentence_list), mode = self.storage_mode, topk = self.store_topk,
+                                        path_prefix = store_path, device = device, layout = self.store_layout)
+        else:
+            all_probs = []
+
+        for start in tqdm.tqdm(range(0, len(sentence_list), batch_size)):
+            batch_base_ids = base_ids[start: start + batch_size]
+            cached = batch_base_ids >= 0
+            pred_probs = torch.zeros([batch_base_ids.size(0), base_probs.size(1)], dtype = torch.float32, device = device)
+            if cached.any():
+                pred_probs[cached.to(device)] = base_probs.select_rows(batch_base_ids[cached]).to(device)
+            if not cached.all():
+                new_index = torch.nonzero(~cached).view(-1)
+                model_output = vtuning_model.predict([sentence_list[start + i] for i in new_index.tolist()], template, False)
+                if self.use_logits:
+                    new_probs = model_output.all_token_logits.detach().clone()
+                else:
+                    new_probs = model_output.all_token_probs.detach().clone()
+                pred_probs[new_index.to(device)] = new_probs.float()
+                del model_output
+            all_probs.append(pred_probs)
+
+        if use_store:
+            return all_probs.finish()
+        return torch.cat(all_probs, dim = 0)
+
     def record_dataset_weights(self, weight_tensor: torch.FloatTensor):
-        self.dataset_weights.append(weight_tensor.tolist())
+        self.dataset_weights.append(weight_tensor.detach().clone())
     
     def adaboost_step(self, error, wrong_flags, weight_tensor):
-        alpha = (math.log((1 - error)/error) + math.log(self.num_classes - 1)) * self.adaboost_lr
+        '''
+        error: a python float, or a tensor to keep alpha on the device (clamped, see clamp_weak_error)
+        '''
+        error = clamp_weak_error(error, self.num_classes)
+        if torch.is_tensor(error):
+            alpha = (torch.log((1 - error)/error) + math.log(self.num_classes - 1)) * self.adaboost_lr
+        else:
+            alpha = (math.log((1 - error)/error) + math.log(self.num_classes - 1)) * self.adaboost_lr
         weight_multiplier = torch.exp(alpha * wrong_flags)
         weight_tensor = weight_tensor * weight_multiplier
         weight_tensor = weight_tensor / torch.sum(weight_tensor)
         self.model_weight_tensor.append(alpha)
         return alpha, weight_tensor
 
+    def replay_weak_learner(self, verbalizer, template_name, alpha, train_preds, valid_preds, train_labels, weight_tensor):
+        '''
+        add a weak learner fitted before (e.g. by a run on a smaller training set) with its alpha, and make its AdaBoost weight
+        update on the current training set
+        return: the new dataset weights
+        '''
+        self.record_dataset_weights(weight_tensor)
+        self.model_weight_tensor.append(alpha)
+        self.save_prediction(train_preds, split = 'train')
+        self.save_prediction(valid_preds, split = 'valid')
+        wrong_flags = (train_preds != train_labels).float()
+        weight_tensor = weight_tensor * torch.exp(alpha * wrong_flags)
+        weight_tensor = weight_tensor / torch.sum(weight_tensor)
+        self.save_weak_learner(verbalizer, template_name)
+        return weight_tensor
+
     def save_dataset_weights(self):
         with open(ROOT_DIR + "dataset_weights/weight.pkl", 'wb') as f:
-            pickle.dump(self.dataset_weights, f)
+            pickle.dump([weights.tolist() if torch.is_tensor(weights) else weights for weights in self.dataset_weights], f)
 
     def save_weak_learner(self, verbalizer, template_name):
         self.verbalizer_list.append(verbalizer)
         self.template_name_list.append(template_name)
 
+    def state_dict(self):
+        '''
+        the boosting state of the trainer (see src/checkpoint.py): the weak learners, their alphas and predictions on
+        train/valid, the recorded dataset weights and the best ensemble so far
+        '''
+        return {
+            'model_weight_tensor': [alpha.cpu() if torch.is_tensor(alpha) else alpha for alpha in self.model_weight_tensor],
+            'dataset_weights': [weights.cpu() if torch.is_tensor(weights) else weights for weights in self.dataset_weights],
+            'verbalizer_list': self.verbalizer_list,
+            'template_name_list': self.template_name_list,
+            'best_ensemble_valid': self.best_ensemble_valid,
+            'best_epoch': self.best_epoch,
+            'ensembles': {split: self.ensembles[split].state_dict() for split in ['train', 'valid']},
+        }
+
+    def load_state_dict(self, state, device):
+        self.model_weight_tensor = [alpha.to(device) if torch.is_tensor(alpha) else alpha for alpha in state['model_weight_tensor']]
+        self.dataset_weights = [weights.to(device) if torch.is_tensor(weights) else weights for weights in state['dataset_weights']]
+        self.verbalizer_list = state['verbalizer_list']
+        self.template_name_list = state['template_name_list']
+        self.best_ensemble_valid = state['best_ensemble_valid']
+        self.best_epoch = state['best_epoch']
+        for split, ensemble_state in state['ensembles'].items():
+            self.ensembles[split].load_state_dict(ensemble_state, device)
+
+    def reset_caches(self):
+        '''
+        drop the state that is rebuilt on demand and is not saved in checkpoints
+        '''
+        pass
+
     def analyze_acc_by_class(self, label_tensor, pred_tensor):
         for i in range(self.num_classes):
             class_mask = label_tensor == i
@@ -159,22 +288,269 @@ class BaseMuticlsTrainer():
             print(f"class {i}: correct prediction: {total_corr}, wrong prediction: {total_curr_class - total_corr}, accuracy: {corr_acc}")
 
 class PromptBoostingTrainer(BaseMuticlsTrainer):
-    def __init__(self, adaboost_lr = 1.0, num_classes = 3, adaboost_maximum_epoch = 20000, use_logits = False):
-        super().__init__(adaboost_lr, num_classes, use_logits)
+    def __init__(self, adaboost_lr = 1.0, num_classes = 3, adaboost_maximum_epoch = 20000, use_logits = False,
+                 storage_mode = 'dense', store_topk = DEFAULT_TOPK, store_layout = 'example', search_mode = 'batched',
+                 search_block_size = None, flag_cache_bytes = 1 << 30, race_delta = 0.05):
+        super().__init__(adaboost_lr, num_classes, use_logits, storage_mode, store_topk, store_layout)
+        assert search_mode in SEARCH_MODES, f"unknown search mode {search_mode}"
         self.adaboost_maximum_epoch = adaboost_maximum_epoch
+        self.search_mode = search_mode
+        self.search_block_size = search_block_size
+        self.race_delta = race_delta
+        self.label_set_scores = LabelSetScoreState()
+        self.candidate_flags = CandidateFlagStore(flag_cache_bytes)
 
     def train(self, dataset: List, vtuning_model: RoBERTaVTuningClassification,
                     train_probs: torch.LongTensor, train_labels: torch.LongTensor, 
-                    weight_tensor: torch.FloatTensor, label_set_size: int, norm_class = False):
-        label_map, token_scores = generate_multicls_l1_label_set_with_cache(dataset, vtuning_model, weight_list = weight_tensor.tolist(), cache_probs = train_probs, label_set_size = 0, 
+                    weight_tensor: torch.FloatTensor, label_set_size: int, norm_class = False, score_key = None, scores = None):
+        '''
+        score_key: identifies train_probs (e.g. the template name) to update its label set scores from the weight changes
+                   since it was last used, instead of rescanning train_probs, and to reuse the wrong flags of the candidates
+                   already evaluated on it
+        scores:    the label set scores (num_classes * vocab_size) if they are already computed (see get_label_set_scores)
+        '''
+        class_token_indices = self.get_class_token_indices(dataset, vtuning_model, train_probs, weight_tensor, label_set_size,
+                                                           norm_class, score_key, scores)
+        if self.search_mode == 'loop':
+            return self.loop_search(vtuning_model, class_token_indices, train_probs, train_labels, weight_tensor)
+        elif self.search_mode == 'exact':
+            class_candidates = [class_token_indices[i].cpu() for i in range(self.num_classes)]
+            best_selected, best_error = exact_search_verbalizer(train_probs, class_candidates, train_labels, weight_tensor)
+            print(f"best error: {best_error}")
+        elif self.search_mode == 'race':
+            selected_candidates = self.sample_candidates(class_token_indices.cpu())
+            best_index, best_error, worst_error = race_best_verbalizer(train_probs, selected_candidates.to(weight_tensor.device), train_labels,
+                                                                       weight_tensor, delta = self.race_delta, block_size = self.search_block_size)
+            print(f"error range: {best_error}-{worst_error}")
+            best_selected = selected_candidates[best_index].tolist()
+        else:
+            selected_candidates = self.sample_candidates(class_token_indices.cpu())
+            flag_cache = self.get_flag_cache(score_key)
+            best_index, best_error, worst_error = search_best_verbalizer(train_probs, selected_candidates, train_labels, weight_tensor,
+                                                                         block_size = self.search_block_size, flag_cache = flag_cache)
+            print(f"error range: {best_error}-{worst_error}")
+            best_selected = selected_candidates[best_index].tolist()
+        if not best_error < 1:
+            return None, 1, 0, None, None
+        best_tokens = vtuning_model.tokenizer.convert_ids_to_tokens(best_selected)
+        best_verbalizer = {i:best_tokens[i] for i in range(self.num_classes)}
+        best_wrong_flags, best_error, best_acc, best_pred_labels, _ = self.inference(train_probs, best_selected, train_labels, weight_tensor)
+        return best_verbalizer, best_error,best_acc, best_wrong_flags,best_pred_labels
+
+    def get_label_set_scores(self, dataset, vtuning_model, train_probs, weight_tensor, norm_class = False, score_key = None):
+        '''
+        return: the class of every token (vocab_size) and the score of every token for every class (num_classes * vocab_size)
+        '''
+        if score_key is not None:
+            return self.label_set_scores.get_scores(score_key, dataset, vtuning_model, weight_tensor, train_probs,
+                                                    num_classes = self.num_classes, norm_class = norm_class)
+        return generate_multicls_l1_label_set_with_cache(dataset, vtuning_model, weight_tensor = weight_tensor, cache_probs = train_probs, label_set_size = 0, 
                                 num_classes = self.num_classes, norm_class = norm_class)
+
+    def get_class_token_indices(self, dataset, vtuning_model, train_probs, weight_tensor, label_set_size, norm_class = False, score_key = None,
+                                scores = None):
+        '''
+        scores: precomputed label set scores, otherwise they are computed with get_label_set_scores
+        return: the label set of every class (num_classes * label_set_size token ids, best first)
+        '''
+        if scores is not None:
+            token_scores = scores.clone()
+            label_map = torch.argmax(token_scores, dim = 0)
+        else:
+            label_map, token_scores = self.get_label_set_scores(dataset, vtuning_model, train_probs, weight_tensor, norm_class, score_key)
         for i in range(self.num_classes):
             class_mask = label_map == i
             token_scores[i,~class_mask] = -10000
 
         indices = torch.argsort(token_scores, dim = 1, descending = True)   ## num_classes, vocab_size
-        class_token_indices = indices[:, :label_set_size]
-                
+        return indices[:, :label_set_size]
+
+    def sample_candidates(self, class_token_indices):
+        num_candidates = count_candidates(class_token_indices.size(1), self.num_classes)
+        candidate_size = self.get_candidate_size(num_candidates)
+        selected_ids = sample_candidate_indices(num_candidates, candidate_size)
+        return decode_candidate_ids(class_token_indices, selected_ids)
+
+    def memo_config(self, norm_class = False):
+        '''
+        the settings that change the label set scores or the result of the search, part of the key of a VerbalizerMemo entry:
+        the search mode and its settings, and the storage mode of the cached predictions (half and top-k stores change the scores)
+        '''
+        config = f"{self.search_mode}{self.adaboost_maximum_epoch}"
+        if self.search_mode == 'race':
+            config += f"_delta{self.race_delta}"
+        config += f"_{self.storage_mode}"
+        if self.storage_mode == 'topk':
+            config += f"{self.store_topk}"
+        if self.use_logits:
+            config += '_logits'
+        if norm_class:
+            config += '_norm'
+        return config
+
+    def replay_search_rng(self, label_set_size):
+        '''
+        draw the candidate indices a sampled search would draw, without searching, so that a weak learner taken from a
+        VerbalizerMemo leaves the random state as a search would
+        '''
+        if self.search_mode in ['loop', 'batched', 'race']:
+            num_candidates = count_candidates(label_set_size, self.num_classes)
+            sample_candidate_indices(num_candidates, self.get_candidate_size(num_candidates))
+
+    def search_result_from_verbalizer(self, selected: torch.LongTensor, train_probs, train_labels, weight_tensor):
+        '''
+        the outputs of search_on_device for a known verbalizer (token ids), e.g. taken from a VerbalizerMemo
+        '''
+        wrong_flags, error, acc, pred_labels, _ = self.inference(train_probs, selected, train_labels, weight_tensor, sync = False)
+        return selected, error, acc, wrong_flags, pred_labels, error
+
+    def get_flag_cache(self, score_key):
+        if score_key is None or self.candidate_flags.max_bytes <= 0:
+            return None
+        return self.candidate_flags.get(score_key)
+
+    def train_on_device(self, dataset: List, vtuning_model: RoBERTaVTuningClassification,
+                        train_probs: torch.LongTensor, train_labels: torch.LongTensor,
+                        weight_tensor: torch.FloatTensor, label_set_size: int, norm_class = False, score_key = None):
+        '''
+        the batched search of train, without copying its results to the host: the candidates are decoded on the device and
+        the verbalizer is returned as token ids. The cached wrong flags (score_key) are looked up on the host.
+        return: token ids of the best verbalizer, its error, accuracy, wrong flags and predictions on the training set,
+                and the largest error among the candidates (tensors)
+        '''
+        class_token_indices = self.get_class_token_indices(dataset, vtuning_model, train_probs, weight_tensor, label_set_size,
+                                                           norm_class, score_key)
+        selected_candidates = self.sample_candidates(class_token_indices)
+        best_index, _, worst_error = search_best_verbalizer(train_probs, selected_candidates, train_labels, weight_tensor,
+                                                            block_size = self.search_block_size, flag_cache = self.get_flag_cache(score_key),
+                                                            sync = False)
+        best_selected = selected_candidates[best_index]
+        wrong_flags, error, acc, pred_labels, _ = self.inference(train_probs, best_selected, train_labels, weight_tensor, sync = False)
+        return best_selected, error, acc, wrong_flags, pred_labels, worst_error
+
+    def search_on_device(self, dataset: List, vtuning_model: RoBERTaVTuningClassification,
+                         train_probs: torch.LongTensor, train_labels: torch.LongTensor,
+                         weight_tensor: torch.FloatTensor, label_set_size: int, norm_class = False, score_key = None):
+        '''
+        the verbalizer search in any search mode, with the outputs of train_on_device. return None if no verbalizer is found.
+        '''
+        if self.search_mode == 'batched':
+            return self.train_on_device(dataset, vtuning_model, train_probs, train_labels, weight_tensor, label_set_size,
+                                        norm_class, score_key)
+        verbalizer, train_error, train_acc, wrong_flags, train_preds = self.train(dataset, vtuning_model, train_probs, train_labels,
+                                                                                weight_tensor, label_set_size, norm_class, score_key)
+        if verbalizer is None:
+            return None
+        word2idx = vtuning_model.tokenizer.get_vocab()
+        selected = torch.LongTensor([word2idx[verbalizer[i]] for i in range(self.num_classes)]).to(weight_tensor.device)
+        train_error = torch.tensor(train_error, device = weight_tensor.device)
+        train_acc = torch.tensor(train_acc, device = weight_tensor.device)
+        return selected, train_error, train_acc, wrong_flags, train_preds, train_error
+
+    def select_template(self, dataset: List, vtuning_model: RoBERTaVTuningClassification, template_probs: Dict,
+                        train_labels: torch.LongTensor, weight_tensor: torch.FloatTensor, label_set_size: int, norm_class = False):
+        '''
+        joint template-and-verbalizer selection: search the best verbalizer of every resident template (keyed by the template
+        name, so the label set scores and the candidate flags are updated incrementally) and keep the lowest weighted error.
+        template_probs: {template name: train_probs}
+        return: the name of the best template and its search result (see search_on_device), or None, None
+        '''
+        results = {}
+        for template_name, train_probs in template_probs.items():
+            result = self.search_on_device(dataset, vtuning_model, train_probs, train_labels, weight_tensor, label_set_size,
+                                           norm_class, score_key = template_name)
+            if result is not None:
+                results[template_name] = result
+        if len(results) == 0:
+            return None, None
+        template_names = list(results.keys())
+        errors = torch.stack([results[template_name][1].float().view(()) for template_name in template_names])
+        best_name = template_names[torch.argmin(errors).item()]
+        return best_name, results[best_name]
+
+    def boost_round(self, dataset: List, vtuning_model: RoBERTaVTuningClassification, train_probs, train_labels: torch.LongTensor,
+                    valid_probs, valid_labels: torch.LongTensor, weight_tensor: torch.FloatTensor, label_set_size: int,
+                    template_name: str, norm_class = False, score_key = None, search_result = None):
+        '''
+        one boosting round kept on the device: the dataset weights, the error and alpha of the weak learner, its predictions
+        and the ensemble accuracies stay tensors, and the statistics of the round are copied to the host once at the end.
+        The search itself still waits for the device where a size is data-dependent: the number of changed examples in the
+        incremental label set scores (score_key), and the number of cached candidates with the candidate flag cache.
+        A weak learner that is not better than random is rolled back.
+        search_result: the verbalizer search already made for this template (e.g. by select_template)
+        return: the log of the round (None if the weak learner is rejected) and the new dataset weights
+        '''
+        self.record_dataset_weights(weight_tensor)
+        if search_result is None:
+            search_result = self.search_on_device(dataset, vtuning_model, train_probs, train_labels, weight_tensor, label_set_size,
+                                                  norm_class, score_key)
+        if search_result is None:
+            print(f"no verbalizer better than the error of 1\n Ensemble is worse than random, ensemble can not be fit.")
+            return None, weight_tensor
+        selected, train_error, train_acc, wrong_flags, train_preds, worst_error = search_result
+        accepted = train_error < 1 - (1 / (self.num_classes))
+        alpha, new_weight_tensor = self.adaboost_step(train_error, wrong_flags, weight_tensor)
+        valid_acc, valid_preds, _ = self.compute_acc(valid_probs, selected, valid_labels, sync = False)
+        self.save_prediction(train_preds, split = 'train')
+        self.save_prediction(valid_preds, split = 'valid')
+        train_ensemble_acc = self.ensemble_result(train_labels, split = 'train', verbose = False)
+        valid_ensemble_acc = self.ensemble_result(valid_labels, split = 'valid', verbose = False)
+
+        stats = torch.stack([accepted.float(), train_error, alpha, train_acc, valid_acc, train_ensemble_acc, valid_ensemble_acc, worst_error])
+        stats = torch.cat([stats.float(), selected.float().to(stats.device)]).tolist()    ## the only copy of the round's results to the host
+        accepted, train_error, alpha, train_acc, valid_acc, train_ensemble_acc, valid_ensemble_acc, worst_error = stats[:8]
+        selected = [int(token_id) for token_id in stats[8:]]
+
+        print(f"error range: {train_error}-{worst_error}")
+        best_tokens = vtuning_model.tokenizer.convert_ids_to_tokens(selected)
+        verbalizer = {i:best_tokens[i] for i in range(self.num_classes)}
+        print(verbalizer)
+        if train_error < MIN_WEAK_ERROR:
+            print(f"error {train_error} of a perfect weak learner clamped to {MIN_WEAK_ERROR}")
+        if not accepted:
+            print(f"error {train_error}; train_acc {train_acc}\n Ensemble is worse than random, ensemble can not be fit.")
+            self.model_weight_tensor.pop()
+            self.ensembles['train'].pop()
+            self.ensembles['valid'].pop()
+            return None, weight_tensor
+        print(f"\ttrain error {train_error}, train_acc {train_acc}")
+        print(f"\talpha {alpha}")
+        print(f"\tvalid accuracy {valid_acc}")
+        print(f"\tensemble: train accuracy {train_ensemble_acc}, valid accuracy {valid_ensemble_acc}")
+
+        if valid_ensemble_acc >= self.best_ensemble_valid:
+            self.best_ensemble_valid = valid_ensemble_acc
+            self.best_epoch = len(self.model_weight_tensor)
+        self.save_weak_learner(verbalizer, template_name)
+
+        tolog = {
+            'train_error': train_error,
+            'alpha': alpha,
+            'train_acc': train_acc,
+            'valid_acc': valid_acc,
+            'ensemble_train_acc': train_ensemble_acc,
+            'ensemble_valid_acc': valid_ensemble_acc,
+        }
+        return tolog, new_weight_tensor
+
+    def reset_caches(self):
+        '''
+        drop the incremental label set scores (rebuilt by a full scan on the next visit of each template). They are not
+        part of a checkpoint, so the run drops them whenever it saves one, and a resumed run makes the same rounding as
+        the run it continues. The candidate wrong flags are not dropped: they give the same errors as a new evaluation.
+        '''
+        self.label_set_scores.clear()
+
+    def get_candidate_size(self, num_candidates):
+        if self.adaboost_maximum_epoch > num_candidates:
+            print(f"change maxmium epochs from {self.adaboost_maximum_epoch} to {num_candidates}")
+            return num_candidates
+        return self.adaboost_maximum_epoch
+
+    def loop_search(self, vtuning_model, class_token_indices, train_probs, train_labels, weight_tensor):
+        '''
+        the original sequential search: evaluate the sampled candidate verbalizers one at a time
+        '''
         label_token_index_list = []
         label_token_list = []
         for i in range(self.num_classes):
@@ -192,11 +568,7 @@ class PromptBoostingTrainer(BaseMuticlsTrainer):
                 extended_verbalizer_pairs.append(reverse_pair)
             verbalizer_pairs = extended_verbalizer_pairs
 
-        if self.adaboost_maximum_epoch > len(verbalizer_pairs):
-            print(f"change maxmium epochs from {self.adaboost_maximum_epoch} to {len(verbalizer_pairs)}")
-            candidate_size = len(verbalizer_pairs)
-        else:
-            candidate_size = self.adaboost_maximum_epoch
+        candidate_size = self.get_candidate_size(len(verbalizer_pairs))
         selected_ids = np.random.choice(len(verbalizer_pairs), candidate_size, replace = False)
         
         best_error = 1
@@ -227,18 +599,25 @@ class PromptBoostingTrainer(BaseMuticlsTrainer):
         print(f"error range: {best_error}-{worst_error}")
         return best_verbalizer, best_error,best_acc, best_wrong_flags,best_pred_labels
 
-    def inference(self, eval_probs, verbalizer, eval_labels, weight_tensor):
-        acc, pred_labels, logits = self.compute_acc(eval_probs, verbalizer, eval_labels, visualize = False)
+    def inference(self, eval_probs, verbalizer, eval_labels, weight_tensor, sync = True):
+        acc, pred_labels, logits = self.compute_acc(eval_probs, verbalizer, eval_labels, visualize = False, sync = sync)
         wrong_flags = (pred_labels != eval_labels).float()
-        error = torch.sum(wrong_flags * weight_tensor).item()
+        error = torch.sum(wrong_flags * weight_tensor)
+        if sync:
+            error = error.item()
         return wrong_flags, error, acc, pred_labels, logits
 
-    def compute_acc(self, eval_probs, verbalizer: List[int], eval_labels, visualize = False):
-        verbalizer_idxs = torch.LongTensor(verbalizer)
-        logits = eval_probs[:, verbalizer_idxs]
+    def compute_acc(self, eval_probs, verbalizer: List[int], eval_labels, visualize = False, sync = True):
+        '''
+        verbalizer: token ids (a list or a tensor). sync: return the accuracy as a python float, otherwise as a tensor
+        '''
+        verbalizer_idxs = torch.as_tensor(verbalizer).long()
+        logits = as_prob_store(eval_probs).gather(verbalizer_idxs).to(eval_labels.device)
         pred_labels = torch.argmax(logits, dim = 1).int()
         corr = (pred_labels == eval_labels).sum()
-        acc = (corr / pred_labels.size(0)).item()
+        acc = corr / pred_labels.size(0)
+        if sync:
+            acc = acc.item()
         if visualize:
             print(f"\ttotal {pred_labels.size(0)}, correct {corr}, accuracy {acc}")
         return acc, pred_labels, logits
@@ -251,8 +630,42 @@ class PromptBoostingTrainer(BaseMuticlsTrainer):
 
         return acc, pred_labels, logits
 
+    def stream_verbalizer_predictions(self, vtuning_model, template, eval_dataset, label_token_tensor: torch.LongTensor,
+                                      pred_labels_by_model: torch.LongTensor, model_ids: torch.LongTensor, batch_size = None):
+        '''
+        Forward passes over eval_dataset chunk by chunk. Each chunk is immediately reduced to the verbalizer columns of the
+        weak learners (label_token_tensor: num_weak_learner * num_classes), the predictions of the weak learners are written
+        into pred_labels_by_model[model_ids, chunk], and the distribution over the vocabulary is discarded. Peak memory does
+        not depend on the size of eval_dataset.
+        return: the gathered columns, num_examples * (num_weak_learner * num_classes)
+        '''
+        sentence_list, _ = eval_dataset
+        if batch_size == None:
+            batch_size = BATCH_SIZE
+        num_weak_learner = label_token_tensor.size(0)
+        flat_token_ids = label_token_tensor.view(-1)
+        all_columns = []
+        for start in tqdm.tqdm(range(0, len(sentence_list), batch_size)):
+            batch_input = sentence_list[start: start + batch_size]
+            with torch.no_grad():
+                model_output = vtuning_model.predict(batch_input, template, False)
+            if self.use_logits:
+                columns = model_output.all_token_logits.index_select(dim = 1, index = flat_token_ids)
+            else:
+                columns = model_output.all_token_probs.index_select(dim = 1, index = flat_token_ids)
+            del model_output
+            columns = columns.detach().float()
+            chunk_preds = torch.argmax(columns.view(-1, num_weak_learner, self.num_classes), dim = -1).transpose(0,1)
+            pred_labels_by_model[model_ids, start: start + columns.size(0)] = chunk_preds.long()
+            all_columns.append(columns)
+        return torch.cat(all_columns, dim = 0)
+
     def final_eval(self, test_dataset: List, vtuning_model: RoBERTaVTuningClassification, template_list: List[SentenceTemplate],
-                    saver: TestPredictionSaver):
+                    saver: TestPredictionSaver, streaming = False):
+        '''
+        streaming: on a cache miss, make the forward passes chunk by chunk and keep only the verbalizer columns (see
+        stream_verbalizer_predictions) instead of computing and caching the full test distribution of the template.
+        '''
         word2idx = vtuning_model.word2idx
         num_examples = len(test_dataset[0])
         test_labels = torch.LongTensor(test_dataset[1]).to(vtuning_model.device)
@@ -267,20 +680,28 @@ class PromptBoostingTrainer(BaseMuticlsTrainer):
             verbalizers = [self.verbalizer_list[x] for x in model_ids]
             label_token_list = [[word2idx[verbalizer[i]] for i in range(self.num_classes)] for verbalizer in verbalizers]
             label_token_tensor = torch.LongTensor(label_token_list).to(vtuning_model.device)  ## num_weak_learner, num_classes
-            cls_scores, flag = saver.load_preds(curr_template)
+            model_ids = torch.LongTensor(model_ids).to(vtuning_model.device)
+            cls_predictions, flag = saver.load_columns(curr_template, label_token_tensor.view(-1))
             # assert flag
+            if not flag and streaming:
+                print(f"Did not find LM's predictions on test set. Streaming forward passes on test set...")
+                cls_predictions = self.stream_verbalizer_predictions(vtuning_model, curr_template, test_dataset, label_token_tensor,
+                                                                     all_pred_labels, model_ids)
+                saver.save_projection(curr_template, label_token_tensor.view(-1), cls_predictions)
+                continue
             if not flag:
                 print(f"Did not find LM's predictions on test set. Making forward passes on test set...")
-                cls_scores = self.pre_compute_logits(vtuning_model, curr_template, test_dataset)
+                cls_scores = self.pre_compute_logits(vtuning_model, curr_template, test_dataset, store_path = saver.get_store_prefix(curr_template))
                 saver.save_preds(curr_template, cls_scores)
-            cls_predictions = cls_scores.index_select(dim = 1, index = label_token_tensor.view(-1))
+                cls_predictions = as_prob_store(cls_scores).gather(label_token_tensor.view(-1))
+                saver.save_projection(curr_template, label_token_tensor.view(-1), cls_predictions)
+                del cls_scores
+            cls_predictions = cls_predictions.to(vtuning_model.device)
             cls_predictions = cls_predictions.view(num_examples, num_weak_learner, self.num_classes)
             pred_labels = torch.argmax(cls_predictions, dim = -1).transpose(0,1) ## num_weak_learner, num_exmaples
-            del cls_scores
 
-            model_ids = torch.LongTensor(model_ids).to(vtuning_model.device)
             all_pred_labels[model_ids,:] = pred_labels
-        self.test_labels_by_model = all_pred_labels
+        self.ensembles['test'].set_predictions(all_pred_labels, self.get_model_weights(self.best_epoch, device = all_pred_labels.device))
         acc = self.ensemble_result(test_labels, split = 'test', ensemble_num = self.best_epoch)
         return acc
 
@@ -0,0 +1,109 @@
+import os
+import shutil
+import torch
+
+from .prob_store import STORAGE_MODES, DEFAULT_TOPK, CHUNK_SIZE
+
+GB = 1024 ** 3
+
+def store_bytes(num_examples, vocab_size, mode = 'dense', topk = DEFAULT_TOPK):
+    '''
+    bytes used by the cached probabilities of num_examples examples in the given storage mode
+    '''
+    if mode == 'dense':
+        return num_examples * vocab_size * 4
+    elif mode in ['half', 'mmap']:
+        return num_examples * vocab_size * 2
+    elif mode == 'topk':
+        return num_examples * min(topk, vocab_size) * 6    ## float16 value + int32 token id
+    else:
+        raise NotImplementedError
+
+def estimate_footprint(num_train, num_valid, num_test, vocab_size, num_templates, num_weak_cls = 200,
+                       mode = 'dense', topk = DEFAULT_TOPK, stream_test = False, num_resident_templates = 1):
+    '''
+    memory: the train/valid stores of the template being used, the test store of the template being evaluated,
+            the temporaries of label set scoring and pre_compute_logits, and the ensemble state
+            (predictions of every weak learner on every split + the recorded dataset weights of every round)
+    disk:   the train/valid stores of every template + the test stores of every template
+    stream_test: the test set is evaluated chunk by chunk and its distribution is neither resident nor cached
+    num_resident_templates: the number of templates whose train/valid stores are resident at the same time (joint selection)
+    '''
+    num_stored = num_train + num_valid + (0 if stream_test else num_test)
+    num_resident = num_train + num_valid + num_test
+    largest_split = max(num_train, num_valid, 0 if stream_test else num_test)
+    if mode == 'mmap':
+        resident = 0
+    else:
+        resident = store_bytes(num_stored, vocab_size, mode, topk) \
+                   + (num_resident_templates - 1) * store_bytes(num_train + num_valid, vocab_size, mode, topk)
+    if mode in ['dense', 'half']:
+        workspace = 2 * largest_split * vocab_size * 4
+    else:
+        workspace = 2 * min(CHUNK_SIZE, largest_split) * vocab_size * 4
+    ensemble = num_weak_cls * num_resident + num_weak_cls * num_train * 4    ## int8 predictions, float32 dataset weights
+    disk = num_templates * store_bytes(num_stored, vocab_size, mode, topk)
+    return {'resident': resident, 'workspace': workspace, 'ensemble': ensemble,
+            'memory': resident + workspace + ensemble, 'disk': disk}
+
+def get_memory_budget(device):
+    '''
+    the cached probabilities live on the same device as the LM. For GPUs, the LM weights are already allocated.
+    '''
+    if device.type == 'cuda':
+        total_memory = torch.cuda.get_device_properties(device).total_memory
+        return int((total_memory - torch.cuda.memory_reserved(device)) * 0.9)
+    return int(os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE') * 0.9)
+
+def get_disk_budget(path):
+    path = os.path.abspath(path)
+    while not os.path.exists(path):
+        path = os.path.dirname(path)
+    return shutil.disk_usage(path).free
+
+class StoragePlan():
+    def __init__(self, mode, topk, footprints, memory_budget, disk_budget):
+        self.mode = mode
+        self.topk = topk
+        self.footprints = footprints
+        self.memory_budget = memory_budget
+        self.disk_budget = disk_budget
+
+    def describe(self):
+        lines = [f"memory budget {self.memory_budget / GB:.2f} GB, disk budget {self.disk_budget / GB:.2f} GB"]
+        for mode, footprint in self.footprints.items():
+            fits = footprint['memory'] <= self.memory_budget and footprint['disk'] <= self.disk_budget
+            lines.append(f"\t{mode:>5}: memory {footprint['memory'] / GB:.2f} GB (stores {footprint['resident'] / GB:.2f}, "
+                         f"workspace {footprint['workspace'] / GB:.2f}, ensemble {footprint['ensemble'] / GB:.2f}), "
+                         f"disk {footprint['disk'] / GB:.2f} GB{'' if fits else '  -- does not fit'}")
+        return "\n".join(lines)
+
+def plan_storage(num_train, num_valid, num_test, vocab_size, num_templates, num_weak_cls = 200,
+                 storage_mode = 'auto', topk = DEFAULT_TOPK, device = torch.device('cuda'), cache_dir = '',
+                 memory_budget = 0, disk_budget = 0, stream_test = False, num_resident_templates = 1):
+    '''
+    Pre-flight check before any forward pass: estimate the footprint of the cached stores and the ensemble state for
+    every storage mode and pick the first feasible one among dense, half, topk and mmap.
+    storage_mode:   'auto' or one of STORAGE_MODES to force a mode (still checked against the budgets)
+    memory_budget, disk_budget: in bytes. 0 means detecting them from the device and from the file system of cache_dir.
+    '''
+    assert storage_mode == 'auto' or storage_mode in STORAGE_MODES, f"unknown storage mode {storage_mode}"
+    if memory_budget <= 0:
+        memory_budget = get_memory_budget(device)
+    if disk_budget <= 0:
+        disk_budget = get_disk_budget(cache_dir if cache_dir != '' else os.getcwd())
+
+    candidate_modes = STORAGE_MODES if storage_mode == 'auto' else [storage_mode]
+    footprints = {mode: estimate_footprint(num_train, num_valid, num_test, vocab_size, num_templates, num_weak_cls, mode, topk, stream_test,
+                                           num_resident_templates)
+                  for mode in candidate_modes}
+    for mode in candidate_modes:
+        footprint = footprints[mode]
+        if footprint['memory'] <= memory_budget and footprint['disk'] <= disk_budget:
+            plan = StoragePlan(mode, topk, footprints, memory_budget, disk_budget)
+            print(f"storage plan: using {mode} stores\n{plan.describe()}")
+            return plan
+    plan = StoragePlan(None, topk, footprints, memory_budget, disk_budget)
+    raise RuntimeError(f"no storage mode fits {num_train}/{num_valid}/{num_test} train/valid/test examples, vocabulary size {vocab_size} "
+                       f"and {num_templates} templates:\n{plan.describe()}\n"
+                       f"reduce the number of templates, use a smaller --store_topk, or free memory/disk space.")
@@ -0,0 +1,395 @@
+import os
+import tempfile
+import numpy as np
+import torch
+
+STORAGE_MODES = ['dense', 'half', 'topk', 'mmap']
+STORE_LAYOUTS = ['example', 'token']
+DEFAULT_TOPK = 1000
+CHUNK_SIZE = 1024
+
+class ProbStore():
+    '''
+    ProbStore: the cached output distribution of the LM over the vocabulary (num_examples * vocab_size) for one template
+    on one split. Depending on the storage mode, the distribution is kept as:
+        dense:  float32 tensor on the device (the same as the tensor returned by pre_compute_logits)
+        half:   float16 tensor on the device
+        topk:   only the top-k probabilities (and their token ids) of each example. The other entries are treated as 0.
+        mmap:   float16 array in a memory-mapped file on disk. Rows are paged in on demand.
+    The trainer only touches the cached probabilities through gather() and iter_chunks(), so the storage mode is transparent to it.
+    The mmap mode is the out-of-core mode: the label set scores and the candidate errors are accumulated over chunks of
+    CHUNK_SIZE examples (iter_chunks, iter_columns), so the memory does not grow with the number of examples times the vocabulary.
+
+    layout:
+        example: example-major (num_examples * vocab_size), the layout returned by the LM.
+        token:   token-major (vocab_size * num_examples). Every hot access is a gather of a few hundred token columns
+                 (verbalizer candidates), which becomes a read of contiguous rows. For the topk mode, the kept entries are
+                 grouped by token id (indptr[token_id]: indptr[token_id + 1] in indices/values, indices being example ids).
+    '''
+    def __init__(self, mode = 'dense', data = None, indices = None, values = None, num_examples = 0, vocab_size = 0,
+                 device = torch.device('cuda'), path = None, layout = 'example', indptr = None):
+        assert mode in STORAGE_MODES, f"unknown storage mode {mode}"
+        assert layout in STORE_LAYOUTS, f"unknown layout {layout}"
+        self.mode = mode
+        self.layout = layout
+        self.data = data
+        self.indices = indices
+        self.values = values
+        self.indptr = indptr
+        self.num_examples = num_examples
+        self.vocab_size = vocab_size
+        self.device = device
+        self.path = path
+
+    def __len__(self):
+        return self.num_examples
+
+    def size(self, dim = None):
+        shape = torch.Size([self.num_examples, self.vocab_size])
+        if dim is None:
+            return shape
+        return shape[dim]
+
+    def nbytes(self):
+        if self.mode == 'topk':
+            return self.indices.element_size() * self.indices.nelement() + self.values.element_size() * self.values.nelement()
+        elif self.mode == 'mmap':
+            return 0
+        return self.data.element_size() * self.data.nelement()
+
+    def gather(self, token_ids):
+        '''
+        return the probabilities of the given token ids for all the examples: num_examples * len(token_ids)
+        '''
+        token_ids = torch.as_tensor(token_ids).long().view(-1)
+        if self.mode in ['dense', 'half']:
+            if self.layout == 'token':
+                return self.data[token_ids.to(self.data.device)].t().contiguous().float()
+            return self.data[:, token_ids.to(self.data.device)].float()
+        elif self.mode == 'mmap':
+            if self.layout == 'token':
+                columns = np.ascontiguousarray(self.data[token_ids.cpu().numpy()].T)
+                return torch.from_numpy(columns).to(self.device).float()
+            return torch.cat([columns for _, columns in self.iter_columns(token_ids)], dim = 0)
+        unique_ids, inverse = torch.unique(token_ids, return_inverse = True)
+        output = torch.zeros([self.num_examples, unique_ids.size(0)], dtype = torch.float32, device = self.values.device)
+        if self.layout == 'token':
+            for column, token_id in enumerate(unique_ids.tolist()):
+                start, end = self.indptr[token_id].item(), self.indptr[token_id + 1].item()
+                output[self.indices[start:end].long(), column] = self.values[start:end].float()
+        else:
+            ## look up the position of each kept token id among the requested ones, CHUNK_SIZE rows at a time
+            unique_ids = unique_ids.to(self.indices.device)
+            lookup = torch.full([self.vocab_size], -1, dtype = torch.long, device = self.indices.device)
+            lookup[unique_ids] = torch.arange(unique_ids.size(0), device = self.indices.device)
+            for start in range(0, self.num_examples, CHUNK_SIZE):
+                end = min(start + CHUNK_SIZE, self.num_examples)
+                columns = lookup[self.indices[start:end].long()]
+                hit = columns >= 0
+                rows = torch.arange(start, end, device = self.indices.device).view(-1, 1).expand_as(columns)
+                output[rows[hit], columns[hit]] = self.values[start:end][hit].float()
+        return output[:, inverse.to(output.device)]
+
+    def get_rows(self, start, end):
+        if self.mode in ['dense', 'half']:
+            if self.layout == 'token':
+                return self.data[:, start:end].t().float()
+            return self.data[start:end].float()
+        elif self.mode == 'mmap':
+            if self.layout == 'token':
+                rows = np.ascontiguousarray(self.data[:, start:end].T)
+            else:
+                rows = np.ascontiguousarray(self.data[start:end])
+            return torch.from_numpy(rows).to(self.device).float()
+        chunk = torch.zeros([end - start, self.vocab_size], dtype = torch.float32, device = self.values.device)
+        if self.layout == 'token':
+            token_ids = torch.repeat_interleave(torch.arange(self.vocab_size), self.indptr[1:] - self.indptr[:-1]).to(self.values.device)
+            in_chunk = (self.indices >= start) & (self.indices < end)
+            chunk[self.indices[in_chunk].long() - start, token_ids[in_chunk]] = self.values[in_chunk].float()
+        else:
+            chunk.scatter_(1, self.indices[start:end].long(), self.values[start:end].float())
+        return chunk
+
+    def select_rows(self, example_ids):
+        '''
+        return the full distributions of the given examples: len(example_ids) * vocab_size float32
+        '''
+        example_ids = torch.as_tensor(example_ids).long().view(-1)
+        if self.mode in ['dense', 'half']:
+            example_ids = example_ids.to(self.data.device)
+            if self.layout == 'token':
+                return self.data[:, example_ids].t().float()
+            return self.data[example_ids].float()
+        elif self.mode == 'mmap':
+            example_ids = example_ids.cpu().numpy()
+            if self.layout == 'token':
+                rows = np.ascontiguousarray(self.data[:, example_ids].T)
+            else:
+                rows = np.ascontiguousarray(self.data[example_ids])
+            return torch.from_numpy(rows).to(self.device).float()
+        rows = torch.zeros([example_ids.size(0), self.vocab_size], dtype = torch.float32, device = self.values.device)
+        example_ids = example_ids.to(self.indices.device)
+        if self.layout == 'token':
+            lookup = torch.full([self.num_examples], -1, dtype = torch.long, device = self.indices.device)
+            lookup[example_ids] = torch.arange(example_ids.size(0), device = self.indices.device)
+            token_ids = torch.repeat_interleave(torch.arange(self.vocab_size), self.indptr[1:] - self.indptr[:-1]).to(self.values.device)
+            positions = lookup[self.indices.long()]
+            hit = positions >= 0
+            rows[positions[hit], token_ids[hit]] = self.values[hit].float()
+        else:
+            rows.scatter_(1, self.indices[example_ids].long(), self.values[example_ids].float())
+        return rows
+
+    def iter_chunks(self, chunk_size = None):
+        '''
+        yield (start_index, float32 tensor of chunk_size * vocab_size) over the examples.
+        Resident example-major stores (dense/half) are returned in one chunk unless chunk_size is given.
+        '''
+        if chunk_size is None:
+            if self.mode == 'dense' and self.layout == 'example':
+                yield 0, self.data
+                return
+            chunk_size = max(self.num_examples, 1) if self.mode in ['dense', 'half'] else CHUNK_SIZE
+        for start in range(0, self.num_examples, chunk_size):
+            end = min(start + chunk_size, self.num_examples)
+            yield start, self.get_rows(start, end)
+
+    def is_resident(self):
+        return self.mode != 'mmap'
+
+    def iter_columns(self, token_ids, chunk_size = None):
+        '''
+        yield (start_index, float32 tensor of chunk_size * len(token_ids)): gather() over chunks of examples.
+        An example-major mmap store is read one block of consecutive rows at a time (sequential reads, and only chunk_size
+        rows are paged in); the other stores are gathered in one chunk unless chunk_size is given.
+        '''
+        token_ids = torch.as_tensor(token_ids).long().view(-1)
+        if chunk_size is None:
+            if self.is_resident() or self.layout == 'token':
+                yield 0, self.gather(token_ids)
+                return
+            chunk_size = CHUNK_SIZE
+        numpy_ids = token_ids.cpu().numpy()
+        for start in range(0, self.num_examples, chunk_size):
+            end = min(start + chunk_size, self.num_examples)
+            if self.mode == 'mmap' and self.layout == 'example':
+                columns = torch.from_numpy(np.ascontiguousarray(self.data[start:end][:, numpy_ids])).to(self.device).float()
+            else:
+                rows = self.get_rows(start, end)
+                columns = rows[:, token_ids.to(rows.device)]
+            yield start, columns
+
+    def to_tensor(self):
+        if self.mode == 'dense' and self.layout == 'example':
+            return self.data
+        return torch.cat([chunk for _, chunk in self.iter_chunks(chunk_size = CHUNK_SIZE)], dim = 0)
+
+    def save(self, path_prefix):
+        '''
+        return: the path of the saved file
+        '''
+        if self.mode == 'mmap':
+            save_path = get_mmap_path(path_prefix, self.layout)
+            if self.path != save_path:
+                np.save(save_path, self.data)
+            return save_path
+        state = {'mode': self.mode, 'layout': self.layout, 'num_examples': self.num_examples, 'vocab_size': self.vocab_size}
+        if self.mode == 'topk':
+            state['indices'] = self.indices
+            state['values'] = self.values
+            state['indptr'] = self.indptr
+        else:
+            state['data'] = self.data
+        torch.save(state, path_prefix + '.pt')
+        return path_prefix + '.pt'
+
+class ProbStoreWriter():
+    '''
+    Build a ProbStore batch by batch, so that pre_compute_logits never holds the full float32 distribution of a split
+    in the non-dense storage modes. The vocabulary size is taken from the first batch (the output dimension of the LM head
+    can be larger than the tokenizer's vocabulary, e.g., OPT).
+    '''
+    def __init__(self, num_examples, mode = 'dense', topk = DEFAULT_TOPK, path_prefix = None, device = torch.device('cuda'),
+                 layout = 'example'):
+        assert mode in STORAGE_MODES, f"unknown storage mode {mode}"
+        assert layout in STORE_LAYOUTS, f"unknown layout {layout}"
+        self.num_examples = num_examples
+        self.vocab_size = None
+        self.mode = mode
+        self.layout = layout
+        self.topk = topk
+        self.path_prefix = path_prefix
+        self.device = device
+        self.curr_index = 0
+        self.batches = []
+
+    def open_mmap(self):
+        if self.path_prefix is None:
+            self.path_prefix = os.path.join(tempfile.mkdtemp(prefix = 'prob_store_'), 'probs')
+        self.path = get_mmap_path(self.path_prefix, self.layout)
+        shape = (self.num_examples, self.vocab_size) if self.layout == 'example' else (self.vocab_size, self.num_examples)
+        self.data = np.lib.format.open_memmap(self.path, mode = 'w+', dtype = np.float16, shape = shape)
+
+    def append(self, batch_probs: torch.Tensor):
+        batch_size = batch_probs.size(0)
+        if self.vocab_size is None:
+            self.vocab_size = batch_probs.size(1)
+            self.topk = min(self.topk, self.vocab_size)
+            if self.mode == 'mmap':
+                self.open_mmap()
+        if self.mode == 'dense':
+            self.batches.append(batch_probs)
+        elif self.mode == 'half':
+            self.batches.append(batch_probs.half())
+        elif self.mode == 'topk':
+            values, indices = torch.topk(batch_probs, k = self.topk, dim = 1)
+            self.batches.append((indices.int(), values.half()))
+        elif self.layout == 'token':
+            self.data[:, self.curr_index: self.curr_index + batch_size] = batch_probs.half().cpu().numpy().T
+        else:
+            self.data[self.curr_index: self.curr_index + batch_size] = batch_probs.half().cpu().numpy()
+        self.curr_index += batch_size
+
+    def finish(self) -> ProbStore:
+        assert self.curr_index == self.num_examples, f"{self.curr_index} -- {self.num_examples}"
+        if self.mode in ['dense', 'half']:
+            data = torch.cat(self.batches, dim = 0)
+            if self.layout == 'token':
+                data = data.t().contiguous()
+            return ProbStore(mode = self.mode, data = data, num_examples = self.num_examples,
+                             vocab_size = self.vocab_size, device = self.device, layout = self.layout)
+        elif self.mode == 'topk':
+            indices = torch.cat([x[0] for x in self.batches], dim = 0)
+            values = torch.cat([x[1] for x in self.batches], dim = 0)
+            indptr = None
+            if self.layout == 'token':
+                indices, values, indptr = to_token_major_topk(indices, values, self.vocab_size)
+            return ProbStore(mode = 'topk', indices = indices, values = values, num_examples = self.num_examples,
+                             vocab_size = self.vocab_size, device = self.device, layout = self.layout, indptr = indptr)
+        self.data.flush()
+        del self.data
+        return load_prob_store(self.path_prefix, device = self.device)
+
+class ProjectedStore():
+    '''
+    ProjectedStore: the columns of a ProbStore for a small set of token ids (token id -> column), e.g. the verbalizer tokens
+    chosen by the weak learners. It is all that is needed to re-evaluate a trained ensemble, and takes kilobytes instead of
+    the gigabytes of the full distribution.
+    '''
+    def __init__(self, token_ids = None, columns = None):
+        self.token_ids = token_ids if token_ids is not None else torch.LongTensor([])
+        self.columns = columns
+
+    def __len__(self):
+        return self.token_ids.size(0)
+
+    def contains(self, token_ids):
+        token_ids = torch.as_tensor(token_ids).long().view(-1).cpu()
+        return bool(torch.isin(token_ids, self.token_ids.cpu()).all())
+
+    def gather(self, token_ids):
+        token_ids = torch.as_tensor(token_ids).long().view(-1).cpu()
+        column_index = {token_id: i for i, token_id in enumerate(self.token_ids.tolist())}
+        positions = torch.LongTensor([column_index[x] for x in token_ids.tolist()]).to(self.columns.device)
+        return self.columns.index_select(dim = 1, index = positions)
+
+    def update(self, token_ids, columns):
+        '''
+        add the columns of new token ids (num_examples * len(token_ids)). Token ids already in the store are skipped.
+        '''
+        token_ids = torch.as_tensor(token_ids).long().view(-1).cpu()
+        unique_ids, first_position = [], {}
+        for i, token_id in enumerate(token_ids.tolist()):
+            if token_id not in first_position:
+                first_position[token_id] = i
+                unique_ids.append(token_id)
+        new_ids = [x for x in unique_ids if not (self.token_ids == x).any()]
+        if len(new_ids) == 0:
+            return
+        new_columns = columns[:, [first_position[x] for x in new_ids]].float()
+        if self.columns is None:
+            self.columns = new_columns
+        else:
+            self.columns = torch.cat([self.columns, new_columns.to(self.columns.device)], dim = 1)
+        self.token_ids = torch.cat([self.token_ids.cpu(), torch.LongTensor(new_ids)])
+
+    def save(self, path):
+        torch.save({'token_ids': self.token_ids.cpu(), 'columns': self.columns}, path)
+
+def load_projected_store(path, device = torch.device('cuda')):
+    if not os.path.exists(path):
+        return ProjectedStore()
+    state = torch.load(path, map_location = device)
+    return ProjectedStore(state['token_ids'], state['columns'])
+
+def to_token_major_topk(indices, values, vocab_size):
+    '''
+    group the kept (example, token) entries of a top-k store by token id.
+    return: example ids and values sorted by token id, and indptr (vocab_size + 1) on the CPU
+    '''
+    num_examples, topk = indices.size()
+    example_ids = torch.arange(num_examples, device = indices.device).view(-1, 1).expand(num_examples, topk).reshape(-1)
+    flat_token_ids = indices.reshape(-1).long()
+    order = torch.argsort(flat_token_ids)
+    counts = torch.bincount(flat_token_ids, minlength = vocab_size).cpu()
+    indptr = torch.zeros(vocab_size + 1, dtype = torch.long)
+    indptr[1:] = torch.cumsum(counts, dim = 0)
+    return example_ids[order].int(), values.reshape(-1)[order], indptr
+
+def as_prob_store(probs) -> ProbStore:
+    '''
+    wrap the raw tensor returned by pre_compute_logits (or loaded from an old cache file) as a dense store
+    '''
+    if isinstance(probs, ProbStore):
+        return probs
+    return ProbStore(mode = 'dense', data = probs, num_examples = probs.size(0), vocab_size = probs.size(1), device = probs.device)
+
+def to_prob_store(probs, mode = 'dense', topk = DEFAULT_TOPK, layout = 'example', path_prefix = None, device = torch.device('cuda')):
+    '''
+    build a store of the given mode from a dense num_examples * vocab_size tensor (e.g. an old pickled cache), CHUNK_SIZE rows at a time
+    '''
+    writer = ProbStoreWriter(probs.size(0), mode = mode, topk = topk, path_prefix = path_prefix, device = device, layout = layout)
+    for start in range(0, probs.size(0), CHUNK_SIZE):
+        writer.append(probs[start: start + CHUNK_SIZE].to(device).float())
+    return writer.finish()
+
+def delete_prob_store(store):
+    '''
+    remove the file of a memory-mapped store that is no longer needed (the other stores have no file)
+    '''
+    if isinstance(store, ProbStore) and store.mode == 'mmap' and store.path is not None:
+        store.data = None
+        if os.path.exists(store.path):
+            os.remove(store.path)
+
+def get_mmap_path(path_prefix, layout = 'example'):
+    if layout == 'token':
+        return path_prefix + '.token.npy'
+    return path_prefix + '.npy'
+
+def get_store_paths(path_prefix):
+    '''
+    all the files a store saved under path_prefix can be in
+    '''
+    return [get_mmap_path(path_prefix), get_mmap_path(path_prefix, 'token'), path_prefix + '.pt']
+
+def prob_store_exists(path_prefix):
+    return any([os.path.exists(x) for x in get_store_paths(path_prefix)])
+
+def load_prob_store(path_prefix, device = torch.device('cuda')):
+    for layout in STORE_LAYOUTS:
+        mmap_path = get_mmap_path(path_prefix, layout)
+        if os.path.exists(mmap_path):
+            data = np.load(mmap_path, mmap_mode = 'r')
+            num_examples, vocab_size = data.shape if layout == 'example' else data.shape[::-1]
+            return ProbStore(mode = 'mmap', data = data, num_examples = num_examples, vocab_size = vocab_size,
+                             device = device, path = mmap_path, layout = layout)
+    if os.path.exists(path_prefix + '.pt'):
+        state = torch.load(path_prefix + '.pt', map_location = device)
+        indptr = state.get('indptr')
+        if indptr is not None:
+            indptr = indptr.cpu()
+        return ProbStore(mode = state['mode'], data = state.get('data'), indices = state.get('indices'), values = state.get('values'),
+                         num_examples = state['num_examples'], vocab_size = state['vocab_size'], device = device,
+                         layout = state.get('layout', 'example'), indptr = indptr)
+    return None
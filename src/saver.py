@@ -2,17 +2,72 @@ import numpy as np
 import os
 from .utils import ROOT_DIR
 from .template import SentenceTemplate
+from .prob_store import ProbStore, prob_store_exists, load_prob_store, as_prob_store, load_projected_store, get_store_paths, \
+    to_prob_store, DEFAULT_TOPK
+from .cache_backend import CacheBackend
 import pickle
+import hashlib
 import torch
 
-class PredictionSaver():
+class SharedCacheSaver():
+    '''
+    Optional shared cache (see src/cache_backend.py): files written under save_dir are published to the backend, and files
+    missing locally are fetched from it before being loaded; a file that exists locally is never replaced by the remote copy.
+    The cache key of a file is "<cache_namespace>/<path relative to ROOT_DIR>", so the files of different datasets and cache
+    directories (e.g. cached_test_preds/sst/ and cached_test_preds/trec/) do not collide.
+    '''
+    cache_namespace = ''
+
+    def __init__(self, backend: CacheBackend = None):
+        self.backend = backend
+
+    def get_cache_key(self, path):
+        path = os.path.abspath(path)
+        relative_path = os.path.relpath(path, os.path.abspath(ROOT_DIR))
+        if relative_path.startswith('..'):
+            relative_path = path.lstrip(os.sep)    ## outside ROOT_DIR: the absolute path
+        return '/'.join([self.cache_namespace] + relative_path.split(os.sep))
+
+    def push_file(self, path):
+        if self.backend is not None and path is not None:
+            self.backend.put_file(self.get_cache_key(path), path)
+
+    def pull_files(self, paths):
+        '''
+        bulk fetch the given files from the backend unless one of them already exists locally
+        '''
+        if self.backend is None or any([os.path.exists(x) for x in paths]):
+            return
+        found = self.backend.fetch_many({self.get_cache_key(x): x for x in paths})
+        if len(found) > 0:
+            print(f"fetched {found} from the shared cache")
+
+    def convert_dense(self, probs, path_prefix):
+        '''
+        store dense predictions (e.g. a pickle written by a dense run, or before the storage modes) as a store of the storage
+        mode of the saver under path_prefix, so that they are converted once and then loaded in that mode
+        '''
+        store = to_prob_store(as_prob_store(probs).data, self.storage_mode, self.store_topk, self.store_layout, path_prefix, self.device)
+        self.push_file(store.save(path_prefix))
+        return store
+
+class PredictionSaver(SharedCacheSaver):
     '''
     PredictionSaver: We rely on the language model's output prediction over [MASK] token. Note that for the same tempalte, the output
     is always the same and we can reuse it. Therefore, this class is used to cache the output prediction of LMs for weak learner training.
     
     This saver only save train/validation prediction. For test set prediction, we use TestPredictionSaver.
+
+    In the dense storage mode, the predictions are pickled as before. In the other storage modes (see src/prob_store.py),
+    each split is saved as its own ProbStore file. In these modes, a pickle found in the cache is converted once into stores
+    of the current mode, which are loaded from then on, so the planned memory footprint holds for old caches as well.
     '''
-    def __init__(self, save_dir = os.path.join(ROOT_DIR,'cached_preds/'), model_name = 'roberta', use_logits = False, fewshot = False, low = False, fewshot_k = 0, fewshot_seed = 0):
+    cache_namespace = 'preds'
+
+    def __init__(self, save_dir = os.path.join(ROOT_DIR,'cached_preds/'), model_name = 'roberta', use_logits = False, fewshot = False, low = False, fewshot_k = 0, fewshot_seed = 0,
+                 storage_mode = 'dense', device = torch.device('cuda'), backend: CacheBackend = None, store_topk = DEFAULT_TOPK,
+                 store_layout = 'example'):
+        super().__init__(backend)
         assert not (fewshot and low), "fewshot and low resource can not be true simutaneously!"
         self.save_dir = save_dir
         self.model_name = model_name
@@ -21,10 +76,14 @@ class PredictionSaver():
         self.low = low
         self.fewshot_k = fewshot_k
         self.fewshot_seed = fewshot_seed
+        self.storage_mode = storage_mode
+        self.store_topk = store_topk
+        self.store_layout = store_layout
+        self.device = device
         if not os.path.exists(self.save_dir):
             os.mkdir(self.save_dir)
 
-    def save_preds(self, template:SentenceTemplate, train_preds, valid_preds):
+    def get_template_name(self, template: SentenceTemplate):
         template_name = template.template_name
         if self.model_name != 'roberta':
             template_name += f"_{self.model_name}"
@@ -32,30 +91,63 @@ class PredictionSaver():
             template_name += f'_fs_{self.fewshot_k}shot_seed{self.fewshot_seed}'
         elif self.low:
             template_name += f'_low{self.fewshot_k}_seed{self.fewshot_seed}'
-        if os.path.exists(os.path.join(self.save_dir, f"{template_name}.pkl")):
+        return template_name
+
+    def get_store_prefix(self, template: SentenceTemplate, split = 'train'):
+        return os.path.join(self.save_dir, f"{self.get_template_name(template)}_{split}")
+
+    def save_preds(self, template:SentenceTemplate, train_preds, valid_preds, overwrite = False):
+        '''
+        overwrite: replace the cached predictions of the template (e.g. extended to a larger training set). Otherwise an
+                   existing pickle is kept.
+        '''
+        template_name = self.get_template_name(template)
+        pickle_path = os.path.join(self.save_dir, f"{template_name}.pkl")
+        if isinstance(train_preds, ProbStore):
+            if overwrite and os.path.exists(pickle_path):
+                os.remove(pickle_path)    ## load_preds reads the pickle first
+            self.push_file(train_preds.save(self.get_store_prefix(template, 'train')))
+            if isinstance(valid_preds, ProbStore):
+                self.push_file(valid_preds.save(self.get_store_prefix(template, 'valid')))
+        elif os.path.exists(pickle_path) and not overwrite:
             print("already exists! Will not save it")
         else:
             with open(os.path.join(self.save_dir, f"{template_name}.pkl"), 'wb') as f:
                 pickle.dump((train_preds, valid_preds), f)
+            self.push_file(os.path.join(self.save_dir, f"{template_name}.pkl"))
     
     def load_preds(self, template: SentenceTemplate):
-        template_name = template.template_name
-        if self.model_name != 'roberta':
-            template_name += f"_{self.model_name}"
-        if self.fewshot:
-            template_name += f'_fs_{self.fewshot_k}shot_seed{self.fewshot_seed}'
-        elif self.low:
-            template_name += f'_low{self.fewshot_k}_seed{self.fewshot_seed}'
-        if os.path.exists(os.path.join(self.save_dir, f"{template_name}.pkl")):
-            with open(os.path.join(self.save_dir, f"{template_name}.pkl"), 'rb') as f:
-                (train_preds, valid_preds) = pickle.load(f)            
+        template_name = self.get_template_name(template)
+        self.pull_files([os.path.join(self.save_dir, f"{template_name}.pkl")] + get_store_paths(self.get_store_prefix(template, 'train')))
+        if prob_store_exists(self.get_store_prefix(template, 'train')):
+            self.pull_files(get_store_paths(self.get_store_prefix(template, 'valid')))
+        pickle_path = os.path.join(self.save_dir, f"{template_name}.pkl")
+        if os.path.exists(pickle_path) and (self.storage_mode == 'dense' or not prob_store_exists(self.get_store_prefix(template, 'train'))):
+            with open(pickle_path, 'rb') as f:
+                (train_preds, valid_preds) = pickle.load(f)
+            if self.storage_mode != 'dense':
+                print(f"converting {pickle_path} to {self.storage_mode} stores")
+                train_preds = self.convert_dense(train_preds, self.get_store_prefix(template, 'train'))
+                if len(valid_preds) > 0:
+                    valid_preds = self.convert_dense(valid_preds, self.get_store_prefix(template, 'valid'))
+            return (train_preds, valid_preds), True
+        elif prob_store_exists(self.get_store_prefix(template, 'train')):
+            train_preds = load_prob_store(self.get_store_prefix(template, 'train'), device = self.device)
+            valid_preds = load_prob_store(self.get_store_prefix(template, 'valid'), device = self.device)
+            if valid_preds is None:
+                valid_preds = []
             return (train_preds, valid_preds), True
         else:
             print(f"did not find file ", os.path.join(self.save_dir, f"{template_name}.pkl"))
             return (), False
 
-class TestPredictionSaver():
-    def __init__(self, save_dir = os.path.join(ROOT_DIR, 'cached_preds/'), model_name = 'roberta', use_logits = False, fewshot = False, fewshot_k = 0, fewshot_seed = 0):
+class TestPredictionSaver(SharedCacheSaver):
+    cache_namespace = 'test_preds'
+
+    def __init__(self, save_dir = os.path.join(ROOT_DIR, 'cached_preds/'), model_name = 'roberta', use_logits = False, fewshot = False, fewshot_k = 0, fewshot_seed = 0,
+                 storage_mode = 'dense', device = torch.device('cuda'), backend: CacheBackend = None, store_topk = DEFAULT_TOPK,
+                 store_layout = 'example'):
+        super().__init__(backend)
         self.save_dir = save_dir
         if not os.path.exists(self.save_dir):
             os.makedirs(self.save_dir, exist_ok = True)
@@ -64,32 +156,171 @@ class TestPredictionSaver():
         self.fewshot = fewshot
         self.fewshot_k = fewshot_k
         self.fewshot_seed = fewshot_seed
+        self.storage_mode = storage_mode
+        self.store_topk = store_topk
+        self.store_layout = store_layout
+        self.device = device
         if not os.path.exists(self.save_dir):
             os.mkdir(self.save_dir)
 
-    def save_preds(self, template:SentenceTemplate, test_preds):
+    def get_template_name(self, template: SentenceTemplate):
         template_name = template.template_name
         if self.model_name != 'roberta':
             template_name += f"_{self.model_name}"
         if self.use_logits:
             template_name += '_logits'
+        return template_name
 
+    def get_store_prefix(self, template: SentenceTemplate):
+        return os.path.join(self.save_dir, f"{self.get_template_name(template)}_test")
+
+    def save_preds(self, template:SentenceTemplate, test_preds):
+        if os.path.exists(self.get_projection_path(template)):
+            os.remove(self.get_projection_path(template))    ## gathered from the previous test predictions
+        if isinstance(test_preds, ProbStore):
+            self.push_file(test_preds.save(self.get_store_prefix(template)))
+            return
+        template_name = self.get_template_name(template)
         save_name = os.path.join(self.save_dir, f"{template_name}.pkl")
         with open(save_name, 'wb') as f:
             pickle.dump(test_preds, f)
+        self.push_file(save_name)
         del test_preds
         torch.cuda.empty_cache() 
     
     def load_preds(self, template: SentenceTemplate):
-        template_name = template.template_name
-        if self.model_name != 'roberta':
-            template_name += f"_{self.model_name}"
-        if self.use_logits:
-            template_name += '_logits'
+        template_name = self.get_template_name(template)
         save_addr = os.path.join(self.save_dir, f"{template_name}.pkl")
-        if not os.path.exists(save_addr):
-            return [], False
+        self.pull_files([save_addr] + get_store_paths(self.get_store_prefix(template)))
+        if not os.path.exists(save_addr) or (self.storage_mode != 'dense' and prob_store_exists(self.get_store_prefix(template))):
+            test_preds = load_prob_store(self.get_store_prefix(template), device = self.device)
+            if test_preds is None:
+                return [], False
+            return test_preds, True
         with open(save_addr, 'rb') as f:
             test_preds = pickle.load(f)
+        if self.storage_mode != 'dense':
+            print(f"converting {save_addr} to a {self.storage_mode} store")
+            test_preds = self.convert_dense(test_preds, self.get_store_prefix(template))
         return test_preds, True
 
+    def get_projection_path(self, template: SentenceTemplate):
+        '''
+        the projected store depends on the precision of the store it was gathered from: half and top-k stores change the columns
+        '''
+        storage_name = f"topk{self.store_topk}" if self.storage_mode == 'topk' else self.storage_mode
+        return os.path.join(self.save_dir, f"{self.get_template_name(template)}_test_proj_{storage_name}.pt")
+
+    def save_projection(self, template: SentenceTemplate, token_ids, columns):
+        '''
+        persist the test set columns of the given token ids (num_test * len(token_ids)) in the projected store of the template
+        '''
+        projected_store = load_projected_store(self.get_projection_path(template), device = self.device)
+        num_before = len(projected_store)
+        projected_store.update(token_ids, columns)
+        if len(projected_store) > num_before:
+            projected_store.save(self.get_projection_path(template))
+            self.push_file(self.get_projection_path(template))
+
+    def merge_remote_projection(self, template: SentenceTemplate):
+        '''
+        other nodes may have added columns to the projected store of the template since the last fetch: the remote copy is
+        downloaded next to the local one and its new columns are added to it (the local columns are kept)
+        '''
+        if self.backend is None:
+            return
+        path = self.get_projection_path(template)
+        remote_path = path + '.remote'
+        if not self.backend.fetch_to_file(self.get_cache_key(path), remote_path):
+            return
+        remote_store = load_projected_store(remote_path, device = self.device)
+        os.remove(remote_path)
+        projected_store = load_projected_store(path, device = self.device)
+        if len(remote_store) == 0:
+            return
+        if projected_store.columns is not None and projected_store.columns.size(0) != remote_store.columns.size(0):
+            print(f"ignoring the shared projection of {template.template_name}: {remote_store.columns.size(0)} examples, "
+                  f"{projected_store.columns.size(0)} locally")
+            return
+        num_before = len(projected_store)
+        projected_store.update(remote_store.token_ids, remote_store.columns)
+        if len(projected_store) > num_before:
+            projected_store.save(path)
+
+    def load_columns(self, template: SentenceTemplate, token_ids):
+        '''
+        Load only the test set columns of the given token ids (num_test * len(token_ids)). The compact projected store is
+        read first. On a miss, the columns are gathered from the full cached predictions and added to the projected store,
+        so the full predictions are read at most once per set of verbalizer tokens.
+        return: (columns, True) or ([], False) if the predictions of the template have never been cached.
+        '''
+        self.merge_remote_projection(template)
+        projected_store = load_projected_store(self.get_projection_path(template), device = self.device)
+        if len(projected_store) > 0 and projected_store.contains(token_ids):
+            return projected_store.gather(token_ids), True
+        test_preds, flag = self.load_preds(template)
+        if not flag:
+            return [], False
+        columns = as_prob_store(test_preds).gather(token_ids)
+        del test_preds
+        self.save_projection(template, token_ids, columns)
+        return columns, True
+
+def get_dataset_key(*datasets):
+    '''
+    a short fingerprint of the examples and labels of the datasets, independent of their order
+    '''
+    digest = hashlib.md5()
+    for sentence_list, label_list in datasets:
+        for item in sorted(repr((sentence, label)) for sentence, label in zip(sentence_list, label_list)):
+            digest.update(item.encode('utf-8'))
+        digest.update(b'|')
+    return digest.hexdigest()[:16]
+
+class VerbalizerMemo(SharedCacheSaver):
+    '''
+    Persistent memo of the weak learner fitted on a template with uniform dataset weights (the first fit on any template), shared
+    by weakcls_training.py, scripts/template_refinement.py and ensemble_training.py. An entry is keyed by the template, the
+    model, a fingerprint of the train/valid examples, the label set size and the search settings, and holds the label set
+    scores (num_classes * vocab_size), the token ids of the best verbalizer, its train error/accuracy and its valid accuracy.
+    The first result computed for a key is kept.
+    '''
+    cache_namespace = 'memo'
+
+    def __init__(self, train_dataset, valid_dataset, save_dir = os.path.join(ROOT_DIR, 'cached_preds/memo/'), model_name = 'roberta',
+                 search_config = '', backend: CacheBackend = None):
+        super().__init__(backend)
+        self.save_dir = save_dir
+        self.model_name = model_name
+        self.search_config = search_config
+        self.dataset_key = get_dataset_key(train_dataset, valid_dataset)
+        if not os.path.exists(self.save_dir):
+            os.makedirs(self.save_dir, exist_ok = True)
+
+    def get_path(self, template: SentenceTemplate, label_set_size):
+        return os.path.join(self.save_dir, f"{template.template_name}_{self.model_name}_{self.dataset_key}_ls{label_set_size}_{self.search_config}.pt")
+
+    def load(self, template: SentenceTemplate, label_set_size):
+        '''
+        return: the entry (a dict) or None
+        '''
+        path = self.get_path(template, label_set_size)
+        self.pull_files([path])
+        if not os.path.exists(path):
+            return None
+        return torch.load(path, map_location = 'cpu')
+
+    def save(self, template: SentenceTemplate, label_set_size, scores, verbalizer_ids, train_error, train_acc, valid_acc):
+        path = self.get_path(template, label_set_size)
+        if os.path.exists(path):
+            return
+        entry = {
+            'scores': scores.float().cpu() if scores is not None else None,
+            'verbalizer': [int(token_id) for token_id in verbalizer_ids],
+            'train_error': float(train_error),
+            'train_acc': float(train_acc),
+            'valid_acc': float(valid_acc),
+        }
+        torch.save(entry, path + '.tmp')
+        os.replace(path + '.tmp', path)
+        self.push_file(path)
@@ -458,6 +458,19 @@ class TemplateManager():
     def get_template(self, index = 0):
         return self.template_list[index]
 
+    def get_current_template(self) -> SentenceTemplate:
+        '''
+        the template returned by the last change_template
+        '''
+        return self.template_list[self.random_indices[self.curr_index - 1]]
+
+    def state_dict(self):
+        return {'curr_index': self.curr_index, 'random_indices': copy.deepcopy(self.random_indices)}
+
+    def load_state_dict(self, state):
+        self.curr_index = state['curr_index']
+        self.random_indices = copy.deepcopy(state['random_indices'])
+
     def change_template(self, prev_template = None) -> SentenceTemplate:
         if not prev_template == None:
             del prev_template
@@ -0,0 +1,402 @@
+import numpy as np
+import torch
+import torch.nn.functional as F
+from typing import List
+
+from src.prob_store import as_prob_store
+
+SEARCH_MODES = ['loop', 'batched', 'exact', 'race']
+SEARCH_BLOCK_ELEMENTS = 1 << 26
+LAZY_SAMPLING_THRESHOLD = 1 << 24
+RACE_INITIAL_SIZE = 256
+RACE_GROWTH = 4
+
+def count_candidates(label_set_size: int, num_classes: int) -> int:
+    num_candidates = label_set_size ** num_classes
+    if num_classes == 2:  ## extend verbalizer
+        num_candidates *= 2
+    return num_candidates
+
+def sample_candidate_indices(num_candidates: int, candidate_size: int) -> np.ndarray:
+    '''
+    sample candidate_size of the num_candidates candidate indices without replacement. Up to LAZY_SAMPLING_THRESHOLD
+    candidates (or when most of them are sampled) this is the same np.random.choice draw as the enumerated search.
+    Above, indices are drawn in batches and the duplicates are rejected, so the memory is proportional to candidate_size.
+    '''
+    if num_candidates <= LAZY_SAMPLING_THRESHOLD or 2 * candidate_size > num_candidates:
+        return np.random.choice(num_candidates, candidate_size, replace = False)
+    assert num_candidates < 2 ** 63, f"{num_candidates} candidates cannot be indexed"
+    selected = np.zeros(0, dtype = np.int64)
+    while len(selected) < candidate_size:
+        draws = np.random.randint(0, num_candidates, size = 2 * (candidate_size - len(selected)), dtype = np.int64)
+        merged = np.concatenate([selected, draws])
+        _, first_index = np.unique(merged, return_index = True)
+        selected = merged[np.sort(first_index)]
+    return selected[:candidate_size]
+
+def decode_candidate_ids(class_token_indices: torch.LongTensor, candidate_indices) -> torch.LongTensor:
+    '''
+    decode candidate indices into verbalizers without materializing the candidates. The index space is the same as
+    itertools.product over the label sets of the classes (num_classes * label_set_size), the last class varying fastest;
+    for binary tasks, the indices after the product are the reversed pairs.
+    return: num_indices * num_classes token ids, on the device of class_token_indices
+    '''
+    num_classes, label_set_size = class_token_indices.size()
+    device = class_token_indices.device
+    indices = torch.as_tensor(candidate_indices, dtype = torch.long).to(device)
+    num_product = label_set_size ** num_classes
+    reverse_flags = indices >= num_product
+    indices = indices % num_product
+    positions = torch.zeros(indices.size(0), num_classes, dtype = torch.long, device = device)
+    for i in reversed(range(num_classes)):
+        positions[:, i] = indices % label_set_size
+        indices = indices // label_set_size
+    candidate_ids = class_token_indices[torch.arange(num_classes, device = device).view(1, -1), positions]
+    if num_classes == 2:  ## extend verbalizer
+        candidate_ids = torch.where(reverse_flags.view(-1, 1), candidate_ids.flip(dims = [1]), candidate_ids)
+    return candidate_ids
+
+def gather_candidate_columns(cache_probs, candidate_ids: torch.LongTensor, device):
+    '''
+    gather the columns of every token used by the candidates at once.
+    return: columns (num_examples * num_unique_tokens), positions (num_candidates * num_classes) of each candidate token in columns
+    '''
+    unique_ids, positions = torch.unique(candidate_ids, return_inverse = True)
+    columns = as_prob_store(cache_probs).gather(unique_ids).to(device)
+    return columns, positions.to(device)
+
+def candidate_errors(columns, positions, labels, weight_tensor, block_size = None, return_flags = False):
+    '''
+    weighted training error of every candidate, evaluated in blocks of candidates as tensor operations.
+    The prediction of a candidate is the argmax over its class tokens, the same as compute_acc.
+    return: num_candidates float tensor on the device of columns (and the bit-packed wrong flags with return_flags)
+    '''
+    num_examples = columns.size(0)
+    num_candidates, num_classes = positions.size()
+    if block_size is None:
+        block_size = max(1, SEARCH_BLOCK_ELEMENTS // max(1, num_examples * num_classes))
+    errors = torch.zeros(num_candidates, dtype = torch.float32, device = columns.device)
+    packed_flags = []
+    for start in range(0, num_candidates, block_size):
+        block_positions = positions[start: start + block_size]    ## block, num_classes
+        logits = columns[:, block_positions]                      ## num_examples, block, num_classes
+        pred_labels = torch.argmax(logits, dim = -1)              ## num_examples, block
+        wrong_flags = (pred_labels != labels.view(-1, 1)).float()
+        errors[start: start + block_positions.size(0)] = torch.sum(wrong_flags.t() * weight_tensor.view(1, -1), dim = 1)
+        if return_flags:
+            packed_flags.append(pack_flags(wrong_flags.t()))
+    if return_flags:
+        return errors, torch.cat(packed_flags, dim = 0)
+    return errors
+
+def streamed_candidate_errors(cache_probs, candidate_ids: torch.LongTensor, labels, weight_tensor, block_size = None,
+                              return_flags = False, chunk_size = None):
+    '''
+    candidate_errors accumulated over chunks of examples (ProbStore.iter_columns), for stores that are not resident (mmap):
+    only chunk_size rows of the candidate columns are on the device at a time. The wrong flags of the chunks are packed
+    separately and joined along the examples, so chunk_size must be a multiple of 8 with return_flags.
+    '''
+    device = weight_tensor.device
+    store = as_prob_store(cache_probs)
+    unique_ids, positions = torch.unique(candidate_ids, return_inverse = True)
+    positions = positions.to(device)
+    labels = labels.to(device)
+    errors = torch.zeros(candidate_ids.size(0), dtype = torch.float32, device = device)
+    packed_flags = []
+    for start, columns in store.iter_columns(unique_ids, chunk_size):
+        end = start + columns.size(0)
+        chunk_errors = candidate_errors(columns.to(device), positions, labels[start:end], weight_tensor[start:end], block_size, return_flags)
+        if return_flags:
+            assert end == store.num_examples or columns.size(0) % 8 == 0, "the chunks must be a multiple of 8 examples"
+            chunk_errors, chunk_flags = chunk_errors
+            packed_flags.append(chunk_flags)
+        errors += chunk_errors
+    if return_flags:
+        return errors, torch.cat(packed_flags, dim = 1)
+    return errors
+
+def evaluate_candidates(cache_probs, candidate_ids: torch.LongTensor, labels, weight_tensor, block_size = None, return_flags = False):
+    '''
+    weighted error of every candidate (see candidate_errors): resident stores are gathered at once, the others are streamed
+    '''
+    if not as_prob_store(cache_probs).is_resident():
+        return streamed_candidate_errors(cache_probs, candidate_ids, labels, weight_tensor, block_size, return_flags)
+    device = weight_tensor.device
+    columns, positions = gather_candidate_columns(cache_probs, candidate_ids, device)
+    return candidate_errors(columns, positions, labels.to(device), weight_tensor, block_size, return_flags)
+
+def pack_flags(wrong_flags):
+    '''
+    num_candidates * num_examples 0/1 flags -> num_candidates * ceil(num_examples / 8) uint8, bit b of byte j being example 8j + b
+    '''
+    num_rows, num_examples = wrong_flags.size()
+    flags = F.pad(wrong_flags.to(torch.uint8), (0, (-num_examples) % 8)).view(num_rows, -1, 8)
+    bit_values = torch.tensor([1 << bit for bit in range(8)], dtype = torch.uint8, device = flags.device)
+    return torch.sum(flags * bit_values, dim = 2).to(torch.uint8)
+
+def packed_weighted_errors(packed_flags, weight_tensor, block_size = None):
+    '''
+    weighted error of every row of bit-packed wrong flags: one matrix-vector product with the weights per bit position
+    '''
+    num_rows, num_bytes = packed_flags.size()
+    weights = F.pad(weight_tensor.float(), (0, num_bytes * 8 - weight_tensor.size(0))).view(num_bytes, 8)
+    if block_size is None:
+        block_size = max(1, SEARCH_BLOCK_ELEMENTS // max(1, num_bytes))
+    errors = torch.zeros(num_rows, dtype = torch.float32, device = packed_flags.device)
+    for start in range(0, num_rows, block_size):
+        block = packed_flags[start: start + block_size]
+        for bit in range(8):
+            errors[start: start + block.size(0)] += torch.matmul(((block >> bit) & 1).float(), weights[:, bit])
+    return errors
+
+def hash_candidates(candidate_ids: torch.LongTensor) -> torch.LongTensor:
+    '''
+    int64 hash of every candidate (num_candidates * num_classes token ids), computed on the device (the products wrap around)
+    '''
+    hashes = torch.zeros(candidate_ids.size(0), dtype = torch.long, device = candidate_ids.device)
+    for i in range(candidate_ids.size(1)):
+        hashes = hashes * 1000003 + candidate_ids[:, i].long()
+    return hashes
+
+class CandidateFlagCache():
+    '''
+    the bit-packed wrong flags of the candidates already evaluated on the training set of a template. The predictions of a
+    candidate do not depend on the dataset weights, so when the template is used again, the errors of the cached candidates
+    are matrix-vector products with the current weights and only the new candidates are evaluated.
+    The candidates are looked up on the device: the hashes of the cached candidates are kept sorted (searchsorted), and a
+    hit is confirmed by comparing the token ids, so a hash collision is a miss.
+    '''
+    def __init__(self, store):
+        self.store = store
+        self.candidate_ids = None
+        self.packed_flags = None
+        self.sorted_hashes = None
+        self.order = None
+
+    def __len__(self):
+        return 0 if self.candidate_ids is None else self.candidate_ids.size(0)
+
+    def nbytes(self):
+        if self.packed_flags is None:
+            return 0
+        return self.packed_flags.nelement()
+
+    def lookup(self, candidate_ids: torch.LongTensor):
+        '''
+        return: the row of every candidate in the cache, -1 for the candidates it does not hold (on the device of candidate_ids)
+        '''
+        rows = torch.full([candidate_ids.size(0)], -1, dtype = torch.long, device = candidate_ids.device)
+        if len(self) == 0:
+            return rows
+        candidate_ids = candidate_ids.to(self.candidate_ids.device)
+        hashes = hash_candidates(candidate_ids)
+        positions = torch.searchsorted(self.sorted_hashes, hashes).clamp(max = len(self) - 1)
+        found_rows = self.order[positions]
+        hit = (self.sorted_hashes[positions] == hashes) & (self.candidate_ids[found_rows] == candidate_ids).all(dim = 1)
+        return torch.where(hit, found_rows, rows.to(found_rows.device)).to(rows.device)
+
+    def add(self, candidate_ids: torch.LongTensor, packed_flags):
+        num_rows = min(candidate_ids.size(0), self.store.remaining_bytes() // max(1, packed_flags.size(1)))
+        if num_rows <= 0:
+            return
+        candidate_ids = candidate_ids[:num_rows].to(packed_flags.device)
+        if self.packed_flags is None:
+            self.candidate_ids = candidate_ids.clone()
+            self.packed_flags = packed_flags[:num_rows].clone()
+        else:
+            self.candidate_ids = torch.cat([self.candidate_ids, candidate_ids], dim = 0)
+            self.packed_flags = torch.cat([self.packed_flags, packed_flags[:num_rows]], dim = 0)
+        self.sorted_hashes, self.order = torch.sort(hash_candidates(self.candidate_ids))
+
+    def get_flags(self, rows):
+        return self.packed_flags[rows.to(self.packed_flags.device)]
+
+class CandidateFlagStore():
+    '''
+    the CandidateFlagCache of every template (key: e.g. the template name), sharing max_bytes of device memory
+    '''
+    def __init__(self, max_bytes = 1 << 30):
+        self.max_bytes = max_bytes
+        self.caches = {}
+
+    def get(self, key):
+        if key not in self.caches:
+            self.caches[key] = CandidateFlagCache(self)
+        return self.caches[key]
+
+    def remaining_bytes(self):
+        return max(0, self.max_bytes - sum(cache.nbytes() for cache in self.caches.values()))
+
+def search_best_verbalizer(cache_probs, candidate_ids: torch.LongTensor, labels: torch.LongTensor, weight_tensor: torch.FloatTensor,
+                           block_size = None, flag_cache: CandidateFlagCache = None, sync = True):
+    '''
+    Batched search of the candidate verbalizer with the lowest weighted error. Ties are broken by the first candidate,
+    as in the sequential search of PromptBoostingTrainer.train.
+    flag_cache: the errors of the candidates it holds are computed from their cached wrong flags, and the wrong flags of the
+                other candidates are added to it. The errors of all the candidates are then computed from the packed flags
+                in one call, so a candidate gets the same error whether it was cached or not.
+    sync:       return python numbers, otherwise tensors on the device
+    return: index of the best candidate, its error, and the largest error among the candidates
+    '''
+    device = weight_tensor.device
+    if flag_cache is None:
+        errors = evaluate_candidates(cache_probs, candidate_ids, labels, weight_tensor, block_size)
+    else:
+        candidate_ids = candidate_ids.to(device)
+        rows = flag_cache.lookup(candidate_ids)
+        miss_index = torch.nonzero(rows < 0).view(-1)
+        hit_index = torch.nonzero(rows >= 0).view(-1)
+        packed_flags = []
+        if hit_index.size(0) > 0:
+            packed_flags.append(flag_cache.get_flags(rows[hit_index]).to(device))
+        if miss_index.size(0) > 0:
+            _, new_flags = evaluate_candidates(cache_probs, candidate_ids[miss_index], labels, weight_tensor, block_size, return_flags = True)
+            flag_cache.add(candidate_ids[miss_index], new_flags)
+            packed_flags.append(new_flags)
+        errors = torch.zeros(candidate_ids.size(0), dtype = torch.float32, device = device)
+        errors[torch.cat([hit_index, miss_index])] = packed_weighted_errors(torch.cat(packed_flags, dim = 0), weight_tensor)
+    best_index = torch.argmin(errors)
+    if not sync:
+        return best_index, errors[best_index], errors.max()
+    summary = torch.stack([errors[best_index], errors.max()]).tolist()    ## one host sync
+    return best_index.item(), summary[0], summary[1]
+
+def race_best_verbalizer(cache_probs, candidate_ids: torch.LongTensor, labels: torch.LongTensor, weight_tensor: torch.FloatTensor,
+                         delta = 0.05, initial_size = RACE_INITIAL_SIZE, growth = RACE_GROWTH, block_size = None):
+    '''
+    Racing search of the candidate verbalizer with the lowest weighted error. The training examples are sampled with
+    probability proportional to their weights, so the error rate of a candidate on the sample estimates its weighted error.
+    The candidates are evaluated on growing prefixes of the sample (initial_size, * growth, ... up to num_examples draws) and
+    the ones whose estimate is more than two Hoeffding radii above the best estimate are dropped; with a union bound over the
+    candidates and the stages, the best candidate is dropped with probability at most delta. The remaining candidates are
+    then evaluated exactly on the full training set (ties broken by the first candidate, as in search_best_verbalizer).
+    return: index of the best candidate, its error, and the largest estimated error among the candidates
+    '''
+    device = weight_tensor.device
+    num_candidates = candidate_ids.size(0)
+    labels = labels.to(device)
+    columns, positions = gather_candidate_columns(cache_probs, candidate_ids, device)
+    num_examples = columns.size(0)
+    num_stages = 1
+    while initial_size * growth ** (num_stages - 1) < num_examples:
+        num_stages += 1
+    sample = torch.multinomial(weight_tensor.float(), num_examples, replacement = True)
+    alive = torch.arange(num_candidates, device = device)
+    sample_size, worst_error = min(initial_size, num_examples), None
+    while sample_size < num_examples and alive.size(0) > 1:
+        sample_ids = sample[:sample_size]
+        estimates = candidate_errors(columns[sample_ids], positions[alive], labels[sample_ids],
+                                     torch.full([sample_size], 1 / sample_size, device = device), block_size)
+        if worst_error is None:
+            worst_error = estimates.max()
+        radius = np.sqrt(np.log(2 * num_candidates * num_stages / delta) / (2 * sample_size))
+        alive = alive[estimates <= estimates.min() + 2 * radius]
+        sample_size *= growth
+    errors = candidate_errors(columns, positions[alive], labels, weight_tensor, block_size)
+    best_index = torch.argmin(errors)
+    if worst_error is None:
+        worst_error = errors.max()
+    summary = torch.stack([alive[best_index].float(), errors[best_index], worst_error, torch.tensor(float(alive.size(0)), device = device)]).tolist()
+    print(f"racing: {int(summary[3])} of {num_candidates} candidates evaluated on the full training set")
+    return int(summary[0]), summary[1], summary[2]
+
+def batched_candidate_errors(columns, positions, labels, weight_tensors, block_size = None):
+    '''
+    candidate_errors for several runs sharing the same training set, the runs being an extra dimension.
+    positions: num_runs * num_candidates * num_classes, weight_tensors: num_runs * num_examples
+    return: num_runs * num_candidates errors
+    '''
+    num_examples = columns.size(0)
+    num_runs, num_candidates, num_classes = positions.size()
+    if block_size is None:
+        block_size = max(1, SEARCH_BLOCK_ELEMENTS // max(1, num_examples * num_runs * num_classes))
+    errors = torch.zeros([num_runs, num_candidates], dtype = torch.float32, device = columns.device)
+    for start in range(0, num_candidates, block_size):
+        block_positions = positions[:, start: start + block_size]    ## num_runs, block, num_classes
+        logits = columns[:, block_positions]                         ## num_examples, num_runs, block, num_classes
+        wrong_flags = (torch.argmax(logits, dim = -1) != labels.view(-1, 1, 1)).float()
+        errors[:, start: start + block_positions.size(1)] = torch.einsum('nrb,rn->rb', wrong_flags, weight_tensors.float())
+    return errors
+
+def search_best_verbalizers(cache_probs, candidate_ids: torch.LongTensor, labels: torch.LongTensor, weight_tensors: torch.FloatTensor,
+                            block_size = None):
+    '''
+    search_best_verbalizer for several runs at once: the columns of the candidates of all the runs are gathered once.
+    candidate_ids: num_runs * num_candidates * num_classes (pad with repeated candidates), weight_tensors: num_runs * num_examples
+    return: token ids of the best verbalizer of every run (num_runs * num_classes), their errors and the largest errors (tensors)
+    '''
+    device = weight_tensors.device
+    num_runs, num_candidates, num_classes = candidate_ids.size()
+    columns, positions = gather_candidate_columns(cache_probs, candidate_ids.view(-1, num_classes), device)
+    errors = batched_candidate_errors(columns, positions.view(num_runs, num_candidates, num_classes), labels.to(device),
+                                      weight_tensors, block_size)
+    best_index = torch.argmin(errors, dim = 1)
+    best_selected = candidate_ids[torch.arange(num_runs, device = candidate_ids.device), best_index.to(candidate_ids.device)]
+    return best_selected, errors.gather(1, best_index.view(-1, 1)).view(-1), errors.max(dim = 1).values
+
+def exact_search_verbalizer(cache_probs, class_candidates: List[torch.LongTensor], labels: torch.LongTensor, weight_tensor: torch.FloatTensor):
+    '''
+    Exact search of the verbalizer with the lowest weighted error over the full product of the per-class candidate tokens,
+    without enumerating it. The classes are assigned one at a time (depth-first, best bound first) and a partial verbalizer
+    is pruned when the weight of the examples it already gets wrong, whatever the tokens of the remaining classes, is not
+    below the best error found so far:
+        - an example of an assigned class is wrong once an assigned class beats its token (the error only grows with the
+          remaining classes), or when every candidate of some remaining class beats it.
+        - an example of a remaining class is wrong when the assigned tokens beat every candidate of its class.
+    Ties follow torch.argmax (the first class wins), so the errors are the same as in compute_acc.
+    For binary tasks the reversed pairs are searched as well, as in the sampled search.
+    class_candidates: num_classes lists of token ids (e.g. the label set of each class)
+    return: token ids of the best verbalizer and its error
+    '''
+    num_classes = len(class_candidates)
+    candidate_orders = [list(range(num_classes))]
+    if num_classes == 2:  ## extend verbalizer: class 0 takes the candidates of class 1 and vice versa
+        candidate_orders.append([1, 0])
+    device = weight_tensor.device
+    labels = labels.to(device).long()
+    store = as_prob_store(cache_probs)
+    candidate_columns = [store.gather(ids).to(device) for ids in class_candidates]    ## num_classes * (num_examples, label_set_size)
+
+    best_selected, best_error, num_nodes = None, float('inf'), 0
+    for candidate_order in candidate_orders:
+        class_ids = [class_candidates[i] for i in candidate_order]
+        class_columns = [candidate_columns[i] for i in candidate_order]
+        ## the largest probability an example can get for its own class, and for every depth the largest of the smallest
+        ## probabilities of the classes that remain to be assigned
+        max_label_probs = torch.stack([columns.max(dim = 1).values for columns in class_columns])[labels, torch.arange(labels.size(0), device = device)]
+        min_probs = [columns.min(dim = 1).values for columns in class_columns]
+        future_min_probs = [torch.stack(min_probs[d + 1:]).max(dim = 0).values if d + 1 < num_classes else None for d in range(num_classes)]
+
+        num_examples = labels.size(0)
+        stack = [(0., 0, [], torch.zeros(num_examples, dtype = torch.bool, device = device),
+                  torch.full((num_examples,), -float('inf'), device = device), torch.zeros(num_examples, device = device))]
+        while len(stack) > 0:
+            bound, depth, assigned, wrong_flags, max_probs, label_probs = stack.pop()
+            if bound >= best_error:
+                continue
+            num_nodes += 1
+            columns = class_columns[depth]                             ## num_examples, label_set_size
+            assigned_label = (labels < depth).view(-1, 1)
+            curr_label = (labels == depth).view(-1, 1)
+            child_wrong = wrong_flags.view(-1, 1) | (assigned_label & (columns > label_probs.view(-1, 1))) \
+                          | (curr_label & (max_probs.view(-1, 1) >= columns))
+            if depth + 1 == num_classes:
+                errors = torch.matmul(weight_tensor, child_wrong.float())
+                best_index = torch.argmin(errors)
+                error = errors[best_index].item()
+                if error < best_error:
+                    best_error = error
+                    best_selected = assigned + [best_index.item()]
+                    best_selected = [class_ids[d][best_selected[d]].item() for d in range(num_classes)]
+                continue
+            child_max_probs = torch.maximum(max_probs.view(-1, 1), columns)
+            child_label_probs = torch.where(curr_label, columns, label_probs.view(-1, 1))
+            assigned_label = (labels <= depth).view(-1, 1)
+            lower_bound_wrong = child_wrong | (assigned_label & (future_min_probs[depth].view(-1, 1) > child_label_probs)) \
+                                | (~assigned_label & (child_max_probs >= max_label_probs.view(-1, 1)))
+            bounds = torch.matmul(weight_tensor, lower_bound_wrong.float()).tolist()
+            for j in sorted(range(len(bounds)), key = lambda j: bounds[j], reverse = True):    ## the best bound is popped first
+                if bounds[j] < best_error:
+                    stack.append((bounds[j], depth + 1, assigned + [j], child_wrong[:, j], child_max_probs[:, j], child_label_probs[:, j]))
+    print(f"exact search: {num_nodes} nodes expanded")
+    return best_selected, best_error
@@ -5,13 +5,17 @@ import tqdm
 import time
 import copy
 import os
+import shutil
+import tempfile
 
 from src.multicls_trainer import PromptBoostingTrainer
 from src.ptuning import  RoBERTaVTuningClassification, OPTVTuningClassification
-from src.saver import PredictionSaver, TestPredictionSaver
+from src.saver import PredictionSaver, TestPredictionSaver, VerbalizerMemo
 from src.template import SentenceTemplate, TemplateManager
 from src.utils import ROOT_DIR, create_logger, MODEL_CACHE_DIR
 from src.data_util import get_class_num, load_dataset, get_task_type, get_template_list
+from src.planner import plan_storage, GB
+from src.prob_store import DEFAULT_TOPK, delete_prob_store
 
 import wandb
 import argparse
@@ -34,6 +38,15 @@ parser.add_argument("--fewshot_seed", type = int, default = 100, choices = [100,
 
 parser.add_argument("--filter_templates", action = 'store_true')
 
+parser.add_argument("--storage_mode", type = str, default = 'auto', choices = ['auto', 'dense', 'half', 'topk', 'mmap'])
+parser.add_argument("--store_topk", type = int, default = DEFAULT_TOPK)
+parser.add_argument("--store_layout", type = str, default = 'example', choices = ['example', 'token'])
+parser.add_argument("--search_mode", type = str, default = 'batched', choices = ['loop', 'batched', 'exact', 'race'], help = "verbalizer candidate search")
+parser.add_argument("--race_delta", type = float, default = 0.05, help = "race search mode: the largest probability to drop the best candidate")
+parser.add_argument("--verbalizer_memo", action = 'store_true', help = "reuse (and record) the weak learners fitted on the templates with uniform weights")
+parser.add_argument("--memory_budget", type = float, default = 0, help = "GB, 0 for detecting from the device")
+parser.add_argument("--disk_budget", type = float, default = 0, help = "GB, 0 for detecting from the file system")
+
 args = parser.parse_args()
 
 
@@ -98,11 +111,26 @@ if __name__ == '__main__':
     dir_list = "\n\t".join(template_manager.template_dir_list)
     print(f"using templates from: {dir_list}",)
 
-    trainer = PromptBoostingTrainer(num_classes = num_classes, adaboost_maximum_epoch = adaboost_maximum_epoch)
+    ## predictions are not cached here: only the stores of the current template (and the test set of the best one) are kept,
+    ## in a directory of the run that is removed at the end
+    store_root = os.path.join(ROOT_DIR, 'cached_preds/')
+    if not os.path.exists(store_root):
+        os.makedirs(store_root)
+    run_store_dir = tempfile.mkdtemp(prefix = 'weakcls_', dir = store_root)
+    storage_plan = plan_storage(num_training, num_valid, num_test, vtuning_model.lm_model.config.vocab_size,
+                                num_templates = 1, num_weak_cls = 0,
+                                storage_mode = args.storage_mode, topk = args.store_topk, device = device, cache_dir = store_root,
+                                memory_budget = int(args.memory_budget * GB), disk_budget = int(args.disk_budget * GB))
+
+    trainer = PromptBoostingTrainer(num_classes = num_classes, adaboost_maximum_epoch = adaboost_maximum_epoch,
+                                    storage_mode = storage_plan.mode, store_topk = storage_plan.topk,
+                                    store_layout = args.store_layout, search_mode = args.search_mode,
+                                    race_delta = args.race_delta)
 
     word2idx = vtuning_model.tokenizer.get_vocab()
-
-
+    memo = None
+    if args.verbalizer_memo:
+        memo = VerbalizerMemo(train_dataset, valid_dataset, model_name = model, search_config = trainer.memo_config())
 
     best_valid = 0
     best_test = 0
@@ -114,25 +142,46 @@ if __name__ == '__main__':
     iter_num = np.min([len(all_templates), args.max_template_num])
 
     for model_id in tqdm.tqdm(range(iter_num)):
+        delete_prob_store(train_probs)
+        delete_prob_store(valid_probs)
         del train_probs
         del valid_probs
         template = template_manager.change_template()
         template.visualize()
-    
-        train_probs = trainer.pre_compute_logits(vtuning_model, template, train_dataset,)
-        valid_probs = trainer.pre_compute_logits(vtuning_model, template, valid_dataset,)
-
-        trainer.record_dataset_weights(weight_tensor)
-
-        verbalizer, train_error,train_acc, wrong_flags,train_preds= trainer.train(train_dataset, vtuning_model, train_probs, train_labels,
-                                                                                weight_tensor = weight_tensor,label_set_size = label_set_size,
-                                                                                )
-        print(verbalizer)
-        print(f"\ttemplate {model_id + 1} finished")
-        print(f"\ttrain error {train_error}, train_acc {train_acc}")
-        succ_flag = True
-                
-        valid_acc, valid_preds, valid_logits = trainer.evaluate(word2idx, valid_probs, verbalizer, valid_labels)
+
+        memo_entry = memo.load(template, label_set_size) if memo is not None else None
+        if memo_entry is not None:
+            ## the weak learner of this template is memoized: no forward pass
+            train_probs, valid_probs = None, None
+            trainer.replay_search_rng(label_set_size)
+            best_tokens = vtuning_model.tokenizer.convert_ids_to_tokens(memo_entry['verbalizer'])
+            verbalizer = {i:best_tokens[i] for i in range(num_classes)}
+            train_error, train_acc, valid_acc = memo_entry['train_error'], memo_entry['train_acc'], memo_entry['valid_acc']
+            print(verbalizer)
+            print(f"\ttemplate {model_id + 1} finished (memoized)")
+            print(f"\ttrain error {train_error}, train_acc {train_acc}")
+            print(f"\tvalid accuracy {valid_acc}")
+        else:
+            train_probs = trainer.pre_compute_logits(vtuning_model, template, train_dataset,
+                                                     store_path = os.path.join(run_store_dir, f"{template.template_name}_train"))
+            valid_probs = trainer.pre_compute_logits(vtuning_model, template, valid_dataset,
+                                                     store_path = os.path.join(run_store_dir, f"{template.template_name}_valid"))
+
+            trainer.record_dataset_weights(weight_tensor)
+
+            _, scores = trainer.get_label_set_scores(train_dataset, vtuning_model, train_probs, weight_tensor)
+            verbalizer, train_error,train_acc, wrong_flags,train_preds= trainer.train(train_dataset, vtuning_model, train_probs, train_labels,
+                                                                                    weight_tensor = weight_tensor,label_set_size = label_set_size,
+                                                                                    scores = scores)
+            print(verbalizer)
+            print(f"\ttemplate {model_id + 1} finished")
+            print(f"\ttrain error {train_error}, train_acc {train_acc}")
+            succ_flag = True
+
+            valid_acc, valid_preds, valid_logits = trainer.evaluate(word2idx, valid_probs, verbalizer, valid_labels)
+            if memo is not None:
+                memo.save(template, label_set_size, scores, [word2idx[verbalizer[i]] for i in range(num_classes)],
+                          train_error, train_acc, valid_acc)
         if valid_acc > best_valid:
             best_valid = valid_acc
             best_template = copy.deepcopy(template)
@@ -145,7 +194,14 @@ if __name__ == '__main__':
         if use_wandb:
             wandb.log(tolog)
     
-    cls_scores = trainer.pre_compute_logits(vtuning_model, best_template, test_dataset)
+    delete_prob_store(train_probs)
+    delete_prob_store(valid_probs)
+    del train_probs
+    del valid_probs
+    cls_scores = trainer.pre_compute_logits(vtuning_model, best_template, test_dataset,
+                                            store_path = os.path.join(run_store_dir, f"{best_template.template_name}_test"))
     test_acc, test_preds, test_logits, = trainer.evaluate(word2idx, cls_scores, best_verbalizer, test_labels)
+    del cls_scores
+    shutil.rmtree(run_store_dir, ignore_errors = True)
     best_template.visualize()
     print(f"best test acc {test_acc}")